@@ -19,7 +19,12 @@
 # limitations under the License.
 # 
 
-from . import editing
-from . import algorithms
-from . import backends
+from ._lazy import lazy_submodules
+
+# subpackages are imported on first access so that, e.g., a training job
+# which only needs `quantlib.algorithms.pact` does not pay for importing
+# exporters and their dependencies (ONNX, torchvision, ...)
+_LAZY_SUBMODULES = ['editing', 'algorithms', 'backends']
+
+__getattr__, __dir__ = lazy_submodules(globals(), _LAZY_SUBMODULES)
 
@@ -0,0 +1,40 @@
+#
+# _lazy.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import importlib
+
+__all__ = ['lazy_submodules']
+
+def lazy_submodules(package_globals : dict, submodules : list):
+    # returns the module-level `__getattr__` and `__dir__` functions for a
+    # package whose `submodules` are only imported on first access. Use as
+    #   __getattr__, __dir__ = lazy_submodules(globals(), [...])
+    package = package_globals['__name__']
+
+    def __getattr__(name):
+        if name in submodules:
+            return importlib.import_module(f"{package}.{name}")
+        raise AttributeError(f"module {package!r} has no attribute {name!r}")
+
+    def __dir__():
+        return sorted(set(package_globals.keys()) | set(submodules))
+
+    return __getattr__, __dir__
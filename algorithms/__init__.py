@@ -20,13 +20,18 @@
 # limitations under the License.
 # 
 
+from .._lazy import lazy_submodules
+
 from .controller import Controller
 
 from . import ste
-from . import inq
-from . import ana
 from . import pact
 
+# ana and inq depend on SciPy - they are only imported on first access
+_LAZY_SUBMODULES = ['inq', 'ana']
+
+__getattr__, __dir__ = lazy_submodules(globals(), _LAZY_SUBMODULES)
+
 __all__ = [
     'ste',
     'inq',
@@ -1,6 +1,12 @@
+from ..._lazy import lazy_submodules
+
 from .bb_ops import *
 from .bb_controllers import *
 from .bb_functions import BBQuantize, BBQuantizeTestTime, bb_cdf, bb_ccdf
 from .bb_loss import *
 from .bb_opt import *
-from . import generate_bench_spec
+
+# generate_bench_spec depends on pandas - it is only imported on first access
+_LAZY_SUBMODULES = ['generate_bench_spec']
+
+__getattr__, __dir__ = lazy_submodules(globals(), _LAZY_SUBMODULES)
@@ -5,7 +5,6 @@ import torch
 import json
 
 import numpy as np
-from scipy.optimize import nnls
 
 from torch import nn, fx
 
@@ -343,6 +342,8 @@ class BBSplitLatencyRegularizer(BBLatencyRegularizer):
                 contrib = torch.cat([contribution_a, contribution_w], dim=1).numpy()
                 penalty_target = self.scales.transpose(1,0).flatten().numpy()
                 # we need nonnegative target penalties, so use SciPy's NNLS solver
+                # (imported here to keep SciPy out of `import quantlib`)
+                from scipy.optimize import nnls
                 #l2_penalties, _, _, _ = np.linalg.lstsq(contrib, penalty_target)
                 l2_penalties, _ = nnls(contrib, penalty_target)
                 act_penalties = np.zeros(self.scales.shape[0])
@@ -174,7 +174,7 @@ def build_net_latency_dict(net : nn.Module, shape_in : Union[Tuple[int], List[in
     from quantlib.editing.fx.passes.bb import BB_symbolic_trace, BBControllerPrepPass, find_layer_sets
     if not isinstance(net, fx.GraphModule):
         net = BB_symbolic_trace(net)
-    prep_pass = BBControllerPrepPass(shape_in=shape_in, latency_spec=latency_spec)
+    prep_pass = BBControllerPrepPass(shape_in=shape_in, latency_spec=latency_spec, input_prec=input_prec)
     net = prep_pass(net)
     prop_dict = deepcopy(prep_pass.property_dict)
     layer_pairs = find_layer_sets(net)
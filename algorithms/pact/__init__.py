@@ -19,6 +19,7 @@
 # limitations under the License.
 # 
 
+from .observers import *
 from .pact_ops import *
 from .pact_controllers import *
 from .pact_optimizers import *
@@ -0,0 +1,169 @@
+#
+# observers.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import math
+
+import torch
+from torch import nn
+
+
+__all__ = [
+    'HistogramObserver',
+    'QuantileSketch',
+]
+
+
+class HistogramObserver(nn.Module):
+    r"""Streaming histogram of observed values which lives entirely on the
+    device of the observed tensors. The histogram covers :math:`[-t, t]` in
+    signed mode or :math:`[0, t]` in unsigned mode. When values outside of
+    the current range are observed, :math:`t` is expanded by a power of 2 so
+    the old histogram can be merged into the new one by summing groups of
+    adjacent bins. No values are ever read back to the host in `update`, so
+    statistics can be gathered at (nearly) the speed of a plain forward pass.
+    """
+    def __init__(self, num_bins : int = 2**12, signed : bool = True):
+        r"""Constructor.
+
+        :param num_bins: Number of histogram bins. Should be even.
+        :param signed:   Whether the histogram covers negative values.
+        """
+        super(HistogramObserver, self).__init__()
+        self.num_bins = num_bins
+        self.signed = signed
+        self.register_buffer('histogram', torch.zeros(num_bins))
+        self.register_buffer('truemax', torch.Tensor((1.,)))
+        self.register_buffer('truemin', torch.Tensor((-1. if signed else 0.,)))
+
+    def reset(self):
+        self.histogram.zero_()
+        self.truemax.fill_(1.)
+        self.truemin.fill_(-1. if self.signed else 0.)
+
+    def edges(self):
+        # the bin edges are only needed when computing clipping bounds, so the
+        # host sync of linspace does not matter here.
+        return torch.linspace(self.truemin[0], self.truemax[0], self.num_bins+1).type_as(self.histogram)
+
+    def update(self, x : torch.Tensor):
+        with torch.no_grad():
+            x = x.detach().flatten().type_as(self.histogram)
+            if x.numel() == 0:
+                return
+
+            bin_top = torch.maximum(self.truemin.abs(), self.truemax)
+            new_top = torch.maximum(torch.minimum(self.truemin, x.min()).abs(), torch.maximum(self.truemax, x.max()))
+            # only rescale exponentially - this way, the old histogram can be
+            # merged by summing up groups of `factor` adjacent bins
+            factor = torch.clamp(2**torch.ceil(torch.log2(new_top / bin_top)), min=1.)
+            top = factor * bin_top
+            bottom = -top if self.signed else torch.zeros_like(top)
+
+            bins = torch.arange(self.num_bins, device=x.device)
+            factor_int = factor.long()
+            if self.signed:
+                # the signed histogram is rescaled around the center bin
+                center = self.num_bins//2
+                merged_bins = torch.div(bins - center, factor_int, rounding_mode='floor') + center
+            else:
+                merged_bins = torch.div(bins, factor_int, rounding_mode='floor')
+            new_hist = torch.zeros_like(self.histogram).index_add_(0, merged_bins, self.histogram)
+
+            # bin the new observations; like `torch.histc`, values equal to
+            # the upper edge go into the last bin and values outside of the
+            # histogram range (i.e., negative values in unsigned mode) are
+            # dropped.
+            x_bins = torch.floor((x - bottom) / (top - bottom) * self.num_bins).clamp(0, self.num_bins-1).long()
+            in_range = ((x >= bottom) & (x <= top)).type_as(x)
+            new_hist.index_add_(0, x_bins, in_range)
+
+            self.histogram.copy_(new_hist)
+            self.truemax.copy_(top)
+            self.truemin.copy_(bottom)
+
+
+class QuantileSketch(nn.Module):
+    r"""Mergeable quantile sketch in the style of t-digest. The observed
+    distribution is summarized by `size` weighted centroids. Centroid
+    boundaries are spaced according to the arcsine scale function, so
+    centroids in the tails of the distribution are much smaller than in the
+    center and extreme percentiles (e.g., 99.99%) can be resolved far more
+    finely than with a fixed-range histogram. Like the
+    :class:`HistogramObserver`, all updates are performed on the device
+    without host synchronization.
+    """
+    def __init__(self, size : int = 512, sample_size : int = 2**16):
+        r"""Constructor.
+
+        :param size:        Number of centroids.
+        :param sample_size: Maximum number of values per observed tensor to
+                            merge into the sketch. Larger tensors are uniformly
+                            subsampled.
+        """
+        super(QuantileSketch, self).__init__()
+        self.size = size
+        self.sample_size = sample_size
+        self.register_buffer('values', torch.full((size,), float('inf')))
+        self.register_buffer('weights', torch.zeros(size))
+        q = torch.arange(size+1, dtype=torch.float64)/size
+        self.register_buffer('q_bounds', ((1 - torch.cos(math.pi * q))/2).float())
+
+    def reset(self):
+        self.values.fill_(float('inf'))
+        self.weights.zero_()
+
+    def _compress(self, values : torch.Tensor, weights : torch.Tensor):
+        values, order = torch.sort(values)
+        weights = weights[order]
+        cum_weights = torch.cumsum(weights, dim=0)
+        # assign every candidate to the centroid its (midpoint) rank falls into
+        pos = (cum_weights - weights/2) / cum_weights[-1:]
+        idx = (torch.searchsorted(self.q_bounds, pos.type_as(self.q_bounds), right=True) - 1).clamp(0, self.size-1)
+        # empty centroids hold inf, which must not leak into the sums
+        weighted = torch.where(weights > 0, weights * values, torch.zeros_like(values))
+        new_weights = torch.zeros_like(self.weights).index_add_(0, idx, weights)
+        new_sums = torch.zeros_like(self.values).index_add_(0, idx, weighted)
+        self.values.copy_(torch.where(new_weights > 0, new_sums / new_weights, torch.full_like(new_sums, float('inf'))))
+        self.weights.copy_(new_weights)
+
+    def update(self, x : torch.Tensor):
+        with torch.no_grad():
+            x = x.detach().flatten().type_as(self.values)
+            n = x.numel()
+            if n == 0:
+                return
+            if n > self.sample_size:
+                x = x[torch.randint(n, (self.sample_size,), device=x.device)]
+            w = torch.full_like(x, n/x.numel())
+            w = torch.where(torch.isnan(x), torch.zeros_like(w), w)
+            self._compress(torch.cat((self.values, x)), torch.cat((self.weights, w)))
+
+    def quantile(self, q : float):
+        r"""Estimate the `q`-quantile (:math:`0 \leq q \leq 1`) of all observed
+        values. Returns a 1-element tensor.
+        """
+        cum_weights = torch.cumsum(self.weights, dim=0)
+        target = q * cum_weights[-1:]
+        idx = torch.searchsorted(cum_weights, target, right=True)
+        # never select one of the empty trailing centroids
+        last = torch.max(torch.arange(self.size, device=idx.device) * (self.weights > 0).long()).reshape(1)
+        idx = torch.minimum(idx, last)
+        return self.values.index_select(0, idx)
@@ -30,7 +30,7 @@ from quantlib.editing.lightweight.rules.filters import VariadicOrFilter, NameFil
 from ..controller import Controller
 
 from .pact_ops import *
-from .util import assert_param_valid, almost_symm_quant, mse_bounds
+from .util import assert_param_valid, almost_symm_quant, mse_bounds, mse_bounds_histogram, klj_clip_max
 
 import copy
 
@@ -98,17 +98,79 @@ class PACTEpsController(Controller):
         self.eps_pass = eps_pass
         # Choose a tracer that doesn't have PACTWrapModule!
         self.tracer = tracer
-
-    def step_pre_training_batch(self, *args, **kwargs):
+        # the model is traced only once; see `retrace`
+        self.fx_model = None
+        self.eps_plan = None
+        self.eps_consumers = None
+        self._eps_state = None
+
+    def retrace(self):
+        # trace the model and precompile the eps propagation over the nodes
+        # upstream of the controlled modules. Call this if the structure of
+        # the model has changed.
         fx_graph = self.tracer.trace(self.model)
-        fx_model = torch.fx.GraphModule(self.tracer.root, fx_graph, self.tracer.root.__class__.__name__)
-        fx_model = self.eps_pass.apply(fx_model)
-        nm = dict(fx_model.named_modules())
+        self.fx_model = torch.fx.GraphModule(self.tracer.root, fx_graph, self.tracer.root.__class__.__name__)
+        nm = dict(self.fx_model.named_modules())
+        modules = set(self.modules)
+        self.eps_consumers = [(node, nm[node.target]) for node in fx_graph.nodes if node.op == 'call_module' and nm[node.target] in modules]
+        needed = set()
+        stack = [i for node, _ in self.eps_consumers for i in node.all_input_nodes]
+        while len(stack):
+            node = stack.pop()
+            if node not in needed:
+                needed.add(node)
+                stack.extend(node.all_input_nodes)
+        self.eps_plan = None
+        if hasattr(self.eps_pass, 'eps_plan'):
+            self.eps_plan = self.eps_pass.eps_plan(self.fx_model, [node for node in fx_graph.nodes if node in needed])
+        self._eps_state = None
+
+    def eps_state(self):
+        # snapshot of the state the epsilons of the plan depend on: the
+        # modules' clipping bounds, epsilons and number of levels. Tensors
+        # are compared on their device, so checking for changes costs a
+        # single synchronization.
+        tensors, values = [], []
+        for _, m, _, _ in self.eps_plan:
+            if m is None:
+                continue
+            tensors.extend(t.detach().reshape(-1) for t in self.eps_pass.eps_state_tensors(m))
+            values.extend(v for sm in m.modules() for v in vars(sm).values() if isinstance(v, (bool, int, float)))
+        if len(tensors):
+            dev = tensors[0].device
+            tensors = torch.cat([t.to(device=dev, dtype=torch.float64) for t in tensors])
+        return tensors, tuple(values)
+
+    def _eps_state_changed(self, state):
+        if self._eps_state is None:
+            return True
+        old_tensors, old_values = self._eps_state
+        tensors, values = state
+        if old_values != values or isinstance(tensors, list) != isinstance(old_tensors, list):
+            return True
+        if isinstance(tensors, list):
+            return False
+        return tensors.shape != old_tensors.shape or tensors.device != old_tensors.device or not torch.equal(tensors, old_tensors)
 
-        for node in fx_graph.nodes:
-            if node.op == 'call_module' and nm[node.target] in self.modules:
-                arg_eps_ins = node.meta['quant'].eps_in[0]
-                nm[node.target].set_eps_in(arg_eps_ins)
+    def step_pre_training_batch(self, *args, **kwargs):
+        if self.fx_model is None:
+            self.retrace()
+        if self.eps_plan is None:
+            # eps passes without a precompiled plan are run on the whole model
+            self.eps_pass.apply(self.fx_model)
+            for node, m in self.eps_consumers:
+                m.set_eps_in(node.meta['quant'].eps_in[0])
+            return
+
+        # the epsilons only need to be propagated if the clipping bounds
+        # upstream of the controlled modules changed
+        state = self.eps_state()
+        if not self._eps_state_changed(state):
+            return
+        self._eps_state = state
+        eps = self.eps_pass.run_eps_plan(self.eps_plan)
+        for node, m in self.eps_consumers:
+            m.set_eps_in([eps[i] for i in node.args if isinstance(i, torch.fx.Node)])
 
     def step_pre_training_epoch(self, epoch, *args, **kwargs):
         if epoch in self.schedule.keys():
@@ -226,9 +288,9 @@ class PACTActController(Controller):
                     for m in self.modules:
                         m.ready |= True
                         m.updateClipBounds()
-                        m.histogram *= 0
-                        m.truemax /= m.truemax
-                        m.truemin /= m.truemin
+                        m.observer.reset()
+                        if m.sketch is not None:
+                            m.sketch.reset()
                     self.log("Started activation quantization!")
 
                 elif cmd == 'start':
@@ -301,62 +363,16 @@ class PACTActController(Controller):
                 # it's not an asymmetric activation
                 pass
 
+        elif method == 'mse_hist':
+            m.prevEdges[:] = m.observer.edges()
+            min_val, max_val = mse_bounds_histogram(m.histogram, m.prevEdges, m.n_levels, m.signed, m.mse_iters, m.symm, m.rounding)
+            max_val = max_val.reshape_as(m.clip_hi)
+            min_val = min_val.reshape_as(m.clip_hi)
+
         elif method == 'klj':
 
             m.updateClipBounds()
-
-            l1 = torch.nn.KLDivLoss()
-            l2 = torch.nn.KLDivLoss()
-
-            def klj_loss(x_hp, x_fq, l1, l2):
-                return l1(x_hp, x_fq) + l2(x_fq, x_hp)
-            def jensen_shannon_loss(x_hp, x_fq, l1, l2):
-                return 0.5*(l1(x_hp, ((x_fq+x_hp)/2)) + l2(x_fq, ((x_fq+x_hp)/2)))
-            def cust_loss(x_hp, x_fq, bincenter, l1, l2):
-                return torch.sum((torch.abs(x_hp-x_fq) * torch.abs(bincenter))**2)#* torch.cos(torch.abs(bincenter)/torch.max(bincenter) * pi/2)
-
-            class Resampler(nn.Module):
-                def __init__(self,m):
-                    super().__init__()
-                    self.m = m
-
-                def forward(self, histogram, prevEdges, n_levels, max):
-                    leftIdx = torch.sum(torch.where(prevEdges < -max, 1, 0))
-                    rightIdx = torch.sum(torch.where(prevEdges < max, 1, 0))
-                    newHist = torch.zeros_like(histogram)
-                    oldHist = histogram[leftIdx:rightIdx]
-                    innerSamples = torch.nn.functional.interpolate(oldHist.reshape(1,1,-1),size=n_levels,mode='linear').reshape(-1)
-                    innerSamples[0] = innerSamples[0] + torch.sum(histogram[:leftIdx])
-                    innerSamples[-1] = innerSamples[-1] + torch.sum(histogram[rightIdx:])
-                    innerSamples = torch.nn.functional.interpolate(innerSamples.reshape(1,1,-1),size=(rightIdx-leftIdx),mode='linear').reshape(-1)
-                    newHist[leftIdx:rightIdx] = innerSamples
-                    return newHist
-
-            model = Resampler(m)
-
-            hist = copy.deepcopy(m.histogram/torch.sum(m.histogram))
-            prevEdges = copy.deepcopy(m.prevEdges)
-            binCenters = torch.zeros_like(hist)
-            for idx in range(len(binCenters)):
-                binCenters[idx] = (prevEdges[idx] + prevEdges[idx+1])/2
-            abs_scale = m.truemax / m.num_bins
-
-            best = 0
-            minLoss = 1
-
-            max = copy.deepcopy(m.truemax)
-
-            maxHat = max
-            model.eval()
-            for i in range(m.num_bins-1):
-                newHist = model(hist, prevEdges, m.n_levels, maxHat)
-                absLoss = cust_loss(hist, newHist, binCenters, l1, l2)
-                maxHat = maxHat - abs_scale
-                if absLoss < minLoss:
-                    best = i
-                    minLoss = absLoss.item()
-
-            max_val = m.truemax - abs_scale*best
+            max_val = klj_clip_max(m.histogram, m.prevEdges, m.truemax, m.n_levels)
             if m.symm:
                 min_val, max_val = almost_symm_quant(max_val, m.n_levels)
             else:
@@ -471,6 +487,7 @@ class PACTLinearController(Controller):
                         m.clip_lo.data = torch.minimum(torch.zeros_like(m.clip_lo.data)-0.01, m.clip_lo.data)
                         _, max_val = almost_symm_quant(-m.clip_lo.data, m.n_levels)
                         m.clip_hi.data = max_val
+                        m.invalidate_weight_q_cache()
 
     def step_pre_training_epoch(self, epoch : int, *args, **kwargs):
         # keep track of whether we already performed update_clip_params
@@ -610,6 +627,8 @@ class PACTLinearController(Controller):
 
         m.clip_hi.data = m.expand_bounds(max_val)
         m.clip_lo.data = m.expand_bounds(min_val)
+        # writes through `.data` are not picked up by the weight cache
+        m.invalidate_weight_q_cache()
 
     def log(self, msg : str):
         if self.verbose:
@@ -0,0 +1,99 @@
+#
+# pact_function_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# The different ways of saving state for the backward pass of the PACT/TQT
+# quantization functions (full, lean and replayed from the weight cache) must
+# produce bit-identical gradients.
+
+import unittest
+from unittest import TestCase
+
+import torch
+
+from quantlib.algorithms.pact.pact_functions import PACTQuantize, TQTQuantize
+from quantlib.algorithms.pact.pact_ops import PACTConv2d
+
+
+def _tqt_grads(x, log_t, clip_lo, clip_hi, eps, lean):
+    # returns the gradients w.r.t. input and log_t as well as the updated
+    # running statistics
+    x = x.clone().requires_grad_(True)
+    log_t = log_t.clone().requires_grad_(True)
+    running_grad_var = torch.zeros_like(clip_lo)
+    running_beta = torch.tensor(1.)
+    y = TQTQuantize(x, eps, log_t, clip_lo, clip_hi, torch.tensor(0.9), running_grad_var, running_beta, torch.tensor(True), rounding=True, lean=lean)
+    y.backward(torch.linspace(-1., 1., y.numel()).reshape(y.shape))
+    return y.detach(), x.grad, log_t.grad, running_grad_var, running_beta
+
+def _module_grads(m, cached):
+    m.zero_grad()
+    m.cache_weight_q = cached
+    m.invalidate_weight_q_cache()
+    if m.tqt:
+        m.tqt_running_grad_var.zero_()
+        m.tqt_running_beta.fill_(1.)
+    wq = m.weight_q
+    wq.backward(torch.linspace(-1., 1., wq.numel()).reshape(wq.shape))
+    grads = [p.grad.clone() for p in m.parameters() if p.grad is not None]
+    return [wq.detach()] + grads
+
+class TestLeanBackward(TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.x = torch.randn(8, 4, 3, 3)
+        self.clip_lo = torch.full((8, 1, 1, 1), -1.)
+        self.clip_hi = torch.full((8, 1, 1, 1), 127./128)
+        self.eps = (self.clip_hi - self.clip_lo)/255
+        self.log_t = torch.zeros(8, 1, 1, 1)
+
+    def assertAllEqual(self, a, b):
+        self.assertEqual(len(a), len(b))
+        for ta, tb in zip(a, b):
+            self.assertTrue(torch.equal(ta, tb))
+
+    def test_tqt_lean(self):
+        full = _tqt_grads(self.x, self.log_t, self.clip_lo, self.clip_hi, self.eps, lean=False)
+        lean = _tqt_grads(self.x, self.log_t, self.clip_lo, self.clip_hi, self.eps, lean=True)
+        self.assertAllEqual(full, lean)
+
+    def test_tqt_lean_float_eps(self):
+        eps = 2./255
+        clip_lo, clip_hi, log_t = torch.tensor(-1.), torch.tensor(1.), torch.tensor(0.)
+        full = _tqt_grads(self.x, log_t, clip_lo, clip_hi, eps, lean=False)
+        lean = _tqt_grads(self.x, log_t, clip_lo, clip_hi, eps, lean=True)
+        self.assertAllEqual(full, lean)
+
+    def test_pact_cached(self):
+        m = PACTConv2d(4, 8, 3, n_levels=256, quantize='per_channel', learn_clip=True, symm_wts=True)
+        m.clip_lo.data.copy_(self.clip_lo)
+        m.clip_hi.data.copy_(self.clip_hi)
+        self.assertAllEqual(_module_grads(m, cached=False), _module_grads(m, cached=True))
+
+    def test_tqt_cached(self):
+        m = PACTConv2d(4, 8, 3, n_levels=256, quantize='per_channel', learn_clip=True, symm_wts=True, tqt=True)
+        m.clip_lo.data.copy_(self.clip_lo)
+        m.clip_hi.data.copy_(self.clip_hi)
+        self.assertAllEqual(_module_grads(m, cached=False), _module_grads(m, cached=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,6 +32,51 @@ __all__ = [
 ]
 
 
+# codes for the region of the clipping range an element falls into. The
+# quantization functions store these in a single int8 tensor for the backward
+# pass rather than keeping three full-size boolean masks alive.
+_REGION_LO = -1
+_REGION_NONCLIPPED = 0
+_REGION_HI = 1
+
+def _clip_region(input, clip_lo, clip_hi):
+    # _REGION_LO where input < clip_lo, _REGION_HI where input >= clip_hi and
+    # _REGION_NONCLIPPED everywhere else
+    return (input >= clip_hi).to(torch.int8) - (input < clip_lo).to(torch.int8)
+
+def _pact_fake_quant(input, eps, clip_lo, clip_hi, floor=True, noisy=False):
+    # for completeness' sake (e.g. to reproduce the results from the
+    # PACT+SAWB paper), we allow for outputs which are not a multiple of
+    # eps.
+    # to ensure hardware compatibility, it is the downstream user's
+    # responsibility to ensure that clip_lo/clip_hi are multiples of eps!
+    input_unrounded_int = (input.clamp(clip_lo, clip_hi + 1e-7) - clip_lo)/ eps
+    if noisy:
+        noise = torch.rand(input_unrounded_int.size(), device=input_unrounded_int.device) - 0.5
+        input_unrounded_int += noise
+
+    # for weights, we want to use rounding - for activations, we will round
+    # in hardware so represent this here too
+    input_rounded_int = input_unrounded_int.floor() if floor else input_unrounded_int.round()
+    return input_rounded_int * eps + clip_lo
+
+def _tqt_fake_quant(input, eps, clip_lo, clip_hi, rounding):
+    # for completeness' sake (e.g. to reproduce the results from the
+    # PACT+SAWB paper), we allow for outputs which are not a multiple of
+    # eps.
+    # to ensure hardware compatibility, it is the downstream user's
+    # responsibility to ensure that clip_lo/clip_hi are multiples of eps!
+    input_unrounded_int = (input.clamp(clip_lo, clip_hi) - clip_lo)/ eps
+
+    # for weights, we want to use rounding - for activations, we will round
+    # in hardware so represent this here too
+    if rounding:
+        input_rounded_int = input_unrounded_int.round()
+    else:
+        input_rounded_int = input_unrounded_int.floor()
+    return input_rounded_int * eps + clip_lo
+
+
 #PACT activation: https://arxiv.org/pdf/1805.06085.pdf
 
 class PACTQuantFunc(torch.autograd.Function):
@@ -76,50 +121,38 @@ class PACTQuantFunc(torch.autograd.Function):
 
     @staticmethod
     def forward(ctx, input, eps, clip_lo, clip_hi, floor=True, clip_gradient=True, noisy=False):
-        where_input_nonclipped = torch.mul(input >= clip_lo, input < clip_hi)
-        where_input_lo = (input < clip_lo)
-        where_input_hi = (input >= clip_hi)
-        ctx.save_for_backward(where_input_nonclipped, where_input_lo, where_input_hi, clip_gradient, clip_lo)
-        # for completeness' sake (e.g. to reproduce the results from the
-        # PACT+SAWB paper), we allow for outputs which are not a multiple of
-        # eps.
-        # to ensure hardware compatibility, it is the downstream user's
-        # responsibility to ensure that clip_lo/clip_hi are multiples of eps!
-        input_unrounded_int = (input.clamp(clip_lo, clip_hi + 1e-7) - clip_lo)/ eps
-        if noisy:
-            noise = torch.rand(input_unrounded_int.size(), device=input_unrounded_int.device) - 0.5
-            input_unrounded_int += noise
-
-        # for weights, we want to use rounding - for activations, we will round
-        # in hardware so represent this here too
-        input_rounded_int = input_unrounded_int.floor() if floor else input_unrounded_int.round()
-        return input_rounded_int * eps + clip_lo
+        # instead of three boolean masks, we only keep a single int8 tensor
+        # encoding the clipping region of each element for backprop
+        region = _clip_region(input, clip_lo, clip_hi)
+        ctx.save_for_backward(region, clip_gradient, clip_lo)
+        return _pact_fake_quant(input, eps, clip_lo, clip_hi, floor, noisy)
 
     @staticmethod
     def backward(ctx, grad_output):
-        # see Hubara et al., Section 2.3
-        where_input_nonclipped, where_input_lo, where_input_hi, clip_gradient, clip_lo = ctx.saved_variables
-        zero = torch.zeros(1).to(where_input_nonclipped.device)
-        if clip_gradient:
-            grad_input = torch.where(where_input_nonclipped, grad_output, zero)
-        else:
-            grad_input = grad_output
-        reduce_dims = tuple(range(len(grad_output.shape)))
-        if len(clip_lo.shape) > 1:
-            # this works only for weights due to activations' batch dimensions,
-            # but we don't support per-channel quantization of activations so
-            # it's OK
-            reduce_dims = reduce_dims[1:]
-
-        grad_upper = torch.where(where_input_hi, grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
-        # clip_lo is the lower bound; making it larger will make the output larger
-        # if input was clipped. the gradient propagation is thus identical for
-        # lower and upper bounds!
-        grad_lower  = torch.where(where_input_lo, grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
+        region, clip_gradient, clip_lo = ctx.saved_tensors
+        grad_input, grad_lower, grad_upper = _pact_quant_backward(grad_output, region, clip_gradient, clip_lo)
         return grad_input, None, grad_lower, grad_upper, None, None, None
 
-
-
+def _pact_quant_backward(grad_output, region, clip_gradient, clip_lo):
+    # see Hubara et al., Section 2.3
+    zero = torch.zeros(1).to(region.device)
+    if clip_gradient:
+        grad_input = torch.where(region == _REGION_NONCLIPPED, grad_output, zero)
+    else:
+        grad_input = grad_output
+    reduce_dims = tuple(range(len(grad_output.shape)))
+    if len(clip_lo.shape) > 1:
+        # this works only for weights due to activations' batch dimensions,
+        # but we don't support per-channel quantization of activations so
+        # it's OK
+        reduce_dims = reduce_dims[1:]
+
+    grad_upper = torch.where(region == _REGION_HI, grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
+    # clip_lo is the lower bound; making it larger will make the output larger
+    # if input was clipped. the gradient propagation is thus identical for
+    # lower and upper bounds!
+    grad_lower  = torch.where(region == _REGION_LO, grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
+    return grad_input, grad_lower, grad_upper
 
 
 # a wrapper for PACTQuantFunc to allow kwargs
@@ -162,6 +195,9 @@ class TQTQuantFunc(torch.autograd.Function):
     :param floor:    If True, perform flooring on to get integer representation. if False, perform rounding.
     :param clip_gradient: if True, zero-out gradients outside of the clipping range.
     :type  clip_gradient: bool
+    :param lean: if True, save only the input for backpropagation and recompute the clipping masks and the quantization
+                 error from it in the backward pass. Use this when the input is kept alive anyway (e.g., weights).
+    :type  lean: bool
 
     :return: The quantized tensor.
     :rtype:  `torch.Tensor`
@@ -169,69 +205,109 @@ class TQTQuantFunc(torch.autograd.Function):
     """
 
     @staticmethod
-    def forward(ctx, input, eps, log_t, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt, rounding):
-        where_input_nonclipped = torch.mul((input >= clip_lo), (input < clip_hi))
-        where_input_lo = (input < clip_lo)
-        where_input_hi = (input >= clip_hi)
-
-        # for completeness' sake (e.g. to reproduce the results from the
-        # PACT+SAWB paper), we allow for outputs which are not a multiple of
-        # eps.
-        # to ensure hardware compatibility, it is the downstream user's
-        # responsibility to ensure that clip_lo/clip_hi are multiples of eps!
-        input_unrounded_int = (input.clamp(clip_lo, clip_hi) - clip_lo)/ eps
-
-        # for weights, we want to use rounding - for activations, we will round
-        # in hardware so represent this here too
-        if rounding:
-            input_rounded_int = input_unrounded_int.round()
+    def forward(ctx, input, eps, log_t, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt, rounding, lean=False):
+        input_quant = _tqt_fake_quant(input, eps, clip_lo, clip_hi, rounding)
+        ctx.lean = lean
+        if lean:
+            # don't store anything of the input's size - the clipping regions
+            # and the quantization error are recomputed from the input in the
+            # backward pass. eps goes through save_for_backward like the
+            # other tensors so in-place modifications are caught by autograd.
+            if not isinstance(eps, torch.Tensor):
+                eps = torch.as_tensor(eps, dtype=input.dtype, device=input.device)
+            ctx.rounding = rounding
+            ctx.save_for_backward(input, eps, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt)
         else:
-            input_rounded_int = input_unrounded_int.floor()
-        input_quant = input_rounded_int * eps + clip_lo
-        quant_error = input_quant - input
-        ctx.save_for_backward(where_input_nonclipped, where_input_lo, where_input_hi, clip_lo, clip_hi, quant_error, beta, running_grad_var, running_beta, clip_grad_logt)
+            region = _clip_region(input, clip_lo, clip_hi)
+            quant_error = input_quant - input
+            ctx.save_for_backward(region, clip_lo, clip_hi, quant_error, beta, running_grad_var, running_beta, clip_grad_logt)
         return input_quant
 
     @staticmethod
     def backward(ctx, grad_output):
-        # see Hubara et al., Section 2.3
-        where_input_nonclipped, where_input_lo, where_input_hi, clip_lo, clip_hi, quant_error, beta, running_grad_var, running_beta, clip_grad_logt = ctx.saved_variables
-        zero = torch.zeros(1).to(where_input_nonclipped.device)
-        grad_input = torch.where(where_input_nonclipped, grad_output, zero)
-
-        reduce_dims = tuple(range(len(grad_output.shape)))
-        if len(clip_lo.shape) > 1:
-            # this works only for weights due to activations' batch dimensions,
-            # but we don't support per-channel quantization of activations so
-            # it's OK
-            reduce_dims = reduce_dims[1:]
-        ln2 = torch.log(torch.tensor(2.).to(clip_lo.device))
-
-        # clipped high
-        grad_logt =  clip_hi * torch.where(where_input_hi, grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
-        # clipped low
-        grad_logt = grad_logt + clip_lo * torch.where(where_input_lo, grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
-        # unclipped
-        grad_logt  = grad_logt + torch.where(where_input_nonclipped, quant_error * grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
-        # scale by log2
-        grad_logt = grad_logt * ln2
-        # normalize and bias-correct (see appendix B in paper) the gradient
-        grad_var = beta * running_grad_var + (1-beta) * grad_logt**2
-        #running_grad_var.copy_(grad_var.reshape(running_grad_var.shape))
-        # we have to hack these with .data in order to bamboozle the
-        # autograd version checker!
-        running_grad_var.data.copy_(grad_var.reshape(running_grad_var.shape))
-        running_beta.data.mul_(beta)
-        grad_var /= (1 - running_beta)
-        grad_logt /= (torch.sqrt(grad_var) + 1e-5)
-        if clip_grad_logt:
-            grad_logt = torch.tanh(grad_logt)
-
-        return grad_input, None, grad_logt, None, None, None, None, None, None, None
+        if ctx.lean:
+            input, eps, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt = ctx.saved_tensors
+            region = _clip_region(input, clip_lo, clip_hi)
+            quant_error = _tqt_fake_quant(input, eps, clip_lo, clip_hi, ctx.rounding) - input
+        else:
+            region, clip_lo, clip_hi, quant_error, beta, running_grad_var, running_beta, clip_grad_logt = ctx.saved_tensors
+        grad_input, grad_logt = _tqt_quant_backward(grad_output, region, quant_error, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt)
+        return grad_input, None, grad_logt, None, None, None, None, None, None, None, None
+
+def _tqt_quant_backward(grad_output, region, quant_error, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt):
+    # see Hubara et al., Section 2.3
+    where_input_nonclipped = (region == _REGION_NONCLIPPED)
+    zero = torch.zeros(1).to(region.device)
+    grad_input = torch.where(where_input_nonclipped, grad_output, zero)
+
+    reduce_dims = tuple(range(len(grad_output.shape)))
+    if len(clip_lo.shape) > 1:
+        # this works only for weights due to activations' batch dimensions,
+        # but we don't support per-channel quantization of activations so
+        # it's OK
+        reduce_dims = reduce_dims[1:]
+    ln2 = torch.log(torch.tensor(2.).to(clip_lo.device))
+
+    # clipped high
+    grad_logt =  clip_hi * torch.where(region == _REGION_HI, grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
+    # clipped low
+    grad_logt = grad_logt + clip_lo * torch.where(region == _REGION_LO, grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
+    # unclipped
+    grad_logt  = grad_logt + torch.where(where_input_nonclipped, quant_error * grad_output, zero).sum(dim=reduce_dims).reshape(clip_lo.shape)
+    # scale by log2
+    grad_logt = grad_logt * ln2
+    # normalize and bias-correct (see appendix B in paper) the gradient
+    grad_var = beta * running_grad_var + (1-beta) * grad_logt**2
+    #running_grad_var.copy_(grad_var.reshape(running_grad_var.shape))
+    # we have to hack these with .data in order to bamboozle the
+    # autograd version checker!
+    running_grad_var.data.copy_(grad_var.reshape(running_grad_var.shape))
+    running_beta.data.mul_(beta)
+    grad_var /= (1 - running_beta)
+    grad_logt /= (torch.sqrt(grad_var) + 1e-5)
+    if clip_grad_logt:
+        grad_logt = torch.tanh(grad_logt)
+    return grad_input, grad_logt
 
 #wrapper to allow kwargs
-def TQTQuantize(input, eps, log_t, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt, rounding=True):
-    return TQTQuantFunc.apply(input, eps, log_t, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt, rounding)
+def TQTQuantize(input, eps, log_t, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt, rounding=True, lean=False):
+    return TQTQuantFunc.apply(input, eps, log_t, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt, rounding, lean)
+
+class _PACTQuantReplayFunc(torch.autograd.Function):
+    r"""Attaches a tensor previously fake-quantized with :py:class:`PACTQuantFunc`
+    to the autograd graph without recomputing it. `input_q` and `region` must
+    have been computed from the same `input`, `clip_lo` and `clip_hi`; the
+    backward pass is then identical to the one of
+    :py:class:`PACTQuantFunc`. This is used to cache quantized weights.
+    """
+
+    @staticmethod
+    def forward(ctx, input, clip_lo, clip_hi, input_q, region, clip_gradient):
+        ctx.save_for_backward(region, clip_gradient, clip_lo)
+        return input_q.view_as(input_q)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        region, clip_gradient, clip_lo = ctx.saved_tensors
+        grad_input, grad_lower, grad_upper = _pact_quant_backward(grad_output, region, clip_gradient, clip_lo)
+        return grad_input, grad_lower, grad_upper, None, None, None
+
+class _TQTQuantReplayFunc(torch.autograd.Function):
+    r"""The equivalent of :py:class:`_PACTQuantReplayFunc` for
+    :py:class:`TQTQuantFunc`.
+    """
+
+    @staticmethod
+    def forward(ctx, input, log_t, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt, input_q, region):
+        ctx.save_for_backward(input, input_q, region, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt)
+        return input_q.view_as(input_q)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, input_q, region, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt = ctx.saved_tensors
+        quant_error = input_q - input
+        grad_input, grad_logt = _tqt_quant_backward(grad_output, region, quant_error, clip_lo, clip_hi, beta, running_grad_var, running_beta, clip_grad_logt)
+        return grad_input, grad_logt, None, None, None, None, None, None, None, None
 
 class AlmostSymmQuantFunc(torch.autograd.Function):
     r"""Helper functional which returns an upper clipping bound which is
@@ -39,7 +39,9 @@ from quantlib.algorithms.generic import CausalConv1d
 from quantlib.QTensor import QTensor
 
 from .pact_functions import (AlmostSymmQuantFunc, PACTQuantFunc, PACTQuantize,
-                             TQTQuantize)
+                             TQTQuantize, _clip_region, _PACTQuantReplayFunc,
+                             _TQTQuantReplayFunc)
+from .observers import HistogramObserver, QuantileSketch
 from .util import almost_symm_quant, assert_param_valid, mse_bounds
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -85,6 +87,7 @@ __all__ = [
     'PACTHardsigmoid',
     'PACTIntegerHardswish',
     'PACTIntegerHardsigmoid',
+    'PACTIntegerLUT',
     'PACTMean',
     'PACTIntegerMean',
     'PACTDiv',
@@ -144,7 +147,7 @@ class RequantShift(nn.Module):
             output = g.op("PACTOps::RequantShift", x, mul, add, div_t=div, signed_t=signed, n_levels_out_t=n_levels_out)
             return output
 
-    def __init__(self, mul : torch.Tensor, add : torch.Tensor, n_levels : int, signed : bool = False, D : torch.Tensor = torch.Tensor((2**16,)), cmsis_requant=False, requant_node=True):
+    def __init__(self, mul : torch.Tensor, add : torch.Tensor, n_levels : int, signed : bool = False, D : torch.Tensor = torch.Tensor((2**16,)), cmsis_requant=False, requant_node=True, shift_path : bool = False):
         super(RequantShift, self).__init__()
         self.register_buffer('mul', mul.clone().detach())
         self.register_buffer('add', add.clone().detach())
@@ -159,9 +162,107 @@ class RequantShift(nn.Module):
         # requant_node specifies whether we want to export a "RequantShift"
         # node in the ONNX graph or explicit mul/add/div operations
         self.requant_node = requant_node
+        # shift_path specifies whether to requantize (integer-valued) inputs
+        # with integer multiply-add-shift operations if D is a power of 2.
+        # The result is the exact result of the requantization; it is
+        # identical to the floating point path as long as that is exact,
+        # i.e., |x*mul+add| < 2**24 for float32 and < 2**53 for float64.
+        # Inputs which are not integer-valued take the floating point path.
+        self.shift_path = shift_path
+        # broadcast-ready parameters, derived on the first forward pass
+        self._fwd_cache = None
+
+    def _apply(self, fn, *args, **kwargs):
+        # the cached parameters must be re-derived after the buffers have been
+        # moved or cast
+        self._fwd_cache = None
+        return super(RequantShift, self)._apply(fn, *args, **kwargs)
+
+    def _forward_params(self, x : torch.Tensor):
+        # the cache is keyed by the input's properties, the buffers'
+        # identities and version counters and the output configuration, so
+        # in-place modifications of mul and add (e.g., by load_state_dict) and
+        # changes to n_levels_out, signed and cmsis_requant are picked up
+        key = (x.dim(), x.dtype, x.device,
+               self.mul.data_ptr(), self.mul._version,
+               self.add.data_ptr(), self.add._version,
+               self.div.data_ptr(), self.div._version,
+               tuple(self.n_levels_out.reshape(-1).tolist()), bool(self.signed), bool(self.cmsis_requant))
+        cache = getattr(self, '_fwd_cache', None)
+        if cache is not None and cache['key'] == key:
+            return cache
+
+        mul = self.mul
+        add = self.add
+        if len(self.mul.shape) == 1:
+            mul = self.mul.reshape([-1]+[1]*(len(x.shape)-2))
+        if len(self.add.shape) == 1:
+            add = self.add.reshape([-1]+[1]*(len(x.shape)-2))
+        mul = mul.type_as(x)
+        add = add.type_as(x)
+        div = self.div.type_as(x)
+        cache = {'key' : key,
+                 'mul' : mul,
+                 'add' : add,
+                 'div' : div,
+                 'n_levels_out' : self.n_levels_out.type_as(x),
+                 'identity' : torch.equal(mul, div) and torch.equal(add, torch.zeros((1,), dtype=x.dtype, device=x.device)),
+                 'shift' : None}
+
+        # parameters of the integer path: D must be a power of 2 and the
+        # (effective) multiplier and offset must be integers
+        def is_int(t):
+            return bool(torch.isfinite(t).all() and torch.equal(t, torch.floor(t)))
+        d = self.div.double()
+        if d.numel() == 1 and is_int(d) and d.item() >= 1 and int(d.item()) & (int(d.item()) - 1) == 0:
+            # the floating point path computes the CMSIS offset in x's dtype
+            eff_add = torch.floor((add/mul) + 0.5) if self.cmsis_requant else add
+            if is_int(mul) and is_int(eff_add):
+                n_levels = self.n_levels_out.item()
+                if self.signed:
+                    c = round(n_levels/2. + 0.001)
+                    lo, hi = -c, c-1
+                else:
+                    lo, hi = 0, int(n_levels)-1
+                cache.update({'shift' : int(d.item()).bit_length()-1,
+                              'mul_int' : mul.long(),
+                              'add_int' : eff_add.long(),
+                              'lo' : lo,
+                              'hi' : hi})
+        self._fwd_cache = cache
+        return cache
+
+    def shift_forward(self, x : torch.Tensor, p : dict):
+        # integer requantization: (x * mul + add + D/2) >> log2(D), clipped.
+        # x must be integer-valued - it is truncated to int64
+        xi = x.long()
+        if self.cmsis_requant:
+            y = (xi + p['add_int']) * p['mul_int']
+        else:
+            y = xi * p['mul_int'] + p['add_int']
+        if p['shift'] > 0:
+            y = (y + 2**(p['shift']-1)) >> p['shift']
+        return torch.clamp(y, p['lo'], p['hi']).to(x.dtype)
 
     def forward(self, x):
 
+        if torch.onnx.is_in_onnx_export() or torch.jit.is_tracing():
+            # don't bake the cached parameters into exported graphs
+            return self.export_forward(x)
+
+        p = self._forward_params(x)
+        if p['identity']:
+            return x
+        if getattr(self, 'shift_path', False) and p['shift'] is not None and not x.requires_grad and torch.equal(x, torch.floor(x)):
+            return self.shift_forward(x, p)
+        if self.requant_node:
+            return self.MyRequantShift.apply(x, p['mul'], p['add'], p['div'], self.signed, p['n_levels_out'], self.cmsis_requant)
+        else:
+            # calling `forward` directly does not trigger the symbolic export
+            return self.MyRequantShift.forward(None, x, p['mul'], p['add'], p['div'], self.signed, self.n_levels_out, self.cmsis_requant)
+
+    def export_forward(self, x):
+
         mul = self.mul
         add = self.add
 
@@ -310,19 +411,21 @@ class _PACTActivation(nn.Module):
                  signed : bool = True,
                  upper_percentile : float = 99.5,
                  lower_percentile : float = 0.5,
-                 num_bins : int = 2**12, # SCHEREMO: Stay below or at 2**12 -
-                 # everything else is super slow
+                 num_bins : int = 2**12,
                  ema : bool = True, # use exponential moving average to track statistics?
                  # note: std/mean and MSE bounds always calculated as EMA!
                  # EMA not supported for 'percentile'
                  ema_beta : float = 0.9,
-                 mse_iters : int = 90
+                 mse_iters : int = 90,
+                 sketch_size : int = 0,
+                 stats_every : int = 1,
+                 stats_subsample : int = 0
                  ):
 
         r"""Constructor.
 
         :param n_levels: currently targeted quantization level (default 256).
-        :param init_clip: how the controller should initialize clipping bounds. Can be 'max', 'std', 'const', 'klj, 'percentile' or 'mse'.
+        :param init_clip: how the controller should initialize clipping bounds. Can be 'max', 'std', 'const', 'klj, 'percentile', 'mse' or 'mse_hist'. 'mse_hist' searches the MSE-optimal bounds on a histogram of all observed activations once quantization is started instead of running the search on every batch.
         :param learn_clip: default `True`; if `False`, do not update the value of the clipping factor(s) with backpropagation.
         :param act_kind: Activation function to use in unquantized mode - can be 'identity', 'relu', 'relu6', 'leaky_relu' or 'htanh'
         :param leaky:     leakiness parameter for leaky ReLU activation; unused if act_kind is not 'leaky_relu'
@@ -336,16 +439,19 @@ class _PACTActivation(nn.Module):
         :param signed:    True if this is a signed activation.
         :param upper_percentile: At which percentile of all observed activations to set the upper clipping bound on quantization activation when using init_clip='percentile'
         :param lower_percentile: At which percentile of all observed activations to set the lower clipping bound on quantization activation when using init_clip='percentile'
-        :param num_bins:  How many bins to use for the histogram used to calculate the percentile values when using init_clip='percentile'
+        :param num_bins:  How many bins to use for the histogram used to calculate the percentile values when using init_clip='percentile', 'klj' or 'mse_hist'
         :param ema:       Whether or not to use exponential moving average to calculate min/max statistics. If `True`` use EMA with weight `ema_beta`. Only used for `init_clip='max'`; `init_clip='std'/'mse'` always uses EMA to update mean/standard deviation or the MSE-optimal min/max bounds, respectively.
         :param ema_beta:  Weight for EMA calculation. An EMA value :math `x` is updated with a new value :math `x_{new}` as :math `x\gets\text{ema_beta} * x + (1-\text{ema_beta})x_{new}`. Not used if `init_clip` is not `'max'` or `'std'`.
         :param mse_iters: How many iterations to search for the MSE-optimal clipping bounds. In each iteration, clipping bounds are set to the observed maximum/minimum values minus :math `i\%`; so `mse_iters=90` will search clipping bounds from :math `10\%` to :math `100\%` of the observed maximum/minimum values and choose the clipping bounds that result in the smallest L2 distance between the quantized and unquantized outputs.
+        :param sketch_size: If > 0, additionally track a quantile sketch with `sketch_size` centroids and use it instead of the histogram to determine the percentile clipping bounds. Recommended for very high/low percentiles.
+        :param stats_every: Only gather statistics in every `stats_every`-th forward pass before quantization is started.
+        :param stats_subsample: If > 0, gather statistics on at most `stats_subsample` randomly sampled elements of the activation tensor. Note that this affects the observed extreme values, i.e., `init_clip='max'`.
         """
         super(_PACTActivation, self).__init__()
         act_kind = act_kind.lower()
         init_clip = init_clip.lower()
         assert_param_valid(self, act_kind, 'act_kind', ['identity', 'relu', 'relu6', 'leaky_relu', 'htanh'])
-        assert_param_valid(self, init_clip, 'init_clip', ['max', 'std', 'const', 'klj', 'percentile', 'mse'])
+        assert_param_valid(self, init_clip, 'init_clip', ['max', 'std', 'const', 'klj', 'percentile', 'mse', 'mse_hist'])
 
         self.upper_percentile = upper_percentile/100
         self.lower_percentile = lower_percentile/100
@@ -403,64 +509,63 @@ class _PACTActivation(nn.Module):
 
         self.stats_initialized = False
         self.mse_iters = mse_iters
+        assert stats_every >= 1, f"{self.__class__.__name__}: stats_every must be >= 1, got {stats_every}"
+        self.stats_every = stats_every
+        self.stats_subsample = stats_subsample
+        self.stats_step = 0
 
         self.register_buffer('clip_gradient', torch.tensor(True))
 
-        if init_clip == "percentile":
+        if init_clip in ["percentile", "klj", "mse_hist"]:
             self.num_bins = num_bins
-            self.register_buffer("histogram",torch.zeros_like(torch.Tensor(range(self.num_bins))))
+            self.observer = HistogramObserver(num_bins, signed)
+            self.sketch = QuantileSketch(sketch_size) if sketch_size > 0 else None
             self.register_buffer("prevEdges",torch.zeros_like(torch.Tensor(range(self.num_bins+1))))
-            self.truemax          = torch.nn.Parameter(torch.Tensor((1,)), requires_grad=False)
-            min_init = -1. if self.signed else 0.
-            self.truemin          = torch.nn.Parameter(torch.Tensor((min_init,)), requires_grad=False)
             self.register_buffer('ready', torch.tensor(False))
+            self._register_load_state_dict_pre_hook(self.make_observer_state_dict_compat)
 
-    # SCHEREMO: Assume self.histogram magnitude list of data, binned
-    def updateHistogram(self, stat):
-        if self.init_clip != "percentile":
-            return
+    def make_observer_state_dict_compat(self, state_dict, prefix, *args, **kwargs):
+        # the histogram statistics used to be stored directly in the
+        # activation module
+        for k in ["histogram", "truemax", "truemin"]:
+            if prefix+k in state_dict.keys():
+                state_dict[prefix+"observer."+k] = state_dict.pop(prefix+k)
 
-        def rebinInt(histogram, factor):
-            factor = min(self.num_bins//2, factor)
-            weight = torch.Tensor([1]*factor).reshape(1,1,-1).type_as(histogram)
-            newHistogram = torch.zeros_like(torch.Tensor(range(self.num_bins))).type_as(histogram)
-            # Downsample histogram
-            res = torch.nn.functional.conv1d(histogram.reshape(1,1,-1), weight, bias=None, stride=factor, padding=0)
-            # Set new downsampled histogram in the middle
-            if self.signed:
-                newHistogram[(self.num_bins//2 - self.num_bins//(2*factor)):(self.num_bins//2 + self.num_bins//(2*factor))] = res.reshape(-1)
-            else:
-                newHistogram[:res.numel()] = res.reshape(-1)
-            return newHistogram
+    # the histogram statistics are exposed directly for the controllers
+    @property
+    def histogram(self):
+        return self.observer.histogram
 
-        with torch.no_grad():
-            # SCHEREMO: get min and max
-            newTruemax = max(self.truemax.item(), stat.max())
-            newTruemin = min(self.truemin.item(), stat.min())
-
-            # SCHEREMO: only rescale exponentially - allows us to rebin very fast and easy
-            binTop = max(abs(self.truemin), self.truemax)
-            newBinTop = max(abs(newTruemin), newTruemax)
-            expFact = int(max(2**torch.ceil(torch.log2(newBinTop / binTop)),1))
-            expTop =  expFact * binTop
-
-            # SCHEREMO: Calculate new histogram according to new range
-            new_min_hist = -expTop.item() if self.signed else 0.
-            addHistogram = torch.histc(input=stat, min=new_min_hist, max=expTop.item(), bins=self.num_bins)
-            resampledHistogram = rebinInt(self.histogram, expFact)
-
-            # SCHEREMO: Add histograms, preserve information about edges
-            self.histogram[:] = resampledHistogram + addHistogram
-            self.truemax[:] = expTop
-            self.truemin[:] = -expTop if self.signed else 0.
+    @property
+    def truemax(self):
+        return self.observer.truemax
+
+    @property
+    def truemin(self):
+        return self.observer.truemin
+
+    def subsample_stats(self, stat):
+        if self.stats_subsample <= 0 or stat.numel() <= self.stats_subsample:
+            return stat
+        stat = stat.flatten()
+        return stat[torch.randint(stat.numel(), (self.stats_subsample,), device=stat.device)]
+
+    def updateHistogram(self, stat):
+        if self.init_clip not in ["percentile", "klj", "mse_hist"]:
+            return
+        self.observer.update(stat)
+        if self.sketch is not None:
+            self.sketch.update(stat)
 
     # SCHEREMO: Calculate clipping bounds
     def updateClipBounds(self):
-        self.prevEdges[:] = torch.linspace(self.truemin[0], self.truemax[0], self.num_bins+1)
+        self.prevEdges[:] = self.observer.edges()
+        if self.sketch is not None:
+            self.min[:] = self.sketch.quantile(self.lower_percentile)
+            self.max[:] = self.sketch.quantile(self.upper_percentile)
+            return
         pdf = self.histogram / (torch.sum(self.histogram))
-        weight = torch.Tensor([1]*len(self.histogram.reshape(-1))).reshape(1,1,-1).type_as(self.histogram)
-        cdf = torch.nn.functional.conv1d(pdf.reshape(1,1,-1), weight, bias=None, stride=1, padding=(len(self.histogram)-1)).reshape(-1)
-        cdf = cdf[:len(self.histogram)]
+        cdf = torch.cumsum(pdf, dim=0)
         rightMinIdx = torch.sum((cdf<self.lower_percentile))
         rightMaxIdx = torch.sum((cdf<self.upper_percentile))
         leftMinIdx = torch.clip(rightMinIdx-1, min=0.).int()
@@ -490,19 +595,27 @@ class _PACTActivation(nn.Module):
                 res = torch.nn.functional.hardtanh(x)
 
             x_stat = torch.tensor(res, device=self.max.device, dtype=self.max.dtype) if not isinstance(res, torch.Tensor) else res
-            self.updateHistogram(x_stat)
+            observe = self.stats_step % self.stats_every == 0
+            self.stats_step += 1
+            if observe:
+                x_stat = self.subsample_stats(x_stat)
+                self.updateHistogram(x_stat)
 
             if self.init_clip == 'percentile' and self.ready:
                 res = torch.clip(res, min=self.min, max=self.max)
-            else:
+            elif observe:
+                # all statistics are updated in-place on the device so that
+                # no host synchronization is needed - they are only read by
+                # the controller when the clipping bounds are initialized
                 with torch.no_grad():
+                    x_stat = x_stat.detach()
                     if self.init_clip != 'mse':
                         if self.ema and self.stats_initialized:
-                            self.min[:] = self.ema_beta*self.min.item() + (1-self.ema_beta) * x_stat.min()
-                            self.max[:] = self.ema_beta*self.max.item() + (1-self.ema_beta) * x_stat.max()
+                            self.min.mul_(self.ema_beta).add_((1-self.ema_beta) * x_stat.min())
+                            self.max.mul_(self.ema_beta).add_((1-self.ema_beta) * x_stat.max())
                         else:
-                            self.min[:] = min(self.min.item(), x_stat.min())
-                            self.max[:] = max(self.max.item(), x_stat.max())
+                            self.min.copy_(torch.minimum(self.min, x_stat.min()))
+                            self.max.copy_(torch.maximum(self.max, x_stat.max()))
                             self.stats_initialized = True
                     else:
                         mse_min, mse_max = mse_bounds(x_stat, self.n_levels, self.signed, False, False, self.mse_iters, self.symm, self.rounding)
@@ -515,8 +628,8 @@ class _PACTActivation(nn.Module):
 
                         self.min[:] = new_min
                         self.max[:] = new_max
-                    self.running_mean[:] = self.ema_beta * self.running_mean.item() + (1-self.ema_beta) * x_stat.mean()
-                    self.running_var[:]  = self.ema_beta * self.running_var.item()  + (1-self.ema_beta) * x_stat.std()*x_stat.std()
+                    self.running_mean.mul_(self.ema_beta).add_((1-self.ema_beta) * x_stat.mean())
+                    self.running_var.mul_(self.ema_beta).add_((1-self.ema_beta) * x_stat.var())
 
             return res
         else:
@@ -882,6 +995,10 @@ class _PACTLinOp:
         # this member indicates that parameters (weight + bias) of the layer
         # are frozen
         self.register_buffer('params_frozen', torch.tensor(False))
+        # the quantized weights are cached and only recomputed when the
+        # weights or the clipping parameters change - see weight_q
+        self.cache_weight_q = True
+        self._weight_q_cache = None
 
     def get_eps_w(self):
         """
@@ -906,25 +1023,80 @@ class _PACTLinOp:
         r += self.pact_repr_str
         return r
 
+    def get_clip_upper(self):
+        if not self.tqt and self.learn_clip and self.symm_wts:
+            return AlmostSymmQuantFunc.apply(self.clip_lo, self.n_levels)
+        return self.clip_hi
+
+    def quantize_weight(self, wt):
+        if not self.tqt:
+            return PACTQuantize(wt, self.get_eps_w(), self.clip_lo, self.get_clip_upper(), floor=False, clip_gradient=self.clip_gradient)
+        else:
+            # the weights are kept around anyway, so there is no need to store
+            # the quantization error for the backward pass
+            return TQTQuantize(wt, self.get_eps_w(), self.log_t, self.clip_lo, self.clip_hi, self.tqt_beta, self.tqt_running_grad_var, self.tqt_running_beta, self.tqt_clip_grad, rounding=True, lean=True)
+
+    def weight_q_cache_key(self, wt):
+        # the cached quantized weights stay valid as long as none of the
+        # tensors they are computed from is replaced or modified in-place
+        # (which increments its version counter). The key holds the tensors
+        # themselves, as data pointers are reused by the allocator; their
+        # data pointers and shapes catch most `.data = ...` reassignments.
+        # In-place modifications through `.data` (e.g.,
+        # `clip_hi.data.copy_(...)`) are not tracked - call
+        # invalidate_weight_q_cache() after doing that!
+        tensors = (wt, self.clip_lo, self.clip_hi, self.clip_gradient)
+        if self.tqt:
+            tensors += (self.log_t,)
+        return (tensors, tuple((t._version, t.data_ptr(), tuple(t.shape)) for t in tensors), (self.n_levels, self.learn_clip, self.symm_wts, self.tqt))
+
+    def _weight_q_cache_valid(self, key):
+        if self._weight_q_cache is None:
+            return False
+        cached = self._weight_q_cache['key']
+        return len(cached[0]) == len(key[0]) and all(a is b for a, b in zip(cached[0], key[0])) and cached[1:] == key[1:]
+
+    def invalidate_weight_q_cache(self):
+        self._weight_q_cache = None
+
     @property
     def weight_q(self):
         if self.params_frozen:
             wt = self.weight_frozen
         else:
             wt = self.weight
+        if not self.cache_weight_q:
+            return self.quantize_weight(wt)
+
+        key = self.weight_q_cache_key(wt)
+        if not self._weight_q_cache_valid(key):
+            with torch.no_grad():
+                clip_upper = self.get_clip_upper()
+                self._weight_q_cache = {'key' : key,
+                                        'weight_q' : self.quantize_weight(wt),
+                                        'region' : _clip_region(wt, self.clip_lo, clip_upper),
+                                        'weight_int' : None}
+        cache = self._weight_q_cache
+        if not torch.is_grad_enabled():
+            return cache['weight_q']
+        # re-attach the cached weights to the autograd graph - this creates a
+        # new node for every forward pass so e.g. the micro-batches of a
+        # gradient accumulation step can share the same quantized weights.
         if not self.tqt:
-            if self.learn_clip and self.symm_wts:
-                clip_upper = AlmostSymmQuantFunc.apply(self.clip_lo, self.n_levels)
-            else:
-                clip_upper = self.clip_hi
-
-            return PACTQuantize(wt, self.get_eps_w(), self.clip_lo, clip_upper, floor=False, clip_gradient=self.clip_gradient)
+            return _PACTQuantReplayFunc.apply(wt, self.clip_lo, self.get_clip_upper(), cache['weight_q'], cache['region'], self.clip_gradient)
         else:
-            return TQTQuantize(wt, self.get_eps_w(), self.log_t, self.clip_lo, self.clip_hi, self.tqt_beta, self.tqt_running_grad_var, self.tqt_running_beta, self.tqt_clip_grad, rounding=True)
+            return _TQTQuantReplayFunc.apply(wt, self.log_t, self.clip_lo, self.clip_hi, self.tqt_beta, self.tqt_running_grad_var, self.tqt_running_beta, self.tqt_clip_grad, cache['weight_q'], cache['region'])
 
     @property
     def weight_int(self):
-        return (self.weight_q / self.get_eps_w()).detach().clone().round()
+        if not self.cache_weight_q:
+            return (self.weight_q / self.get_eps_w()).detach().clone().round()
+        with torch.no_grad():
+            wq = self.weight_q
+        cache = self._weight_q_cache
+        if cache['weight_int'] is None:
+            cache['weight_int'] = (wq / self.get_eps_w()).round()
+        return cache['weight_int'].clone()
 
     # not nice: inheriting classes must set up weight_frozen/bias_frozen in
     # their constructors!!!
@@ -1447,7 +1619,7 @@ class PACTIntegerHardswish(nn.Module):
         self.register_buffer("one_over_six", one_over_six_q)
 
     def forward(self, x):
-        z = torch.zeros.type_as(x)
+        z = torch.zeros(1).type_as(x)
         inp = x
         x = x + self.three
         x = torch.clip(x, z, self.six)
@@ -1501,12 +1673,51 @@ class PACTIntegerHardsigmoid(nn.Module):
 
 
     def forward(self, x):
-        z = torch.zeros.type_as(x)
+        z = torch.zeros(1).type_as(x)
         inp = x
         x = x + self.three
         x = torch.clip(x, z, self.six)
         return x * self.one_over_six
 
+class PACTIntegerLUT(nn.Module):
+    # elementwise lookup table for integer-valued inputs in the domain
+    # [offset, offset + len(lut) - 1]: y = lut[x - offset]. Inputs outside of
+    # the domain are clamped to it. clips_output specifies whether the
+    # outputs are guaranteed to lie in the range given by n_levels_out and
+    # signed_out (e.g., if the table ends with a RequantShift).
+
+    class MyLUT(torch.autograd.Function):
+
+        @staticmethod
+        def forward(ctx, x, lut, offset):
+            idx = torch.clip(x - offset, 0, lut.numel() - 1).long()
+            return lut[idx]
+
+        @staticmethod
+        @parse_args('v', 't', 'i')
+        def symbolic(g, x, lut, offset):
+            return g.op("PACTOps::LUT", x, lut_t=lut, offset_i=offset)
+
+    def __init__(self, lut : torch.Tensor, offset : int, eps_out : Optional[torch.Tensor] = None, n_levels_out : Optional[int] = None, signed_out : Optional[bool] = None, clips_output : bool = False, export_node : bool = False):
+        super(PACTIntegerLUT, self).__init__()
+        self.register_buffer('lut', lut.clone().detach().reshape(-1))
+        self.offset = int(offset)
+        # quantization of the output, used for epsilon propagation
+        self.eps_out = eps_out
+        self.n_levels_out = n_levels_out
+        self.signed_out = signed_out
+        self.clips_output = clips_output and n_levels_out is not None and signed_out is not None
+        self.export_node = export_node
+
+    def extra_repr(self):
+        return f"entries={self.lut.numel()}, offset={self.offset}"
+
+    def forward(self, x):
+        if self.export_node:
+            return self.MyLUT.apply(x, self.lut.type_as(x), self.offset)
+        else:
+            return self.MyLUT.forward(None, x, self.lut.type_as(x), self.offset)
+
 class PACTEmbedding(torch.nn.Module):
 
     def __init__(self, n_levels:int = 256, weights : torch.Tensor = torch.Tensor((1.,)), **kwargs):
@@ -1773,7 +1984,7 @@ class PACTIntegerSoftmax(torch.nn.Module):
 
             return g.op("PACTOps::iSoftmax", x, log2_t=log2, coeffA_t=coeffA, coeffB_t=coeffB,  coeffC_t=coeffC, n_levels_t=n_levels)
 
-    def __init__(self, n_levels: int = 256, eps_in: float = 1./255, export_node=False):
+    def __init__(self, n_levels: int = 256, eps_in: float = 1./255, export_node=False, int_kernel : bool = False):
         super().__init__()
 
         self.eps_in = eps_in
@@ -1784,8 +1995,15 @@ class PACTIntegerSoftmax(torch.nn.Module):
         self.log2 = torch.Tensor((1.,))
         self.zero = torch.Tensor((0.,))
 
+        # table of the exponentials for each value of max(x)-x, derived on
+        # the first forward pass with int_kernel
+        self._exp_lut = None
         self.updateCoeffs(eps_in)
         self.export_node = export_node
+        # int_kernel specifies whether to evaluate the softmax of
+        # integer-valued inputs with an exponential lookup table and integer
+        # normalization. The result is identical to MySoftmax.forward.
+        self.int_kernel = int_kernel
 
     def updateCoeffs(self, eps):
         """Updates the coefficients, usually only done with the IntegerizeSoftmax pass
@@ -1805,6 +2023,83 @@ class PACTIntegerSoftmax(torch.nn.Module):
         #self.log2.data[0] = 2**torch.round(torch.Tensor((math.log2(math.log2(2)/(eps)),)))
         #self.log2.data[0] = torch.round(torch.Tensor((math.log2(2)/(eps)),))
         self.log2.data[0] = torch.round(math.log2(2)/(eps))
+        self._exp_lut = None
+
+    def exp_lut(self, x : torch.Tensor):
+        """Returns the table of MySoftmax's (unnormalized) exponentials for
+        each value d = max(x)-x, computed with the same floating point
+        operations as MySoftmax.forward. Beyond the end of the table, all
+        exponentials are 0.
+
+        :param x: Input tensor; determines dtype and device of the table
+        :returns: The table or None if the coefficients don't allow one
+        :rtype: Optional[torch.Tensor]
+
+        """
+        coeffs = [self.log2, self.coeffA, self.coeffB, self.coeffC]
+        key = (x.dtype, x.device) + tuple(c.item() for c in coeffs)
+        cache = getattr(self, '_exp_lut', None)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        log2, A, B, C = key[2:]
+        lut = None
+        # the exponentials vanish once 2**z exceeds the largest possible
+        # numerator A*(p+B)**2+C, p in [-log2, 0]; this requires a positive
+        # numerator
+        if log2 >= 1 and A >= 0 and C > 0 and all(float(c).is_integer() for c in key[2:]):
+            num_max = A * max(B**2, (B-log2)**2) + C
+            length = (int(num_max).bit_length() + 2) * int(log2) + 1
+            if length <= 2**20:
+                d = -torch.arange(length, dtype=x.dtype, device=x.device)
+                log2_, A_, B_, C_ = (c.type_as(x).to(x.device) for c in coeffs)
+                z = torch.floor(-d / log2_)
+                p = d + z * log2_
+                lut = torch.floor(((A_*(p + B_)**2 + C_)) // (2**z))
+                if lut[-1] != 0:
+                    lut = None
+        self._exp_lut = (key, lut)
+        return lut
+
+    def int_forward(self, x : torch.Tensor):
+        """Integer implementation of MySoftmax.forward for integer-valued
+        inputs: the exponentials are looked up in `exp_lut` and normalized
+        with a fixed-point reciprocal of each row's sum.
+
+        :param x: Integer-valued input
+        :returns: The softmax or None if the result could differ from
+                  MySoftmax.forward
+        :rtype: Optional[torch.Tensor]
+
+        """
+        if not x.is_floating_point() or x.numel() == 0 or not torch.equal(x, torch.floor(x)):
+            return None
+        lut = self.exp_lut(x)
+        if lut is None:
+            return None
+        # floating point arithmetic is exact as long as all integers are
+        # smaller than 2**(mantissa bits + 1)
+        exact = 2**(torch.finfo(x.dtype).nmant + 1)
+        n_levels = int(self.n_levels.item())
+        d = torch.max(x, dim=-1, keepdim=True)[0] - x
+        if float(d.max()) >= exact:
+            return None
+        y = lut[torch.clamp(d, max=lut.numel()-1).long()]
+        # the row sums are computed just like in MySoftmax.forward
+        y_sum = torch.sum(y, -1, keepdim=True)
+        a_max = int(lut.max()) * (n_levels-1)
+        if a_max >= exact//2 or a_max.bit_length() > 31 or float(y_sum.max()) >= exact:
+            return None
+        # with a = y*(n_levels-1) < 2**mant_bits, floor(a/y_sum) equals the
+        # floor of the correctly rounded quotient. It is computed as
+        # (a * floor(2**k / y_sum)) >> k with k >= log2(a), which is too small
+        # by at most 1
+        a = y.long() * (n_levels-1)
+        b = y_sum.long()
+        k = 62 - a_max.bit_length()
+        q = (a * torch.div(torch.full_like(b, 2**k), b, rounding_mode='floor')) >> k
+        q = q + ((q + 1) * b <= a).long()
+        return torch.clip(q.type_as(x), self.zero.type_as(x), self.n_levels.type_as(x)-1)
 
     def forward(self, x):
         """Approximate Softmax implementation according to the I-BERT paper:
@@ -1817,8 +2112,11 @@ class PACTIntegerSoftmax(torch.nn.Module):
         """
         if self.export_node:
             return self.MySoftmax.apply(x, self.log2.type_as(x), self.coeffA.type_as(x), self.coeffB.type_as(x), self.coeffC.type_as(x), self.n_levels.type_as(x), self.zero.type_as(x))
-        else:
-            return self.MySoftmax.forward(None, x, self.log2.type_as(x), self.coeffA.type_as(x), self.coeffB.type_as(x), self.coeffC.type_as(x), self.n_levels.type_as(x), self.zero.type_as(x))
+        if getattr(self, 'int_kernel', False) and not x.requires_grad and not (torch.onnx.is_in_onnx_export() or torch.jit.is_tracing()):
+            out = self.int_forward(x)
+            if out is not None:
+                return out
+        return self.MySoftmax.forward(None, x, self.log2.type_as(x), self.coeffA.type_as(x), self.coeffB.type_as(x), self.coeffC.type_as(x), self.n_levels.type_as(x), self.zero.type_as(x))
 
 class PACTITAMax(_PACTEps):
     def __init__(self,  n_levels: int = 256, **kwargs):
@@ -2084,56 +2382,47 @@ class PACTIntegerITAPartialMax(torch.nn.Module):
             eps_max = B / (2**B)
 
             _, H, S, _ = x.size()
-
-            # Initialize denominator
-            exp_partial_sum = torch.zeros_like(x)[...,0].type(torch.int32)
-
-            # Initialize maximum with minimal possible value
-            global_max = torch.full_like(x, -127)[...,0].type(torch.int8)
+            rnd_eps = torch.finfo(x.dtype).eps
 
             ## STAGE 1: Compute the denominator of the softmax
-            for i in range(groups):
-                # Find the maximum for each row in the current column block (consisting of 16 columns)
-                current_max = torch.max(x[...,0 + i * group_width:group_width + i * group_width].type(torch.int32), dim = -1)[0]
-
-                # Initialize all shift values for each row to zero
-                shift_sum = torch.zeros_like(x)[...,0].type(torch.int32)
+            # View the rows as blocks of group_width columns: [..., groups, group_width]
+            x_blocks = x[..., :groups * group_width].type(torch.int32).unflatten(-1, (groups, group_width))
 
-                # Calculate the number of shifts required to updated the already accumulated sum
-                # Make sure to do use round-half-up instead of round-half-to-even
-                max_shift = torch.floor((current_max - global_max) * eps_max + 0.5 + torch.finfo(x.dtype).eps)
+            # Maximum of each row in each column block
+            current_max = torch.max(x_blocks, dim=-1)[0]
 
-                # Update all shift values where new maximum is larger
-                shift_sum = torch.where(current_max > global_max, max_shift, shift_sum)
+            # Running maximum after each block; the maximum is initialized with
+            # the minimal possible value -127
+            global_max = torch.cummax(torch.clamp(current_max, min=-127), dim=-1)[0]
+            prev_max = torch.cat([torch.full_like(global_max[..., :1], -127), global_max[..., :-1]], dim=-1)
 
-                # Updated all maximums where they changed
-                global_max = torch.where(current_max > global_max, current_max, global_max)
-
-                # Find the difference between the maximum and x in the current part of the row
-                diff = torch.repeat_interleave(global_max, group_width).reshape(
-                -1, H, S, group_width) - x[...,0 + i * group_width:group_width + i * group_width].type(torch.int32)
+            # Number of shifts required to update the already accumulated sum in each block
+            # Make sure to do use round-half-up instead of round-half-to-even
+            max_shift = torch.floor((current_max - prev_max) * eps_max + 0.5 + rnd_eps)
+            shift_sum = torch.where(current_max > prev_max, max_shift, torch.zeros_like(max_shift))
 
-                # Shift the values by B-log2B -> multiply by B/2**B = eps_max = log2e * eps_in
-                shift = torch.floor(diff * eps_max + 0.5 + torch.finfo(x.dtype).eps).type(torch.int32)
+            # Shift the values by B-log2B -> multiply by B/2**B = eps_max = log2e * eps_in
+            shift = torch.floor((global_max.unsqueeze(-1) - x_blocks) * eps_max + 0.5 + rnd_eps).type(torch.int32)
 
-                # Calculate exponential sum over the current part of the row
-                exp_sum = torch.floor(torch.sum(n_levels / 2**shift, dim = -1))
+            # Exponential sum over each block
+            exp_sum = torch.floor(torch.sum(n_levels / 2**shift, dim = -1))
 
-                # Update the accumulated sum and add the accumulation over the current part of the row
-                exp_partial_sum = torch.floor(exp_partial_sum / 2**shift_sum) + exp_sum
+            # Accumulate the block sums: acc_i = floor(acc_{i-1} / 2**shift_sum_i) + exp_sum_i
+            exp_partial_sum = PACTIntegerITAPartialMax._accumulate(exp_sum, shift_sum).type_as(exp_sum)
+            global_max = global_max[..., -1]
 
             ## STAGE 2: Calculate the softmax activation
             # Invert the partial sum
             exp_partial_sum_inverse = torch.floor(n_levels * (n_levels-1) / exp_partial_sum).type(torch.int32)
 
             # Find the difference between the maximum and x
-            diff = torch.repeat_interleave(global_max, S).reshape(-1, H, S, S) - x.type(torch.int32)
+            diff = global_max.unsqueeze(-1) - x.type(torch.int32)
 
             # Shift the values by B-log2B -> multiply by B/2**B = log2e*eps_x
-            shift = torch.floor(diff * eps_max + 0.5 + torch.finfo(x.dtype).eps).type(torch.int32)
+            shift = torch.floor(diff * eps_max + 0.5 + rnd_eps).type(torch.int32)
 
             # Calculate the activation value
-            ret = torch.floor(torch.repeat_interleave(exp_partial_sum_inverse, S).reshape(-1, H, S, S) / 2**shift).type_as(x)
+            ret = torch.floor(exp_partial_sum_inverse.unsqueeze(-1) / 2**shift).type_as(x)
             return ret
 
         @staticmethod
@@ -2144,6 +2433,26 @@ class PACTIntegerITAPartialMax(torch.nn.Module):
 
             return g.op("PACTOps::ITAPartialMax", x, n_levels_t=n_levels, groups_i=groups, group_width_i=group_width)
 
+    @staticmethod
+    def _accumulate(exp_sum: torch.Tensor, shift_sum: torch.Tensor):
+        # Evaluates the recurrence acc_i = floor(acc_{i-1} / 2**s_i) + e_i
+        # (acc_0 = 0) over the last dimension without a loop. All operands are
+        # non-negative integers, so the nested floors collapse into
+        #   acc_G = floor(sum_i e_i * 2**T_i / 2**T_G),  T_i = s_1 + ... + s_i
+        # which is computed exactly in int64.
+        e = exp_sum.type(torch.int64)
+        t = torch.cumsum(shift_sum.type(torch.int64), dim=-1)
+        t_max = int(t[..., -1].max()) if t.numel() else 0
+        e_max = int(e.max()) if e.numel() else 0
+        if t_max + e_max.bit_length() + e.shape[-1].bit_length() < 63:
+            return torch.sum(e << t, dim=-1) >> t[..., -1]
+        # the scaled sum would overflow int64 - fall back to a scan over the
+        # (per-row) block sums
+        acc = torch.zeros_like(e[..., 0])
+        for i in range(e.shape[-1]):
+            acc = (acc >> shift_sum[..., i].type(torch.int64)) + e[..., i]
+        return acc
+
     def __init__(self, max_value, n_levels: int = 256, processing_uints: int = 16, ita_sequence_length: int = 64, eps_in: float = 1./255, D=2**12, export_node=False, **kwargs):
         super().__init__()
 
@@ -0,0 +1,182 @@
+#
+# pact_stats_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Tests for the statistics PACT activations gather before quantization is
+# started.
+
+import unittest
+from unittest import TestCase
+
+import torch
+
+from quantlib.algorithms.pact.observers import HistogramObserver, QuantileSketch
+from quantlib.algorithms.pact.pact_ops import PACTUnsignedAct, PACTAsymmetricAct
+
+
+def _update_histogram_loop(histogram, truemax, truemin, stat, signed : bool):
+    # reference: _PACTActivation.updateHistogram before the statistics were
+    # moved to the HistogramObserver
+    num_bins = histogram.numel()
+
+    def rebinInt(histogram, factor):
+        factor = min(num_bins//2, factor)
+        weight = torch.Tensor([1]*factor).reshape(1,1,-1).type_as(histogram)
+        newHistogram = torch.zeros(num_bins).type_as(histogram)
+        res = torch.nn.functional.conv1d(histogram.reshape(1,1,-1), weight, bias=None, stride=factor, padding=0)
+        if signed:
+            newHistogram[(num_bins//2 - num_bins//(2*factor)):(num_bins//2 + num_bins//(2*factor))] = res.reshape(-1)
+        else:
+            newHistogram[:res.numel()] = res.reshape(-1)
+        return newHistogram
+
+    newTruemax = max(truemax.item(), stat.max())
+    newTruemin = min(truemin.item(), stat.min())
+    binTop = max(abs(truemin), truemax)
+    newBinTop = max(abs(newTruemin), newTruemax)
+    expFact = int(max(2**torch.ceil(torch.log2(newBinTop / binTop)),1))
+    expTop =  expFact * binTop
+    new_min_hist = -expTop.item() if signed else 0.
+    addHistogram = torch.histc(input=stat, min=new_min_hist, max=expTop.item(), bins=num_bins)
+    histogram = rebinInt(histogram, expFact) + addHistogram
+    truemin = -expTop if signed else torch.zeros_like(expTop)
+    return histogram, expTop.clone(), truemin
+
+
+class TestHistogramObserver(TestCase):
+
+    def test_matches_loop(self):
+        torch.manual_seed(0)
+        for signed in [True, False]:
+            obs = HistogramObserver(256, signed)
+            hist, truemax, truemin = torch.zeros(256), torch.Tensor((1.,)), torch.Tensor((-1. if signed else 0.,))
+            # the range grows by different powers of 2 (including 1)
+            for scale in [0.5, 3., 5., 60., 10.]:
+                x = torch.randn(32, 64) * scale
+                if not signed:
+                    x = x.abs()
+                obs.update(x)
+                hist, truemax, truemin = _update_histogram_loop(hist, truemax, truemin, x.flatten(), signed)
+                self.assertTrue(torch.equal(obs.truemax, truemax))
+                self.assertTrue(torch.equal(obs.truemin, truemin))
+                self.assertTrue(torch.equal(obs.histogram, hist), f"histograms differ for signed={signed}, scale={scale}")
+
+    def test_state_dict_compat(self):
+        # checkpoints from before the observer was introduced store the
+        # histogram statistics in the activation itself
+        torch.manual_seed(1)
+        act = PACTAsymmetricAct(n_levels=256, init_clip='percentile', learn_clip=False, act_kind='identity')
+        act(torch.randn(16, 32) * 4)
+        old_sd = {(k[len('observer.'):] if k.startswith('observer.') else k) : v for k, v in act.state_dict().items()}
+        self.assertIn('histogram', old_sd.keys())
+
+        new_act = PACTAsymmetricAct(n_levels=256, init_clip='percentile', learn_clip=False, act_kind='identity')
+        new_act.load_state_dict(old_sd)
+        for k in ['histogram', 'truemax', 'truemin']:
+            self.assertTrue(torch.equal(getattr(new_act, k), getattr(act, k)))
+
+
+class TestQuantileSketch(TestCase):
+
+    def test_quantiles(self):
+        torch.manual_seed(2)
+        sketch = QuantileSketch(512)
+        xs = [torch.randn(4096) for _ in range(16)]
+        for x in xs:
+            sketch.update(x)
+        x = torch.cat(xs)
+        for q in [0.001, 0.01, 0.5, 0.99, 0.999]:
+            ref = torch.quantile(x, q)
+            self.assertLess(abs(sketch.quantile(q).item() - ref.item()), 0.05, f"quantile {q}")
+
+    def test_reset(self):
+        sketch = QuantileSketch(64)
+        sketch.update(torch.randn(1000))
+        sketch.reset()
+        sketch.update(torch.Tensor((3., 3., 3.)))
+        self.assertEqual(sketch.quantile(0.5).item(), 3.)
+
+
+_STATS = ['min', 'max', 'running_mean', 'running_var']
+
+def _stats_act(**kwargs):
+    return PACTAsymmetricAct(n_levels=256, init_clip='max', learn_clip=False, act_kind='identity', **kwargs)
+
+class TestActivationStatistics(TestCase):
+
+    def assertStatsEqual(self, a, b):
+        for k in _STATS:
+            self.assertTrue(torch.equal(getattr(a, k), getattr(b, k)), f"{k}: {getattr(a, k)} != {getattr(b, k)}")
+
+    def test_matches_host_updates(self):
+        # reference: the .item()-based updates used before the statistics
+        # were kept on the device
+        torch.manual_seed(3)
+        act = _stats_act()
+        mn, mx, mean, var = 0., 0., 0., 1.
+        initialized = False
+        beta = act.ema_beta
+        for _ in range(5):
+            x = torch.randn(8, 32) * 2 + 0.5
+            act(x)
+            if initialized:
+                mn = beta * mn + (1-beta) * x.min().item()
+                mx = beta * mx + (1-beta) * x.max().item()
+            else:
+                mn = min(mn, x.min().item())
+                mx = max(mx, x.max().item())
+                initialized = True
+            mean = beta * mean + (1-beta) * x.mean().item()
+            var = beta * var + (1-beta) * (x.std()*x.std()).item()
+        for k, v in zip(_STATS, [mn, mx, mean, var]):
+            self.assertAlmostEqual(getattr(act, k).item(), v, places=5, msg=k)
+
+    def test_stats_every(self):
+        # with stats_every=3, only the 1st, 4th, 7th... batch is observed
+        torch.manual_seed(4)
+        xs = [torch.randn(8, 32) * (i+1) for i in range(7)]
+        act = _stats_act(stats_every=3)
+        ref = _stats_act()
+        for i, x in enumerate(xs):
+            act(x)
+            if i % 3 == 0:
+                ref(x)
+        self.assertStatsEqual(act, ref)
+
+    def test_stats_subsample(self):
+        torch.manual_seed(5)
+        x = torch.randn(16, 128)
+        act = _stats_act(stats_subsample=100)
+        ref = _stats_act()
+        torch.manual_seed(6)
+        act(x)
+        torch.manual_seed(6)
+        ref(x.flatten()[torch.randint(x.numel(), (100,))])
+        self.assertStatsEqual(act, ref)
+        # tensors with at most stats_subsample elements are observed entirely
+        small = _stats_act(stats_subsample=x.numel())
+        full = _stats_act()
+        small(x)
+        full(x)
+        self.assertStatsEqual(small, full)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+#
+# pact_util_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# The batched clipping bound searches are tested against the sequential
+# loops they replaced.
+
+import unittest
+from unittest import TestCase
+
+import torch
+
+from quantlib.algorithms.pact.pact_functions import PACTQuantize
+from quantlib.algorithms.pact.util import almost_symm_quant, mse_bounds, mse_bounds_histogram, klj_clip_max
+from quantlib.algorithms.pact.observers import HistogramObserver
+from quantlib.algorithms.pact.pact_ops import PACTAsymmetricAct
+from quantlib.algorithms.pact.pact_controllers import PACTActController
+
+
+def _mse_bounds_loop(x, n_levels : int, signed : bool, channelwise : bool, x_is_weights : bool, n_iters : int = 80, symm : bool = True, rounding : bool = True):
+    # reference: the sequential search mse_bounds used before it was
+    # vectorized
+    if channelwise and not x_is_weights:
+        x = x.permute(1, 0, 2, 3)
+    reduce_dims = tuple(range(len(x.shape)))
+    if channelwise:
+        reduce_dims = reduce_dims[1:]
+
+    act_max = x.amax(dim=reduce_dims, keepdim=True)
+    if signed:
+        act_min = x.amin(dim=reduce_dims, keepdim=True)
+    else:
+        act_min = torch.zeros_like(act_max)
+
+    best_min, best_max = act_min, act_max
+    best_dist = 1000000
+
+    for i in range(n_iters):
+        cur_min = act_min * (1 - i * 0.01)
+        cur_max = act_max * (1 - i * 0.01)
+        if symm and signed:
+            abs_max = torch.maximum(-cur_min, cur_max)
+            cur_min, cur_max = almost_symm_quant(abs_max, n_levels)
+        with torch.no_grad():
+            eps = (cur_max - cur_min)/(n_levels-1)
+            x_quant = PACTQuantize(x, eps, cur_min, cur_max, floor=(not rounding), clip_gradient=False, noisy=False)
+            cur_dist = (x-x_quant).pow(2).mean()
+            if cur_dist < best_dist:
+                best_dist = cur_dist
+                best_min = cur_min
+                best_max = cur_max
+
+    return best_min.squeeze(), best_max.squeeze()
+
+
+class TestMSEBounds(TestCase):
+
+    def assertBoundsEqual(self, a, b):
+        self.assertTrue(torch.equal(a[0], b[0]) and torch.equal(a[1], b[1]), f"{a} != {b}")
+
+    def test_matches_loop(self):
+        torch.manual_seed(0)
+        x = torch.randn(4, 8, 6, 6) * 3
+        for signed in [True, False]:
+            for symm in [True, False]:
+                for rounding in [True, False]:
+                    xs = x if signed else x.abs()
+                    ref = _mse_bounds_loop(xs, 16, signed, False, False, 40, symm, rounding)
+                    self.assertBoundsEqual(mse_bounds(xs, 16, signed, False, False, 40, symm, rounding), ref)
+
+    def test_channelwise_weights(self):
+        torch.manual_seed(1)
+        w = torch.randn(8, 4, 3, 3)
+        ref = _mse_bounds_loop(w, 16, True, True, True, 80)
+        self.assertBoundsEqual(mse_bounds(w, 16, True, True, True, 80), ref)
+
+    def test_chunks(self):
+        # splitting the candidates into chunks must not change the result
+        torch.manual_seed(2)
+        x = torch.randn(2, 4, 8, 8)
+        ref = mse_bounds(x, 256, True, False, False, 80)
+        for n_cand in [1, 3, 7]:
+            self.assertBoundsEqual(mse_bounds(x, 256, True, False, False, 80, max_chunk_numel=n_cand*x.numel()), ref)
+
+
+def _klj_clip_max_loop(histogram, edges, truemax, n_levels : int):
+    # reference: the per-bin loop of the 'klj' initialization in
+    # PACTActController before it was batched
+    def resample(histogram, prevEdges, n_levels, max):
+        leftIdx = torch.sum(torch.where(prevEdges < -max, 1, 0))
+        rightIdx = torch.sum(torch.where(prevEdges < max, 1, 0))
+        newHist = torch.zeros_like(histogram)
+        oldHist = histogram[leftIdx:rightIdx]
+        innerSamples = torch.nn.functional.interpolate(oldHist.reshape(1,1,-1),size=n_levels,mode='linear').reshape(-1)
+        innerSamples[0] = innerSamples[0] + torch.sum(histogram[:leftIdx])
+        innerSamples[-1] = innerSamples[-1] + torch.sum(histogram[rightIdx:])
+        innerSamples = torch.nn.functional.interpolate(innerSamples.reshape(1,1,-1),size=int(rightIdx-leftIdx),mode='linear').reshape(-1)
+        newHist[leftIdx:rightIdx] = innerSamples
+        return newHist
+
+    num_bins = histogram.numel()
+    hist = histogram/torch.sum(histogram)
+    binCenters = (edges[:-1] + edges[1:])/2
+    abs_scale = truemax / num_bins
+
+    best = 0
+    minLoss = 1
+    maxHat = truemax.clone()
+    for i in range(num_bins-1):
+        newHist = resample(hist, edges, n_levels, maxHat)
+        absLoss = torch.sum((torch.abs(hist-newHist) * torch.abs(binCenters))**2)
+        maxHat = maxHat - abs_scale
+        if absLoss < minLoss:
+            best = i
+            minLoss = absLoss.item()
+    return truemax - abs_scale*best
+
+
+class TestKLJClipMax(TestCase):
+
+    def test_matches_loop(self):
+        torch.manual_seed(3)
+        for num_bins, n_levels in [(64, 16), (256, 16), (256, 256)]:
+            for dtype in [torch.float32, torch.float64]:
+                x = torch.randn(2**14).to(dtype)
+                truemax = x.abs().max().reshape(1)
+                histogram = torch.histc(x, bins=num_bins, min=-truemax.item(), max=truemax.item())
+                edges = torch.linspace(-truemax.item(), truemax.item(), num_bins+1).to(dtype)
+                ref = _klj_clip_max_loop(histogram, edges, truemax, n_levels)
+                self.assertTrue(torch.equal(klj_clip_max(histogram, edges, truemax, n_levels), ref), f"mismatch for {num_bins} bins, {n_levels} levels, {dtype}")
+
+    def test_chunks(self):
+        torch.manual_seed(4)
+        x = torch.randn(2**12)
+        truemax = x.abs().max().reshape(1)
+        histogram = torch.histc(x, bins=128, min=-truemax.item(), max=truemax.item())
+        edges = torch.linspace(-truemax.item(), truemax.item(), 129)
+        ref = klj_clip_max(histogram, edges, truemax, 16)
+        self.assertTrue(torch.equal(klj_clip_max(histogram, edges, truemax, 16, max_chunk_numel=5*128), ref))
+
+
+def _mse_bounds_histogram_loop(histogram, edges, n_levels : int, signed : bool, n_iters : int = 80, symm : bool = True, rounding : bool = True):
+    # reference: the sequential MSE search of mse_bounds, run on the bin
+    # centers weighted by the bin counts
+    centers = (edges[:-1] + edges[1:])/2
+    nonempty = [i for i in range(histogram.numel()) if histogram[i] > 0]
+    act_max = edges[nonempty[-1]+1].reshape(1)
+    act_min = edges[nonempty[0]].reshape(1) if signed else torch.zeros(1)
+
+    best_min, best_max = act_min, act_max
+    best_dist = float('inf')
+    for i in range(n_iters):
+        cur_min = act_min * (1 - i * 0.01)
+        cur_max = act_max * (1 - i * 0.01)
+        if symm and signed:
+            abs_max = torch.maximum(-cur_min, cur_max)
+            cur_min, cur_max = almost_symm_quant(abs_max, n_levels)
+        eps = (cur_max - cur_min)/(n_levels-1)
+        centers_quant = PACTQuantize(centers, eps, cur_min, cur_max, floor=(not rounding), clip_gradient=False, noisy=False)
+        cur_dist = ((centers - centers_quant).pow(2) * histogram).sum() / histogram.sum()
+        if cur_dist < best_dist:
+            best_dist = cur_dist
+            best_min = cur_min
+            best_max = cur_max
+    return best_min, best_max
+
+
+class TestMSEBoundsHistogram(TestCase):
+
+    def test_matches_loop(self):
+        torch.manual_seed(7)
+        for signed in [True, False]:
+            for symm in [True, False]:
+                obs = HistogramObserver(512, signed)
+                x = torch.randn(64, 256) * 2
+                obs.update(x if signed else x.abs())
+                ref = _mse_bounds_histogram_loop(obs.histogram, obs.edges(), 16, signed, 80, symm)
+                res = mse_bounds_histogram(obs.histogram, obs.edges(), 16, signed, 80, symm)
+                self.assertTrue(torch.equal(res[0], ref[0]) and torch.equal(res[1], ref[1]), f"{res} != {ref} for signed={signed}, symm={symm}")
+
+    def test_close_to_mse_bounds(self):
+        # with fine enough bins, the histogram search should find roughly the
+        # same bounds as the search on the raw values
+        torch.manual_seed(8)
+        x = torch.randn(64, 256)
+        obs = HistogramObserver(2**12, True)
+        obs.update(x)
+        lo, hi = mse_bounds_histogram(obs.histogram, obs.edges(), 16, True, 80, False)
+        ref_lo, ref_hi = mse_bounds(x, 16, True, False, False, 80, symm=False)
+        self.assertLess(abs(hi.item() - ref_hi.item()), 0.1 * ref_hi.item())
+        self.assertLess(abs(lo.item() - ref_lo.item()), 0.1 * abs(ref_lo.item()))
+
+    def test_controller(self):
+        torch.manual_seed(9)
+        act = PACTAsymmetricAct(n_levels=16, init_clip='mse_hist', learn_clip=False, act_kind='identity', symm=False, mse_iters=80)
+        for _ in range(4):
+            act(torch.randn(8, 128) * 3)
+        lo, hi = mse_bounds_histogram(act.histogram, act.observer.edges(), 16, True, 80, False, act.rounding)
+        PACTActController([act], {0 : 'start'}).step_pre_training_epoch(0)
+        self.assertTrue(torch.equal(act.clip_hi.data, hi.reshape_as(act.clip_hi)))
+        self.assertTrue(torch.equal(act.clip_lo.data, lo.reshape_as(act.clip_lo)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,9 +19,11 @@
 # limitations under the License.
 # 
 
+import math
+
 from torch import nn
 import torch
-from .pact_functions import PACTQuantize
+from .pact_functions import PACTQuantize, _pact_fake_quant
 
 def assert_param_valid(module : nn.Module, value, param_name : str, valid_values : list):
     error_str = f"[{module.__class__.__name__}]  Invalid argument {param_name}: Got {value}, expected {valid_values[0] if len(valid_values)==1 else ', '.join(valid_values[:-1]) + ' or ' + str(valid_values[-1])}"
@@ -41,36 +43,219 @@ def almost_symm_quant(max_val, n_levels):
     return min_val, max_val
 
 
+def _mse_best_candidate(x, act_min, act_max, ratios, idxs, n_levels, signed, symm, rounding, max_chunk_numel):
+    # evaluates the candidate clipping bounds act_min/act_max * ratios[idxs]
+    # in chunks of batched tensor operations and returns the distance, index
+    # and bounds of the best one without synchronizing with the host.
+    chunk = max(1, max_chunk_numel // max(1, x.numel()))
+    best = None
+    for start in range(0, idxs.numel(), chunk):
+        cur_idxs = idxs[start:start+chunk]
+        r = ratios.index_select(0, cur_idxs).reshape((-1,) + (1,) * x.dim())
+        cur_min = act_min * r
+        cur_max = act_max * r
+        if symm and signed:
+            abs_max = torch.maximum(-cur_min, cur_max)
+            cur_min, cur_max = almost_symm_quant(abs_max, n_levels)
+        eps = (cur_max - cur_min)/(n_levels-1)
+        x_quant = _pact_fake_quant(x.unsqueeze(0), eps, cur_min, cur_max, floor=(not rounding))
+        dist = (x - x_quant).pow(2).flatten(1).mean(dim=1)
+        # a NaN distance is never better than the current best
+        dist = torch.nan_to_num(dist, nan=float('inf'))
+        # argmin returns the first minimum, just like the sequential search.
+        # index_select avoids the host sync of indexing with a tensor
+        i = torch.argmin(dist).reshape(1)
+        cand = tuple(t.index_select(0, i)[0] for t in (dist, cur_idxs, cur_min, cur_max))
+        if best is None:
+            best = cand
+        else:
+            better = cand[0] < best[0]
+            best = tuple(torch.where(better, c, b) for c, b in zip(cand, best))
+    return best
+
+
 # implemented like in MQBench: https://github.com/ModelTC/MQBench/blob/main/mqbench/observer.py
-def mse_bounds(x, n_levels : int, signed : bool, channelwise : bool, x_is_weights : bool, n_iters : int = 80, symm : bool = True, rounding : bool = True):
-    if channelwise and not x_is_weights:
-        x = x.permute(1, 0, 2, 3)
-    reduce_dims = tuple(range(len(x.shape)))
-    if channelwise:
-        reduce_dims = reduce_dims[1:]
-
-    act_max = x.amax(dim=reduce_dims, keepdim=True)
-    if signed:
-        act_min = x.amin(dim=reduce_dims, keepdim=True)
-    else:
-        act_min = torch.zeros_like(act_max)
+def mse_bounds(x, n_levels : int, signed : bool, channelwise : bool, x_is_weights : bool, n_iters : int = 80, symm : bool = True, rounding : bool = True, search : str = 'exhaustive', max_chunk_numel : int = 2**24):
+    r"""Search for the clipping bounds minimizing the mean squared quantization
+    error of `x`. The candidates are the observed minimum/maximum values
+    scaled by :math:`1, 0.99, ..., 1-(n_{iters}-1)/100`. They are evaluated in
+    batched tensor operations and the best one is selected on the device.
+
+    :param search: 'exhaustive' evaluates all `n_iters` candidates. 'coarse_to_fine' evaluates every
+                   :math:`\sqrt{n_{iters}}`-th candidate and then all candidates around the best of them, which
+                   is faster but only exact if the error is unimodal in the clipping ratio.
+    :param max_chunk_numel: Upper bound on the number of elements processed at once; `x` is quantized with
+                   `max_chunk_numel // x.numel()` candidate bounds in parallel.
+    """
+    assert search in ['exhaustive', 'coarse_to_fine'], f"mse_bounds: Invalid search method {search}, expected 'exhaustive' or 'coarse_to_fine'"
+    with torch.no_grad():
+        if channelwise and not x_is_weights:
+            x = x.permute(1, 0, 2, 3)
+        reduce_dims = tuple(range(len(x.shape)))
+        if channelwise:
+            reduce_dims = reduce_dims[1:]
+
+        act_max = x.amax(dim=reduce_dims, keepdim=True)
+        if signed:
+            act_min = x.amin(dim=reduce_dims, keepdim=True)
+        else:
+            act_min = torch.zeros_like(act_max)
+
+        if n_iters < 1:
+            return act_min.squeeze(), act_max.squeeze()
+
+        ratios = torch.tensor([1 - i * 0.01 for i in range(n_iters)], dtype=x.dtype, device=x.device)
+        search_args = (x, act_min, act_max, ratios)
+        search_kwargs = dict(n_levels=n_levels, signed=signed, symm=symm, rounding=rounding, max_chunk_numel=max_chunk_numel)
+        if search == 'exhaustive':
+            idxs = torch.arange(n_iters, device=x.device)
+            best_dist, _, best_min, best_max = _mse_best_candidate(*search_args, idxs, **search_kwargs)
+        else:
+            stride = max(1, int(round(math.sqrt(n_iters))))
+            coarse_idxs = torch.arange(0, n_iters, stride, device=x.device)
+            _, best_idx, _, _ = _mse_best_candidate(*search_args, coarse_idxs, **search_kwargs)
+            fine_idxs = (best_idx + torch.arange(-stride+1, stride, device=x.device)).clamp(0, n_iters-1)
+            best_dist, _, best_min, best_max = _mse_best_candidate(*search_args, fine_idxs, **search_kwargs)
+
+        # like in the original sequential implementation, fall back to the
+        # observed bounds if no candidate's distance is below 1e6
+        found = best_dist < 1000000
+        best_min = torch.where(found, best_min, act_min)
+        best_max = torch.where(found, best_max, act_max)
+
+    return best_min.squeeze(), best_max.squeeze()
+
 
-    best_min, best_max = act_min, act_max
-    best_dist = 1000000
+def mse_bounds_histogram(histogram, edges, n_levels : int, signed : bool, n_iters : int = 80, symm : bool = True, rounding : bool = True):
+    r"""Search for the clipping bounds minimizing the mean squared quantization
+    error of a distribution given as a histogram, i.e., the histogram-based
+    equivalent of :func:`mse_bounds`. Every bin is represented by its center,
+    weighted by its count. The candidates are the bounds of the observed
+    (non-empty) histogram range scaled by :math:`1, 0.99, ...,
+    1-(n_{iters}-1)/100`, so the cost is :math:`O(n_{bins} n_{iters})`,
+    independent of how many values were observed.
 
-    for i in range(n_iters):
-        cur_min = act_min * (1 - i * 0.01)
-        cur_max = act_max * (1 - i * 0.01)
+    :param histogram: The histogram of observed values
+    :param edges: The `n_bins+1` bin edges of `histogram`
+    """
+    with torch.no_grad():
+        hist = histogram.flatten()
+        edges = edges.flatten().type_as(hist)
+        centers = (edges[:-1] + edges[1:])/2
+        nonempty = hist > 0
+        act_max = torch.amax(torch.where(nonempty, edges[1:], edges[:1])).reshape(1)
+        if signed:
+            act_min = torch.amin(torch.where(nonempty, edges[:-1], edges[-1:])).reshape(1)
+        else:
+            act_min = torch.zeros_like(act_max)
+
+        if n_iters < 1:
+            return act_min, act_max
+
+        ratios = torch.tensor([1 - i * 0.01 for i in range(n_iters)], dtype=hist.dtype, device=hist.device).reshape(-1, 1)
+        cur_min = act_min * ratios
+        cur_max = act_max * ratios
         if symm and signed:
             abs_max = torch.maximum(-cur_min, cur_max)
             cur_min, cur_max = almost_symm_quant(abs_max, n_levels)
-        with torch.no_grad():
-            eps = (cur_max - cur_min)/(n_levels-1)
-            x_quant = PACTQuantize(x, eps, cur_min, cur_max, floor=(not rounding), clip_gradient=False, noisy=False)
-            cur_dist = (x-x_quant).pow(2).mean()
-            if cur_dist < best_dist:
-                best_dist = cur_dist
-                best_min = cur_min
-                best_max = cur_max
+        eps = (cur_max - cur_min)/(n_levels-1)
+        centers_quant = _pact_fake_quant(centers.unsqueeze(0), eps, cur_min, cur_max, floor=(not rounding))
+        dist = ((centers - centers_quant).pow(2) * hist).sum(dim=1) / hist.sum()
+        dist = torch.nan_to_num(dist, nan=float('inf'))
+        i = torch.argmin(dist).reshape(1)
+        best_min = cur_min.index_select(0, i).reshape(1)
+        best_max = cur_max.index_select(0, i).reshape(1)
 
-    return best_min.squeeze(), best_max.squeeze()
+    return best_min, best_max
+
+
+def _resample_linear(src, offset, in_len, out_len, out_width):
+    # batched version of torch.nn.functional.interpolate(mode='linear',
+    # align_corners=False) using the same index/weight arithmetic: for every
+    # row c, src[c, offset[c]:offset[c]+in_len[c]] is resampled to out_len[c]
+    # samples. The result has out_width columns; entries at positions >=
+    # out_len[c] are meaningless and must be masked by the caller.
+    dtype = src.dtype
+    last = (in_len - 1).unsqueeze(1)
+    j = torch.arange(out_width, device=src.device).to(dtype)
+    scale = in_len.to(dtype) / out_len.to(dtype)
+    real_idx = torch.clamp(scale.unsqueeze(1) * (j + 0.5) - 0.5, min=0)
+    idx0 = torch.minimum(real_idx.floor().long(), last)
+    lambda1 = torch.clamp(real_idx - idx0.to(dtype), 0, 1)
+    lambda0 = 1 - lambda1
+    idx1 = idx0 + (idx0 < last).long()
+    idx0 = (idx0 + offset.unsqueeze(1)).clamp(max=src.shape[1]-1)
+    idx1 = (idx1 + offset.unsqueeze(1)).clamp(max=src.shape[1]-1)
+    return lambda0 * src.gather(1, idx0) + lambda1 * src.gather(1, idx1)
+
+def klj_clip_max(histogram, edges, truemax, n_levels : int, max_chunk_numel : int = 2**22):
+    r"""Find the upper clipping bound for the 'klj' initialization from a
+    histogram of observed activations. For every candidate threshold
+    :math:`t \in \{t_{max}, t_{max} - \Delta, ...\}` with
+    :math:`\Delta = t_{max}/n_{bins}`, the histogram mass inside
+    :math:`[-t, t)` is resampled to `n_levels` bins (with the clipped mass
+    folded into the outermost levels) and back, and the squared difference to
+    the original histogram weighted by the bin centers is used as the loss.
+
+    All candidates are scored in batched tensor operations; the mass and loss
+    outside of each candidate range are taken from prefix sums over the
+    histogram.
+
+    :param histogram: The histogram of observed values
+    :param edges: The `n_bins+1` bin edges of `histogram`
+    :param truemax: The upper end of the histogram range
+    :param n_levels: The number of quantization levels
+    :param max_chunk_numel: Upper bound on the number of elements processed at once
+    :return: The selected upper clipping bound
+    """
+    num_bins = histogram.numel()
+    hist = histogram / torch.sum(histogram)
+    centers = (edges[:-1] + edges[1:])/2
+    abs_scale = truemax / num_bins
+
+    # the candidate thresholds are generated by repeated subtraction rather
+    # than multiplication so the values (and the resulting histogram ranges)
+    # are bit-identical to those of the sequential search
+    cur_max = truemax.detach().cpu()
+    step = abs_scale.detach().cpu()
+    thresholds = []
+    for _ in range(num_bins-1):
+        thresholds.append(cur_max)
+        cur_max = cur_max - step
+    thresholds = torch.cat(thresholds).to(hist.device)
+
+    # number of edges below -t and t, respectively
+    left = torch.searchsorted(edges.contiguous(), -thresholds)
+    right = torch.searchsorted(edges.contiguous(), thresholds)
+
+    zero = torch.zeros(1, dtype=torch.float64, device=hist.device)
+    mass_cum = torch.cat((zero, torch.cumsum(hist.double(), 0)))
+    outer_loss_cum = torch.cat((zero, torch.cumsum(((torch.abs(hist) * torch.abs(centers))**2).double(), 0)))
+
+    bins = torch.arange(num_bins, device=hist.device)
+    chunk = max(1, max_chunk_numel // num_bins)
+    losses = []
+    for start in range(0, thresholds.numel(), chunk):
+        l = left[start:start+chunk]
+        r = right[start:start+chunk]
+        n_inner = r - l
+        n_out = torch.full_like(n_inner, n_levels)
+        inner = _resample_linear(hist.expand(l.numel(), -1), l, n_inner, n_out, n_levels)
+        inner[:, 0] += mass_cum[l].to(hist.dtype)
+        inner[:, -1] += (mass_cum[-1] - mass_cum[r]).to(hist.dtype)
+        resampled = _resample_linear(inner, torch.zeros_like(l), n_out, n_inner, num_bins)
+
+        in_range = bins.unsqueeze(0) < n_inner.unsqueeze(1)
+        bin_idx = (l.unsqueeze(1) + bins.unsqueeze(0)).clamp(max=num_bins-1)
+        inner_loss = (torch.abs(hist[bin_idx] - resampled) * torch.abs(centers[bin_idx]))**2
+        inner_loss = torch.where(in_range, inner_loss, torch.zeros_like(inner_loss)).sum(dim=1)
+        # outside of [-t, t), the resampled histogram is 0
+        outer_loss = outer_loss_cum[l] + (outer_loss_cum[-1] - outer_loss_cum[r])
+        losses.append(inner_loss + outer_loss.to(hist.dtype))
+
+    losses = torch.nan_to_num(torch.cat(losses), nan=float('inf'))
+    # like the sequential search, only accept losses below 1 and keep the
+    # first of several equal minima
+    best = torch.argmin(losses)
+    best = torch.where(losses.min() < 1, best, torch.zeros_like(best))
+    return truemax - abs_scale * best
@@ -19,7 +19,11 @@
 # limitations under the License.
 # 
 
-from . import twn_accelerator
-from . import abstract_net
-from . import cutie
-from . import dory
+from .._lazy import lazy_submodules
+
+# backends pull in heavy dependencies (ONNX, ONNXRuntime, torchvision, ...) -
+# they are only imported on first access
+_LAZY_SUBMODULES = ['twn_accelerator', 'abstract_net', 'cutie', 'dory', 'deeploy']
+
+__getattr__, __dir__ = lazy_submodules(globals(), _LAZY_SUBMODULES)
+
@@ -22,10 +22,11 @@
 
 from functools import partial
 from pathlib import Path
+from typing import Optional
 import numpy as np
 
 import torch
-from torch import nn
+from torch import nn, fx
 
 import onnx
 
@@ -81,6 +82,9 @@ NODES_MAPPING = {
     "iGELU": {
         "op_type": "Relu",
     },
+    "LUT": {
+        "op_type": "Relu",
+    },
     "IntegerDiv": {
         "op_type": "Div",
     },
@@ -145,7 +149,10 @@ def export_net(net: nn.Module,
                n_levels_in=256,
                D: float = 2**24,
                opset_version: int = 10,
-               code_size=0):
+               code_size=0,
+               integerize_cache: Optional[str] = None,
+               memory_plan: bool = False,
+               integer_engine: bool = False):
     net = net.eval()
 
     out_path = Path(out_dir)
@@ -154,22 +161,35 @@ def export_net(net: nn.Module,
     onnx_path = out_path.joinpath(onnx_file)
 
     if integerize:
-        net_traced = qlfx.passes.pact.PACT_symbolic_trace(net)
-
-        int_pass = qlfx.passes.pact.IntegerizePACTNetPass(
-            shape_in=in_data.shape,
-            eps_in=eps_in,
-            D=D,
-            n_levels_in=n_levels_in,
-            requant_node=True,
-            export_layernorm_node = True,
-            export_softmax_node = True,
-            export_gelu_node = True,
-            export_div_node = True)
-        net_integerized = int_pass(net_traced)
+        int_pass_kwargs = {
+            "shape_in": in_data.shape,
+            "eps_in": eps_in,
+            "D": D,
+            "n_levels_in": n_levels_in,
+            "requant_node": True,
+            "export_layernorm_node": True,
+            "export_softmax_node": True,
+            "export_gelu_node": True,
+            "export_div_node": True,
+        }
+        if integerize_cache is not None:
+            # reuse the integerized network from a previous export with
+            # identical network and settings, if available
+            cache = qlfx.passes.pact.IntegerizationCache(integerize_cache)
+            net_integerized = cache.integerize(net, **int_pass_kwargs)
+        else:
+            net_traced = qlfx.passes.pact.PACT_symbolic_trace(net)
+            int_pass = qlfx.passes.pact.IntegerizePACTNetPass(**int_pass_kwargs)
+            net_integerized = int_pass(net_traced)
     else:
         net_integerized = net
 
+    if memory_plan:
+        # static activation memory plan of the integerized network
+        qlfx.passes.ShapePropPass(in_data.shape, meta=True)(net_integerized)
+        plan_pass = qlfx.passes.ActivationMemoryPlanPass()
+        plan_pass(net_integerized).memory_plan.to_json(str(out_path.joinpath(f"{name}_memory_plan.json")), indent=2)
+
     # First export an ONNX graph without shape inference
     kwargs = {
         "input_names": ["input"],
@@ -289,8 +309,12 @@ def export_net(net: nn.Module,
     # Open the supplied input image
     if in_data is not None:
         input = in_data.clone().to(dtype=torch.float64)
-        net_integerized = net_integerized.to(dtype=torch.float64)
-        output = net_integerized(input).to(dtype=torch.float64)
+        if integer_engine and isinstance(net_integerized, fx.GraphModule):
+            # bit-identical to the float64 reference, but faster
+            output = qlfx.passes.pact.IntegerInterpreter(net_integerized).run(input)
+        else:
+            net_integerized = net_integerized.to(dtype=torch.float64)
+            output = net_integerized(input).to(dtype=torch.float64)
 
         input_np = torch.round(input.detach()).numpy().astype(np.int64)
         output_np = torch.round(output.detach()).numpy().astype(np.int64)
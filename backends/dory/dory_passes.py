@@ -9,8 +9,8 @@ from torch.nn.modules.utils import _single, _pair, _triple
 
 from quantlib.algorithms.pact import RequantShift
 from quantlib.editing.fx.passes import SequentialPass, ReplaceSequentialPatternPass, ShapePropPass
-from quantlib.editing.fx.util import get_ordered_active_nodes, module_of_node
-from quantlib.editing.fx.passes.pact import PACT_symbolic_trace, OpTree, OpTreeReplacementPass
+from quantlib.editing.fx.util import get_ordered_active_nodes, module_of_node, delete_submodule
+from quantlib.editing.fx.passes.pact import PACT_symbolic_trace, OpTree, OpTreeReplacementPass, register_integer_kernel
 
 
 class AvgPoolWrap(nn.Sequential):
@@ -178,6 +178,21 @@ class DORYAdder(nn.Module):
         return self.DORYAdderFun.apply(x1, self.in1_requant, x2, self.in2_requant, self.out_requant)
 
 
+def dory_adder_integer_kernel(engine, m : DORYAdder, x1, x2):
+    # integer execution of DORYAdder for the IntegerInterpreter - same
+    # sequence of operations as DORYAdderFun.forward
+    if m.in1_requant:
+        x1 = engine.call_kernel(m.in1_requant, (x1,))
+    if m.in2_requant:
+        x2 = engine.call_kernel(m.in2_requant, (x2,))
+    x_sum = engine.call_function(operator.add, (x1, x2), {})
+    if m.out_requant:
+        x_sum = engine.call_kernel(m.out_requant, (x_sum,))
+    return x_sum
+
+register_integer_kernel(DORYAdder, dory_adder_integer_kernel)
+
+
 class DORYReplaceAddersPass(OpTreeReplacementPass):
     add_node_specs = [('call_function', (torch.add, operator.add)),
                       ('call_method', ('add',))]
@@ -256,7 +271,7 @@ class DORYReplaceAddersPass(OpTreeReplacementPass):
             n.replace_all_uses_with(n.all_input_nodes[0])
             gm.graph.erase_node(n)
             if n.op == 'call_module':
-                gm.delete_submodule(n.target)
+                delete_submodule(gm, n.target)
             else:
                 print(f"Warning: Suspicious node {n} with op {n.op} is being deleted...")
 
@@ -274,10 +289,10 @@ class DORYReplaceAddersPass(OpTreeReplacementPass):
 
 
 class DORYHarmonizePass(SequentialPass):
-    def __init__(self, in_shape):
+    def __init__(self, in_shape, meta_shape_prop : bool = False):
         passes = []
         passes.append(DORYReplaceAddersPass())
-        passes.append(ShapePropPass(in_shape))
+        passes.append(ShapePropPass(in_shape, meta=meta_shape_prop))
         passes.append(AlignAvgPoolPass())
         passes.append(RemoveRedundantGlobalPoolingPass())
         super(DORYHarmonizePass, self).__init__(*passes)
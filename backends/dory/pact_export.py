@@ -22,6 +22,7 @@
 from functools import partial
 from itertools import chain 
 from pathlib import Path
+from typing import Optional
 import json
 
 
@@ -116,7 +117,7 @@ def annotate_onnx(m, prec_dict : dict, requant_bits : int = 32):
         mult_attr = onnx.helper.make_attribute(key='mult_bits', value=requant_bits)
         n.attribute.append(mult_attr)
 
-def export_net(net : nn.Module,name : str, out_dir : str, eps_in : float, in_data : torch.Tensor, integerize : bool = True, D : float = 2**24, opset_version : int  = 10, align_avg_pool : bool = False, code_size : int = 160000):
+def export_net(net : nn.Module,name : str, out_dir : str, eps_in : float, in_data : torch.Tensor, integerize : bool = True, D : float = 2**24, opset_version : int  = 10, align_avg_pool : bool = False, code_size : int = 160000, integerize_cache : Optional[str] = None, memory_plan : bool = False, integer_engine : bool = False):
     net = net.eval()
 
 
@@ -127,7 +128,12 @@ def export_net(net : nn.Module,name : str, out_dir : str, eps_in : float, in_dat
 
     shape_in = in_data.shape
 
-    if integerize:
+    if integerize and integerize_cache is not None:
+        # reuse the integerized network from a previous export with identical
+        # network and settings, if available
+        cache = qlfx.passes.pact.IntegerizationCache(integerize_cache)
+        net_integerized = cache.integerize(net, shape_in=shape_in, eps_in=eps_in, D=D)
+    elif integerize:
         net_traced = qlfx.passes.pact.PACT_symbolic_trace(net)
 
         int_pass = qlfx.passes.pact.IntegerizePACTNetPass(shape_in=shape_in,  eps_in=eps_in, D=D)
@@ -139,6 +145,12 @@ def export_net(net : nn.Module,name : str, out_dir : str, eps_in : float, in_dat
         align_avgpool_pass = DORYHarmonizePass(in_shape=shape_in)
         net_integerized = align_avgpool_pass(net_integerized)
 
+    if memory_plan:
+        # static activation memory plan of the integerized network
+        qlfx.passes.ShapePropPass(shape_in, meta=True)(net_integerized)
+        plan_pass = qlfx.passes.ActivationMemoryPlanPass()
+        plan_pass(net_integerized).memory_plan.to_json(str(out_path.joinpath(f"{name}_memory_plan.json")), indent=2)
+
     integerized_nodes = LightweightGraph.build_nodes_list(net_integerized, leaf_types=(AvgPoolWrap, DORYAdder, PACTWrapMHSA))
 
     # the integerization pass annotates the conv layers with the number of
@@ -190,8 +202,12 @@ def export_net(net : nn.Module,name : str, out_dir : str, eps_in : float, in_dat
     # open the supplied input image
     if in_data is not None:
         im_tensor = in_data.clone().to(dtype=torch.float64)
-        net_integerized = net_integerized.to(dtype=torch.float64)
-        output = net_integerized(im_tensor).to(dtype=torch.float64)
+        if integer_engine and isinstance(net_integerized, fx.GraphModule):
+            # bit-identical to the float64 reference, but faster
+            output = qlfx.passes.pact.IntegerInterpreter(net_integerized).run(im_tensor)
+        else:
+            net_integerized = net_integerized.to(dtype=torch.float64)
+            output = net_integerized(im_tensor).to(dtype=torch.float64)
         # now, save everything into beautiful text files
         def save_beautiful_text(t : torch.Tensor, layer_name : str, filename : str):
             t = t.squeeze(0)
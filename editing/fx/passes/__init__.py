@@ -1,5 +1,8 @@
 from . import eps
+from .profiling import *
 from .pass_base import *
 from .general import *
 from .eps import *
+from .memory_plan import *
+from .latency import *
 from . import pact
@@ -0,0 +1,65 @@
+#
+# bb_pass_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+from unittest import TestCase
+from itertools import product
+
+import torch
+from torch import nn
+
+from quantlib.algorithms.bb import BBAct, BBConv2d, BBLatencyRegularizer
+from quantlib.editing.fx.passes import TargetDescription
+from quantlib.editing.fx.passes.bb import BB_symbolic_trace, BBControllerPrepPass
+
+
+_BB_ARGS = {'precs' : [2, 4, 8], 'hc_stretch' : 1.2, 'hc_T' : 0.5, 'init_clip' : 'max'}
+
+def _bb_net():
+    return nn.Sequential(BBAct(learn_clip=False, act_kind='relu', signed=False, **_BB_ARGS),
+                         BBConv2d(3, 8, 3, quantize='per_channel', **_BB_ARGS))
+
+
+class TestLatencyModelPrep(TestCase):
+
+    def test_bb_precisions(self):
+        # the target only describes 8x8 bit MACs, but the regularizer looks up
+        # the latencies of all BB precision configurations
+        target = TargetDescription(name='test', macs_per_cycle={(8, 8) : 4.}, bytes_per_cycle=8.)
+        prep = BBControllerPrepPass((1, 3, 8, 8), latency_spec=target)
+        gm = prep(BB_symbolic_trace(_bb_net()))
+        act, conv = gm.get_submodule('0'), gm.get_submodule('1')
+        props = prep.property_dict
+        self.assertTrue(set(product([2, 4, 8], [2, 4, 8])) <= set(props['1']['latency'].keys()))
+
+        reg = BBLatencyRegularizer(input_prec=8)
+        reg.register_layers({'0' : (act, props['0']), '1' : (conv, props['1'])})
+        self.assertEqual(tuple(reg.scales.shape), (3, 3))
+
+    def test_explicit_precisions(self):
+        target = TargetDescription(name='test', macs_per_cycle={(8, 8) : 4.}, bytes_per_cycle=8.)
+        prep = BBControllerPrepPass((1, 3, 8, 8), latency_spec=target, precisions=[(8, 2), (8, 8)])
+        prep(BB_symbolic_trace(_bb_net()))
+        self.assertEqual(set(prep.property_dict['1']['latency'].keys()), {(8, 2), (8, 8)})
+
+
+if __name__ == '__main__':
+    unittest.main()
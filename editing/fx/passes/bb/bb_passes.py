@@ -1,12 +1,14 @@
 from typing import Optional, Tuple, List, Union, Literal
+from itertools import product
 
+import numpy as np
 import pandas as pd
 import torch
 from torch import nn, fx
 
 from quantlib.editing.fx.util import module_of_node, named_module_nodes
-from quantlib.editing.fx.passes import FxPass, ModifySequentialPatternPass, ShapePropPass, CountMACsPass, SequentialPass, MemoryUsagePass, CollectPropertiesPass, AnnotateEpsPass
-from quantlib.algorithms.pact import PACTIntegerAdd
+from quantlib.editing.fx.passes import FxPass, ModifySequentialPatternPass, ShapePropPass, CountMACsPass, SequentialPass, MemoryUsagePass, CollectPropertiesPass, AnnotateEpsPass, LatencyModelPass, TargetDescription
+from quantlib.algorithms.pact import PACTIntegerAdd, PACTUnsignedAct, PACTAsymmetricAct
 from .bb_util import BB_symbolic_trace, find_layer_sets, partition_dict
 
 from quantlib.algorithms.bb import BBAct, BBConv2d, BBLinear, BBGateController, BBBOPComplexityRegularizer, BBLatencyRegularizer, BBSplitLatencyRegularizer, BBMultiLayerController, BB_attach_gates_individual, BB_attach_gates_shared, BB_attach_gates_individual_best_latency
@@ -166,15 +168,39 @@ class ReadLatencyPass(FxPass):
                 node.meta['max_latency'] = self.latency_dict['max_latency']
         return gm
 
+def bb_precision_configs(gm : fx.GraphModule, input_prec : int = 8):
+    # all (act_prec, op_prec) configurations the BB latency regularizers can
+    # look up for the layers in gm
+    act_precs = {input_prec}
+    op_precs = set()
+    for m in gm.modules():
+        if isinstance(m, tuple(_BB_LINOPS)):
+            op_precs.update(m.precs)
+        elif isinstance(m, BBAct):
+            act_precs.update(m.precs)
+        elif isinstance(m, (PACTUnsignedAct, PACTAsymmetricAct)):
+            act_precs.add(int(np.ceil(np.log2(m.n_levels))))
+    return sorted(product(act_precs, op_precs))
+
 class BBControllerPrepPass(FxPass):
-    def __init__(self, shape_in : Union[Tuple[int], List[int], torch.Size], latency_spec : Optional[str] = None):
+    def __init__(self, shape_in : Union[Tuple[int], List[int], torch.Size], latency_spec : Optional[Union[str, TargetDescription]] = None, precisions : Optional[list] = None, input_prec : int = 8):
         super(BBControllerPrepPass, self).__init__()
+        # if latency_spec is a TargetDescription, the latencies are estimated
+        # for the precision configurations in `precisions`. By default, these
+        # are all configurations of the BB layers in the network plus the
+        # ones supported by the target.
+        self.precisions = precisions
+        self.input_prec = input_prec
         # to know #MACs for each layer we must first know the input shapes for
         # conv layers
         self.register_subpass("shape_prop", ShapePropPass(shape_in))
         self.register_subpass("count_macs", CountMACsPass())
         self.register_subpass("memory", MemoryUsagePass())
-        if latency_spec is not None:
+        if isinstance(latency_spec, TargetDescription):
+            # no measurements available - estimate the latencies with the
+            # analytical model of the target
+            self.register_subpass("latency", LatencyModelPass(latency_spec))
+        elif latency_spec is not None:
             self.register_subpass("latency", ReadLatencyPass(latency_spec))
         else:
             self.latency = None
@@ -186,6 +212,12 @@ class BBControllerPrepPass(FxPass):
         gm = self.shape_prop.apply(gm)
         gm = self.count_macs.apply(gm)
         gm = self.memory.apply(gm)
+        if isinstance(self.latency, LatencyModelPass):
+            if self.precisions is not None:
+                self.latency.precisions = self.precisions
+            else:
+                target_precs = list(self.latency.target.macs_per_cycle.keys())
+                self.latency.precisions = sorted(set(target_precs) | set(bb_precision_configs(gm, self.input_prec)))
         if self.latency is not None:
             gm = self.latency.apply(gm)
         gm = self.properties.apply(gm)
@@ -211,7 +243,7 @@ class BBActConvControllerInitPass(FxPass):
         else:
             assert not init_best_latency_gates, f"For target=={target}, BBActConvController requires init_best_latency_gates==False!"
         self.target = target
-        self.register_subpass("prep", BBControllerPrepPass(shape_in, latency_spec_file))
+        self.register_subpass("prep", BBControllerPrepPass(shape_in, latency_spec_file, input_prec=input_prec))
         self.input_prec = input_prec
         self.joint_distribution = joint_distribution
         self.gate_init = gate_init
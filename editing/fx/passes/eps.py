@@ -22,6 +22,7 @@
 
 import copy
 from typing import Union, Optional
+import weakref
 from dataclasses import dataclass
 
 from collections.abc import Iterable
@@ -93,6 +94,11 @@ def eps_conversion_PACTWrapModule(m : nn.Module, *eps_in):
 def eps_conversion_mul(m : nn.Module, *eps_in):
     return eps_in[0] * eps_in[1].type_as(eps_in[0])
 
+def eps_conversion_pact_lut(m : nn.Module, *eps_in):
+    if m.eps_out is None:
+        return eps_in[0]
+    return m.eps_out.type_as(eps_in[0])
+
 def eps_conversion_first_in(m : nn.Module, *eps_in):
     if len(eps_in) > 0:
         return eps_in[0]
@@ -147,6 +153,7 @@ _EPS_CONVERSIONS = {
     PACTIntegerITAMax: eps_conversion_pact_softmax,
     PACTIntegerITAPartialMax: eps_conversion_pact_softmax,
     PACTIntegerLayerNorm : eps_conversion_pact_layernorm,
+    PACTIntegerLUT : eps_conversion_pact_lut,
     PACTIntegerMatmul: eps_conversion_pact_matmul,
     PACTIntegerSoftmax : eps_conversion_pact_softmax,
 }
@@ -169,6 +176,9 @@ def n_levels_out_first_in(m : nn.Module, in_levels : list, accumulator_levels :
 def n_levels_out_pact_acts(m : nn.Module, in_levels : list, accumulator_levels : int = 2**32):
     return m.n_levels
 
+def n_levels_out_pact_lut(m : nn.Module, in_levels : list, accumulator_levels : int = 2**32):
+    return in_levels[0] if m.n_levels_out is None else m.n_levels_out
+
 def n_levels_out_pact_embedding(m : nn.Module, in_levels : list, accumulator_levels : int = 2**32):
     return m.adder.act_out.n_levels
 
@@ -211,6 +221,7 @@ _N_LEVELS_OUT_PROP = {
     PACTIntegerITAMax: n_levels_out_pact_acts,
     PACTIntegerITAPartialMax: n_levels_out_pact_acts,
     PACTIntegerLayerNorm: n_levels_out_pact_acts,
+    PACTIntegerLUT : n_levels_out_pact_lut,
     PACTIntegerMatmul : n_levels_out_pact_linears,
     PACTIntegerSoftmax : n_levels_out_pact_acts,
 }
@@ -233,6 +244,9 @@ def has_signed_attr(m : nn.Module, si : list):
 def signed_out_first_in(m : nn.Module, si : list):
     return si[0]
 
+def signed_out_pact_lut(m : nn.Module, si : list):
+    return si[0] if m.signed_out is None else m.signed_out
+
 _SIGNED_OUT_PROP = {
     '_CALL_METHOD_contiguous' : signed_out_first_in,
     '_CALL_METHOD_reshape' : signed_out_first_in,
@@ -283,10 +297,15 @@ _SIGNED_OUT_PROP = {
     PACTIntegerITAMax: always_unsigned,
     PACTIntegerITAPartialMax: always_unsigned,
     PACTIntegerLayerNorm: always_signed,
+    PACTIntegerLUT : signed_out_pact_lut,
     PACTIntegerMatmul : signed_out_or_in_signed,
     PACTIntegerMean: signed_out_or_in_signed,
     PACTIntegerSoftmax : always_unsigned,
 }
+# attributes of a module (and its submodules) which the eps, n_levels and
+# signedness propagation functions read
+_EPS_STATE_ATTRS = ('clip_lo', 'clip_hi', 'log_t', 'n_levels', 'n_levels_out', 'eps', 'eps_s', 'eps_out', 'epsOut', 'Delta', 'locked')
+
 @dataclass
 class QuantInfo:
     eps_in : torch.Tensor
@@ -297,9 +316,16 @@ class QuantInfo:
     signed_out : bool
 
 class AnnotateEpsPass(FxPass):
-    def __init__(self, eps_in : Optional[Union[torch.Tensor, float]], n_levels_in : Optional[int] = 256, accumulator_levels : int = 2**32, signed_in : bool = True, prop_eps : bool = True, prop_n_levels : bool = True, prop_sign : bool = True, verbose=False):
+    def __init__(self, eps_in : Optional[Union[torch.Tensor, float]], n_levels_in : Optional[int] = 256, accumulator_levels : int = 2**32, signed_in : bool = True, prop_eps : bool = True, prop_n_levels : bool = True, prop_sign : bool = True, verbose=False, incremental : bool = False):
         super(AnnotateEpsPass, self).__init__()
         self.verbose = verbose
+        # in incremental mode, only nodes which changed since the last run on
+        # the same GraphModule and the nodes downstream of them are
+        # re-annotated.
+        self.incremental = incremental
+        self._node_states = weakref.WeakKeyDictionary()
+        self._value_snapshots = weakref.WeakKeyDictionary()
+        self._dirty = set()
 
         if isinstance(eps_in, Iterable):
             try:
@@ -333,104 +359,243 @@ class AnnotateEpsPass(FxPass):
         self.prop_n_levels = prop_n_levels
         self.prop_sign = prop_sign
 
-    def run_pass(self, gm : fx.GraphModule):
-        modules = gm_modules(gm)
-        placeHolderIdx = 0
-        for node in gm.graph.nodes:
-            if node.op == 'placeholder':
+    def annotate_node(self, gm : fx.GraphModule, node : fx.Node, placeholder_idx : int = 0):
+        # annotate a single node; all its inputs must already be annotated.
+        # placeholder_idx is the index of the node among the placeholders
+        if node.op == 'placeholder':
+
+            node.meta['quant'] = QuantInfo(eps_in=[self.eps_in[placeholder_idx]], eps_out=self.eps_in[placeholder_idx], n_levels_in=self.n_levels_in, n_levels_out=self.n_levels_in, signed_in=[self.signed_in], signed_out=self.signed_in)
+            # an equivalent for noeps for signedness is not yet supported...
+
+            for u in node.users:
+                if self.noeps and self.prop_eps:
+                    assert u.op == 'call_module' and isinstance(module_of_node(gm, u), _ORIGINAL_EPS_MODULES), "If no eps is provided to annotate_eps, all users of placeholder nodes must be in _ORIGINAL_EPS_MODULES!"
+                #u.meta['quant'] = QuantInfo(eps_in=torch.tensor(1.0), eps_out=torch.tensor(-1.0))
+            return
+        if node.op == 'output':
+            return
+
+        if node.op == 'call_module':
+            m = module_of_node(gm, node)
+            k = type(m)
+        else:
+            if node.op == 'get_attr':
+                print(f"[AnnotateEpsPass] get_attr nodes are not currently supported!!")
+                print(f"                    -> Node: {node.name}, Key: _{node.op.upper()}_{node.target}")
+
+            assert node.op != 'get_attr', "get_attr nodes are not currently supported!"
+
+            k = f'_{node.op.upper()}_{node.target}'
+            m = None
+
+        if self.prop_eps:
+            arg_eps_ins = [i.meta['quant'].eps_out for i in node.args if isinstance(i, fx.Node)]
+            other_args = [i for i in node.args if not isinstance(i, fx.Node)]
+
+            kwarg_eps_ins = {k : v.meta['quant'].eps_out for k, v in node.kwargs.items() if isinstance(v, fx.Node)}
+            other_kwargs = {k : v for k, v in node.kwargs.items() if not isinstance(v, fx.Node)}
+            conversion_kwargs = copy.copy(other_kwargs)
+            conversion_kwargs.update(other_kwargs)
+            all_eps = arg_eps_ins + [v for v in kwarg_eps_ins.values()]
+            eps_in = [arg_eps_ins, kwarg_eps_ins]
+            if node.op == 'call_module':
+                conversion_args = [m] + arg_eps_ins + other_args
+            else:
+                conversion_args = arg_eps_ins
+
+            try:
+                eps_out = _EPS_CONVERSIONS[k](*conversion_args, **conversion_kwargs)
+            except KeyError:
+                if (self.verbose): 
+                    print(f"[AnnotateEpsPass] Key {k} not found in _EPS_CONVERSIONS!")
+                eps_diffs = [torch.abs(e1 - e2) for e1, e2 in zip(all_eps[:-1], all_eps[1:])]
+                if not all(d < 1e-8 for d in eps_diffs):
+                    print("[AnnotateEpsPass] Mismatching input epsilons in node with no eps propagation function! Eps propagation will likely be wrong!")
+                    print(f"                    -> Node: {node.name}, Key: {k}, eps_in: {all_eps}")
+                    if (self.verbose): print(f"[AnnotateEpsPass] Using identity epsilon propagation on node with op {node.op}, target {node.target}!")
+                eps_out = all_eps[0]
+        else:
+            eps_in = None
+            eps_out = None
 
-                node.meta['quant'] = QuantInfo(eps_in=[self.eps_in[placeHolderIdx]], eps_out=self.eps_in[placeHolderIdx], n_levels_in=self.n_levels_in, n_levels_out=self.n_levels_in, signed_in=[self.signed_in], signed_out=self.signed_in)
-                # an equivalent for noeps for signedness is not yet supported...
+        if self.prop_n_levels:
+            node_in_levels = [i.meta['quant'].n_levels_out for i in node.args if isinstance(i, fx.Node)]
+            try:
+                node_out_levels = _N_LEVELS_OUT_PROP[k](m, node_in_levels, self.accumulator_levels)
+            except KeyError:
+                if (self.verbose): 
+                    print(f"[AnnotateEpsPass] Key {k} not found in _N_LEVELS_OUT_PROP!")
+                in_levels_diffs = [abs(l1 - l2) for l1, l2 in zip(node_in_levels[:-1], node_in_levels[1:])]
+                if not all(d < 1e-8 for d in in_levels_diffs):
+                    print("[AnnotateEpsPass] Mismatching input n_levels in node with no n_levels_out propagation function! n_levels propagation will likely be wrong!")
+                    print(f"                    -> Node: {node.name}, Key: {k}, n_levels_in: {node_in_levels}")
+                    if (self.verbose): print(f"[AnnotateEpsPass] Using identity n_level propagation on node with op {node.op}, target {node.target}!")
+                node_out_levels = node_in_levels[0]
+        else:
+            node_in_levels = None
+            node_out_levels = None
+
+        if self.prop_sign:
 
-                placeHolderIdx += 1
+            node_in_signed = [i.meta['quant'].signed_out for i in node.args if isinstance(i, fx.Node)]
+            try:
+                node_out_signed = _SIGNED_OUT_PROP[k](m, node_in_signed)
+            except KeyError:
+                if (self.verbose): 
+                    print(f"[AnnotateEpsPass] Key {k} not found in _SIGNED_OUT_PROP!")
+                in_singed_diffs = [abs(s1 - s2) for s1, s2 in zip(node_in_signed[:-1], node_in_signed[1:])]
+                if not all(d < 1e-8 for d in in_singed_diffs):
+                    print("[AnnotateEpsPass] Mismatching input signedness in node with no signedness propagation function! signedness propagation will likely be wrong!")
+                    print(f"                    -> Node: {node.name}, Key: : {k}, signed_in: {node_in_signed}")
+                    if (self.verbose): print(f"[AnnotateEpsPass] Using identity signed propagation on node with op {node.op}, target {node.target}!")
+                node_out_signed = node_in_signed[0]
+        else:
+            node_in_signed = None
+            node_out_signed = None
+        node.meta['quant'] = QuantInfo(eps_in=eps_in, eps_out=eps_out, n_levels_in=node_in_levels, n_levels_out=node_out_levels, signed_in=node_in_signed, signed_out=node_out_signed)
+
+
+    @staticmethod
+    def eps_state_tensors(m : nn.Module):
+        # the tensors among _EPS_STATE_ATTRS of m and its submodules (e.g.,
+        # clipping bounds), which determine m's annotations
+        return [v for sm in m.modules() for v in (getattr(sm, a, None) for a in _EPS_STATE_ATTRS) if isinstance(v, torch.Tensor)]
+
+    @staticmethod
+    def _module_state(m : Optional[nn.Module]):
+        # the annotations of a call_module node depend on the module's
+        # configuration (e.g. n_levels) and on the values of its
+        # eps_state_tensors, which are compared separately in _changed_values
+        if m is None:
+            return None
+        return tuple((k, v) for sm in m.modules() for k, v in vars(sm).items() if isinstance(v, (bool, int, float, str)))
+
+    def _changed_values(self, gm : fx.GraphModule, nodes : list):
+        # returns the nodes whose eps_state_tensors changed since the last run
+        # on gm. Controllers update clipping bounds with `t.data.copy_()`,
+        # which bumps neither the data pointer nor the version counter, so
+        # the values are compared - all at once on their device, which costs
+        # a single synchronization.
+        layout, tensors = [], []
+        for node in nodes:
+            ts = self.eps_state_tensors(module_of_node(gm, node)) if node.op == 'call_module' else []
+            layout.append((node, tuple(t.numel() for t in ts)))
+            tensors.extend(t.detach().reshape(-1) for t in ts)
+        layout = tuple(layout)
+        old = self._value_snapshots.get(gm, None)
+        if not len(tensors):
+            self._value_snapshots[gm] = (layout, None, None)
+            return set()
+        dev = tensors[0].device
+        flat = torch.cat([t.to(device=dev, dtype=torch.float64) for t in tensors])
+        if old is None or old[0] != layout or old[1] is None or old[1].device != dev:
+            # segment index of each element, reused while the layout persists
+            seg = torch.cat([torch.full((sum(numels),), i, dtype=torch.long) for i, (_, numels) in enumerate(layout)]).to(dev)
+            self._value_snapshots[gm] = (layout, flat, seg)
+            return set(n for n, numels in layout if len(numels))
+        seg = old[2]
+        self._value_snapshots[gm] = (layout, flat, seg)
+        changed = torch.zeros(len(layout), device=dev).index_add_(0, seg, (flat != old[1]).to(torch.float32))
+        return set(layout[i][0] for i in torch.nonzero(changed).reshape(-1).tolist())
+
+    def _node_state(self, gm : fx.GraphModule, node : fx.Node, placeholder_idx : int):
+        # everything the annotation of node depends on besides its inputs'
+        # annotations, as a tuple of (objects compared by identity, values).
+        # fx creates new args/kwargs containers whenever they are modified,
+        # so comparing them by identity is sufficient.
+        if node.op == 'placeholder':
+            return ((self.eps_in[placeholder_idx],), (placeholder_idx, self.n_levels_in, self.signed_in))
+        m = module_of_node(gm, node) if node.op == 'call_module' else None
+        return ((node.args, node.kwargs, m), (node.op, node.target, self._module_state(m)))
+
+    @staticmethod
+    def _same_state(s1, s2):
+        return all(a is b for a, b in zip(s1[0], s2[0])) and s1[1] == s2[1]
+
+    def mark_dirty(self, *nodes_or_modules):
+        # force re-annotation of the given nodes (or the nodes calling the
+        # given modules) and everything downstream of them in the next
+        # incremental run. Only required if module state other than the
+        # attributes listed in _EPS_STATE_ATTRS which the annotations depend
+        # on was modified.
+        self._dirty.update(nodes_or_modules)
+
+    def run_incremental(self, gm : fx.GraphModule):
+        old_states = self._node_states.get(gm, {})
+        new_states = {}
+        changed = set()
+        placeholder_idx = 0
+        nodes = [n for n in gm.graph.nodes if n.op != 'output']
+        changed_values = self._changed_values(gm, nodes)
+        for node in nodes:
+            state = self._node_state(gm, node, placeholder_idx)
+            old = old_states.get(node)
+            dirty = (old is None
+                     or node in self._dirty
+                     or node in changed_values
+                     or (node.op == 'call_module' and state[0][2] in self._dirty)
+                     # another pass may have overwritten the annotation
+                     or node.meta.get('quant') is not old[1]
+                     or not self._same_state(old[0], state)
+                     or any(i in changed for i in node.all_input_nodes))
+            if dirty:
+                self.annotate_node(gm, node, placeholder_idx)
+                changed.add(node)
+            new_states[node] = (state, node.meta['quant'])
+            if node.op == 'placeholder':
+                placeholder_idx += 1
+        self._node_states[gm] = new_states
+        self._dirty = set()
+        return gm
 
-                for u in node.users:
-                    if self.noeps and self.prop_eps:
-                        assert u.op == 'call_module' and isinstance(module_of_node(gm, u), _ORIGINAL_EPS_MODULES), "If no eps is provided to annotate_eps, all users of placeholder nodes must be in _ORIGINAL_EPS_MODULES!"
-                    #u.meta['quant'] = QuantInfo(eps_in=torch.tensor(1.0), eps_out=torch.tensor(-1.0))
-            elif node.op == 'output':
+    def annotate_nodes(self, gm : fx.GraphModule, nodes : list):
+        # annotate a subset of gm's nodes, which must be in topological
+        # order and contain all nodes they depend on
+        placeholder_idxs = {n : i for i, n in enumerate(n for n in gm.graph.nodes if n.op == 'placeholder')}
+        for node in nodes:
+            self.annotate_node(gm, node, placeholder_idxs.get(node, 0))
+
+    def eps_plan(self, gm : fx.GraphModule, nodes : list):
+        # precompiles the eps propagation over a subset of gm's nodes (in
+        # topological order, containing all nodes they depend on) into a list
+        # of (node, module, conversion function, placeholder index) steps
+        # for run_eps_plan. Only epsilons are propagated.
+        placeholder_idxs = {n : i for i, n in enumerate(n for n in gm.graph.nodes if n.op == 'placeholder')}
+        plan = []
+        for node in nodes:
+            if node.op == 'output':
+                continue
+            assert node.op != 'get_attr', "get_attr nodes are not currently supported!"
+            m = module_of_node(gm, node) if node.op == 'call_module' else None
+            k = type(m) if m is not None else f'_{node.op.upper()}_{node.target}'
+            plan.append((node, m, _EPS_CONVERSIONS.get(k, None), placeholder_idxs.get(node, 0)))
+        return plan
+
+    def run_eps_plan(self, plan : list):
+        # evaluates a plan produced by eps_plan, computing the same output
+        # epsilons as annotate_node. Returns a dict {node : eps_out}.
+        eps = {}
+        for node, m, conversion, placeholder_idx in plan:
+            if node.op == 'placeholder':
+                eps[node] = self.eps_in[placeholder_idx]
                 continue
+            arg_eps_ins = [eps[i] for i in node.args if isinstance(i, fx.Node)]
+            if conversion is None:
+                all_eps = arg_eps_ins + [eps[v] for v in node.kwargs.values() if isinstance(v, fx.Node)]
+                eps[node] = all_eps[0]
+                continue
+            other_kwargs = {k : v for k, v in node.kwargs.items() if not isinstance(v, fx.Node)}
+            if m is not None:
+                conversion_args = [m] + arg_eps_ins + [i for i in node.args if not isinstance(i, fx.Node)]
             else:
-                if node.op == 'call_module':
-                    m = module_of_node(gm, node)
-                    k = type(m)
-                else:
-                    if node.op == 'get_attr':
-                        print(f"[AnnotateEpsPass] get_attr nodes are not currently supported!!")
-                        print(f"                    -> Node: {node.name}, Key: _{node.op.upper()}_{node.target}")
-
-                    assert node.op != 'get_attr', "get_attr nodes are not currently supported!"
-
-                    k = f'_{node.op.upper()}_{node.target}'
-                    m = None
-
-                if self.prop_eps:
-                    arg_eps_ins = [i.meta['quant'].eps_out for i in node.args if isinstance(i, fx.Node)]
-                    other_args = [i for i in node.args if not isinstance(i, fx.Node)]
-
-                    kwarg_eps_ins = {k : v.meta['quant'].eps_out for k, v in node.kwargs.items() if isinstance(v, fx.Node)}
-                    other_kwargs = {k : v for k, v in node.kwargs.items() if not isinstance(v, fx.Node)}
-                    conversion_kwargs = copy.copy(other_kwargs)
-                    conversion_kwargs.update(other_kwargs)
-                    all_eps = arg_eps_ins + [v for v in kwarg_eps_ins.values()]
-                    eps_in = [arg_eps_ins, kwarg_eps_ins]
-                    if node.op == 'call_module':
-                        conversion_args = [m] + arg_eps_ins + other_args
-                    else:
-                        conversion_args = arg_eps_ins
-
-                    try:
-                        eps_out = _EPS_CONVERSIONS[k](*conversion_args, **conversion_kwargs)
-                    except KeyError:
-                        if (self.verbose): 
-                            print(f"[AnnotateEpsPass] Key {k} not found in _EPS_CONVERSIONS!")
-                        eps_diffs = [torch.abs(e1 - e2) for e1, e2 in zip(all_eps[:-1], all_eps[1:])]
-                        if not all(d < 1e-8 for d in eps_diffs):
-                            print("[AnnotateEpsPass] Mismatching input epsilons in node with no eps propagation function! Eps propagation will likely be wrong!")
-                            print(f"                    -> Node: {node.name}, Key: {k}, eps_in: {all_eps}")
-                            if (self.verbose): print(f"[AnnotateEpsPass] Using identity epsilon propagation on node with op {node.op}, target {node.target}!")
-                        eps_out = all_eps[0]
-                else:
-                    eps_in = None
-                    eps_out = None
-
-                if self.prop_n_levels:
-                    node_in_levels = [i.meta['quant'].n_levels_out for i in node.args if isinstance(i, fx.Node)]
-                    try:
-                        node_out_levels = _N_LEVELS_OUT_PROP[k](m, node_in_levels, self.accumulator_levels)
-                    except KeyError:
-                        if (self.verbose): 
-                            print(f"[AnnotateEpsPass] Key {k} not found in _N_LEVELS_OUT_PROP!")
-                        in_levels_diffs = [abs(l1 - l2) for l1, l2 in zip(node_in_levels[:-1], node_in_levels[1:])]
-                        if not all(d < 1e-8 for d in in_levels_diffs):
-                            print("[AnnotateEpsPass] Mismatching input n_levels in node with no n_levels_out propagation function! n_levels propagation will likely be wrong!")
-                            print(f"                    -> Node: {node.name}, Key: {k}, n_levels_in: {node_in_levels}")
-                            if (self.verbose): print(f"[AnnotateEpsPass] Using identity n_level propagation on node with op {node.op}, target {node.target}!")
-                        node_out_levels = node_in_levels[0]
-                else:
-                    node_in_levels = None
-                    node_out_levels = None
-
-                if self.prop_sign:
-
-                    node_in_signed = [i.meta['quant'].signed_out for i in node.args if isinstance(i, fx.Node)]
-                    try:
-                        node_out_signed = _SIGNED_OUT_PROP[k](m, node_in_signed)
-                    except KeyError:
-                        if (self.verbose): 
-                            print(f"[AnnotateEpsPass] Key {k} not found in _SIGNED_OUT_PROP!")
-                        in_singed_diffs = [abs(s1 - s2) for s1, s2 in zip(node_in_signed[:-1], node_in_signed[1:])]
-                        if not all(d < 1e-8 for d in in_singed_diffs):
-                            print("[AnnotateEpsPass] Mismatching input signedness in node with no signedness propagation function! signedness propagation will likely be wrong!")
-                            print(f"                    -> Node: {node.name}, Key: : {k}, signed_in: {node_in_signed}")
-                            if (self.verbose): print(f"[AnnotateEpsPass] Using identity signed propagation on node with op {node.op}, target {node.target}!")
-                        node_out_signed = node_in_signed[0]
-                else:
-                    node_in_signed = None
-                    node_out_signed = None
-                node.meta['quant'] = QuantInfo(eps_in=eps_in, eps_out=eps_out, n_levels_in=node_in_levels, n_levels_out=node_out_levels, signed_in=node_in_signed, signed_out=node_out_signed)
-
+                conversion_args = arg_eps_ins
+            eps[node] = conversion(*conversion_args, **other_kwargs)
+        return eps
 
+    def run_pass(self, gm : fx.GraphModule):
+        if self.incremental:
+            return self.run_incremental(gm)
+        self.annotate_nodes(gm, gm.graph.nodes)
         return gm
 
 
@@ -31,7 +31,7 @@ from torch import nn, fx
 from torch.fx.passes.shape_prop import ShapeProp
 from torch.nn import functional as F
 from .pass_base import FxPass, SequentialPass, ModifySequentialPatternPass, ModularizePass
-from ..util import module_of_node, get_qualified_prefix
+from ..util import module_of_node, get_qualified_prefix, add_submodule
 
 from quantlib.algorithms.pact.pact_ops import *
 from quantlib.algorithms.bb.bb_ops import *
@@ -239,6 +239,8 @@ class ModularizeActivationsPass(ModularizePass):
         super(ModularizeActivationsPass, self).__init__(op='call_function', target=tuple(k for k in self.act_function_to_module.keys()), replacement_fn=self.act_node_to_module, name="MODULARIZE_ACTIVATIONS_PASS")
 
 class RetracePass(FxPass):
+    requires_recompiled_gm = True
+
     def __init__(self, trace : callable):
         super(RetracePass, self).__init__()
         self.trace = trace
@@ -264,7 +266,7 @@ class InsertModuleAfterNodePass(FxPass):
             target_list.append(self.insert_target)
         target_list.append(f"_QL_INSERTED_AFTER_{self.name.upper()}")
         new_target = '.'.join(target_list)
-        gm.add_submodule(new_target, self.module)
+        add_submodule(gm, new_target, self.module)
 
         # need to keep track of users before adding the new node
         users_list = [u for u in self.node_before.users]
@@ -297,7 +299,7 @@ class InsertModuleBetweenNodesPass(FxPass):
             target_list.append(self.insert_target)
         target_list.append(f"_QL_INSERTED_BETWEEN_{self.name.upper()}")
         new_target = '.'.join(target_list)
-        gm.add_submodule(new_target, self.module)
+        add_submodule(gm, new_target, self.module)
 
         with gm.graph.inserting_after(self.node_before):
             new_node = gm.graph.call_module(new_target, args=(self.node_before,))
@@ -356,9 +358,137 @@ class InsertModuleBetweenModulesPass(SequentialPass):
 
         super(InsertModuleBetweenModulesPass, self).setup_passes(passes)
 
+def _meta_like(t : torch.Tensor, shape=None):
+    return torch.empty(t.shape if shape is None else shape, dtype=t.dtype, device='meta')
+
+def _to_meta(x):
+    if isinstance(x, torch.Tensor):
+        return _meta_like(x)
+    if type(x) in (list, tuple):
+        return type(x)(_to_meta(el) for el in x)
+    if isinstance(x, dict):
+        return {k: _to_meta(v) for k, v in x.items()}
+    return x
+
+def _materialize(x):
+    # meta tensors have no data - this is only used for operations which
+    # cannot run on the meta device
+    if isinstance(x, torch.Tensor) and x.is_meta:
+        return torch.zeros(x.shape, dtype=x.dtype)
+    if type(x) in (list, tuple):
+        return type(x)(_materialize(el) for el in x)
+    if isinstance(x, dict):
+        return {k: _materialize(v) for k, v in x.items()}
+    return x
+
+# shape rules for quantlib modules whose forward passes can't be executed on
+# the meta device (e.g., because they read values back to the host) or which
+# would materialize their parameters. each rule takes the module and the
+# (meta) inputs and returns a meta tensor of the output shape.
+def _meta_same_shape(m, x, *args, **kwargs):
+    return _meta_like(x)
+
+def _meta_requant_shift(m, x):
+    mul = m.mul.reshape([-1]+[1]*(x.dim()-2)) if m.mul.dim() == 1 else m.mul
+    add = m.add.reshape([-1]+[1]*(x.dim()-2)) if m.add.dim() == 1 else m.add
+    return _meta_like(x, torch.broadcast_shapes(x.shape, mul.shape, add.shape))
+
+def _meta_linear(m, x):
+    return _meta_like(x, x.shape[:-1] + (m.out_features,))
+
+def _meta_conv(m, x):
+    conv = F.conv1d if isinstance(m, nn.Conv1d) else F.conv2d
+    if isinstance(m, PACTCausalConv1d):
+        x = F.pad(x, ((m.kernel_size[0]-1) * m.dilation[0], 0))
+    w = torch.empty(m.weight.shape, dtype=x.dtype, device='meta')
+    return conv(x, w, None, m.stride, m.padding, m.dilation, m.groups)
+
+def _meta_attention(m, q, *args, **kwargs):
+    return _meta_like(q, q.shape[:-1] + (m.wo_weight.shape[0],))
+
+_META_SHAPE_RULES = {
+    RequantShift : _meta_requant_shift,
+    HardActRequantShift : _meta_same_shape,
+    ChannelwiseThreshold : _meta_same_shape,
+    _PACTActivation : _meta_same_shape,
+    PACTLinear : _meta_linear,
+    PACTConv1d : _meta_conv,
+    PACTConv2d : _meta_conv,
+    PACTHardswish : _meta_same_shape,
+    PACTIntegerHardswish : _meta_same_shape,
+    PACTHardsigmoid : _meta_same_shape,
+    PACTIntegerHardsigmoid : _meta_same_shape,
+    PACTExp : _meta_same_shape,
+    PACTIntegerExp : _meta_same_shape,
+    PACTSoftmax : _meta_same_shape,
+    PACTIntegerSoftmax : _meta_same_shape,
+    PACTITAMax : _meta_same_shape,
+    PACTIntegerITAMax : _meta_same_shape,
+    PACTITAPartialMax : _meta_same_shape,
+    PACTIntegerITAPartialMax : _meta_same_shape,
+    PACTGELU : _meta_same_shape,
+    PACTIntegerGELU : _meta_same_shape,
+    PACTIntegerLUT : _meta_same_shape,
+    PACTLayerNorm : _meta_same_shape,
+    PACTIntegerLayerNorm : _meta_same_shape,
+    PACTWrapMHSA : _meta_attention,
+    PACTWrapLinearAttention : _meta_attention,
+    PACTWrapCLCA : _meta_attention,
+}
+
+def _meta_shape_rule(m : nn.Module):
+    # the most specific rule along the MRO wins
+    for t in type(m).__mro__:
+        if t in _META_SHAPE_RULES.keys():
+            return _META_SHAPE_RULES[t]
+    return None
+
+class _MetaShapeProp(ShapeProp):
+    # ShapeProp which executes the graph on meta tensors: no activations are
+    # allocated and no FLOPs are spent. Nodes are evaluated with (in order of
+    # preference):
+    # 1. a shape rule from _META_SHAPE_RULES
+    # 2. the node's target with all inputs, parameters and buffers on the
+    #    meta device
+    # 3. the node's target on zero-filled real tensors - this costs FLOPs,
+    #    but only for the affected node
+    def run_node(self, n : fx.Node):
+        result = super(_MetaShapeProp, self).run_node(n)
+        # keep everything downstream of a fallback on the meta device
+        return _to_meta(result)
+
+    def get_attr(self, target, args, kwargs):
+        return _to_meta(super(_MetaShapeProp, self).get_attr(target, args, kwargs))
+
+    def call_function(self, target, args, kwargs):
+        try:
+            return target(*args, **kwargs)
+        except Exception:
+            return target(*_materialize(args), **_materialize(kwargs))
+
+    def call_method(self, target, args, kwargs):
+        try:
+            return super(_MetaShapeProp, self).call_method(target, args, kwargs)
+        except Exception:
+            return super(_MetaShapeProp, self).call_method(target, _materialize(args), _materialize(kwargs))
+
+    def call_module(self, target, args, kwargs):
+        m = self.fetch_attr(target)
+        rule = _meta_shape_rule(m)
+        if rule is not None:
+            return rule(m, *args, **kwargs)
+        meta_state = {k: _meta_like(v) for k, v in list(m.named_parameters()) + list(m.named_buffers())}
+        try:
+            return torch.nn.utils.stateless.functional_call(m, meta_state, tuple(args), kwargs)
+        except Exception:
+            return m(*_materialize(args), **_materialize(kwargs))
+
 class ShapePropPass(FxPass):
     # a wrapper for the shape propagation pass of torch.fx
-    def __init__(self, *shapes_in, dtype_in : torch.dtype = torch.float32):
+    # with meta=True, the graph is executed on tensors on the meta device, so
+    # shape propagation costs (almost) no FLOPs and no activation memory.
+    # Custom quantlib modules are handled by the rules in _META_SHAPE_RULES.
+    def __init__(self, *shapes_in, dtype_in : torch.dtype = torch.float32, meta : bool = False):
         super(ShapePropPass, self).__init__()
 
         # SCHEREMO: Workaround for unpacking multi input shapes
@@ -370,12 +500,17 @@ class ShapePropPass(FxPass):
             self.shapes_in = [torch.Size(s) for s in shapes_in]
 
         self.dtype_in = dtype_in
+        self.meta = meta
 
     def run_pass(self, gm : fx.GraphModule):
         training = gm.training
         gm.eval()
-        sp = ShapeProp(gm)
-        inp = [torch.rand(s, dtype=self.dtype_in) for s in self.shapes_in]
+        if self.meta:
+            sp = _MetaShapeProp(gm)
+            inp = [torch.empty(s, dtype=self.dtype_in, device='meta') for s in self.shapes_in]
+        else:
+            sp = ShapeProp(gm)
+            inp = [torch.rand(s, dtype=self.dtype_in) for s in self.shapes_in]
         try:
             sp.run(*inp)
         except Exception as e:
@@ -0,0 +1,192 @@
+#
+# latency.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import math
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+from torch import nn, fx
+
+from .pass_base import FxPass
+from .general import CountMACsPass
+from .memory_plan import activation_bytes, _node_bits
+from ..util import module_of_node
+
+__all__ = ['TargetDescription',
+           'LatencyModelPass']
+
+def _int_log2(v):
+    return int(math.ceil(math.log2(float(v))))
+
+@dataclass
+class TargetDescription:
+    # description of a deployment target for the roofline latency model.
+    # - macs_per_cycle: {(act_bits, weight_bits) : MACs/cycle} - throughput of
+    #                   the target's compute units for each supported precision
+    #                   configuration
+    # - bytes_per_cycle: bandwidth of the memory holding weights and
+    #                    activations
+    # - layer_overhead: fixed cost per executed layer in cycles (kernel
+    #                   launch, tiling setup, ...)
+    # - frequency: clock frequency in Hz. If supplied, latencies are reported
+    #              in seconds, otherwise in cycles.
+    name : str
+    macs_per_cycle : dict
+    bytes_per_cycle : float
+    layer_overhead : float = 0.
+    frequency : Optional[float] = None
+    default_macs_per_cycle : float = 1.
+
+    def throughput(self, act_bits : int, weight_bits : int):
+        # MACs/cycle for the given precision configuration; unsupported
+        # configurations are executed in the narrowest supported
+        # configuration which fits both operands
+        try:
+            return self.macs_per_cycle[(act_bits, weight_bits)]
+        except KeyError:
+            fitting = [(a*w, v) for (a, w), v in self.macs_per_cycle.items() if a >= act_bits and w >= weight_bits]
+            if len(fitting):
+                return min(fitting, key=lambda kv: kv[0])[1]
+            return self.default_macs_per_cycle
+
+    def to_time(self, cycles : float):
+        return cycles if self.frequency is None else cycles / self.frequency
+
+    def estimate(self, macs : int, n_bytes : int, act_bits : int, weight_bits : int):
+        # roofline estimate: a layer is either compute or memory bound
+        compute = macs / self.throughput(act_bits, weight_bits)
+        memory = n_bytes / self.bytes_per_cycle
+        total = max(compute, memory) + self.layer_overhead
+        return {'compute' : self.to_time(compute),
+                'memory' : self.to_time(memory),
+                'total' : self.to_time(total),
+                'bound' : 'compute' if compute >= memory else 'memory'}
+
+
+class LatencyModelPass(FxPass):
+    # annotate each call_module node of a shape-annotated network (run
+    # ShapePropPass first) with an estimated latency:
+    # - node.meta['latency_est']: {'compute', 'memory', 'total', 'bound',
+    #                              'source'} for the node's own precision
+    #                              configuration
+    # - node.meta['latency'] and node.meta['max_latency']: for nodes which
+    #   perform MACs, the latency for every precision configuration in
+    #   `precisions`, in the same format as ReadLatencyPass produces from
+    #   measured benchmark results. This lets BBControllerPrepPass and the
+    #   BBLatencyRegularizer run on the model instead of measurements.
+    # If `bench_results` (a file path for `import_bench_results` or its
+    # result) is supplied, measured latencies are used for all layers and
+    # configurations found in it and the model fills in the rest.
+    # `bench_unit` is the unit of the measured latencies, 'cycles' or 's'.
+    # They are converted to the unit of the model's estimates (seconds if
+    # target.frequency is set, cycles otherwise); measurements in seconds
+    # can only be combined with a target with known frequency.
+    # The whole-network breakdown is stored in gm.latency_breakdown (sorted
+    # by descending latency) and gm.total_latency.
+    def __init__(self, target : TargetDescription, bench_results : Optional[Union[str, dict]] = None, bench_unit : str = 'cycles', precisions : Optional[list] = None, default_act_bits : int = 8, default_weight_bits : int = 8):
+        super(LatencyModelPass, self).__init__()
+        assert bench_unit in ['cycles', 's'], f"LatencyModelPass: Invalid bench_unit '{bench_unit}' - must be 'cycles' or 's'!"
+        assert bench_results is None or bench_unit == 'cycles' or target.frequency is not None, "LatencyModelPass: Measured latencies in seconds can't be combined with cycle estimates - specify the target's frequency!"
+        self.target = target
+        self.bench_unit = bench_unit
+        if isinstance(bench_results, str):
+            # pandas is only needed for reading benchmark results
+            from quantlib.algorithms.bb.generate_bench_spec import import_bench_results
+            bench_results = import_bench_results(bench_results)
+        self.bench_results = bench_results
+        self.precisions = list(target.macs_per_cycle.keys()) if precisions is None else precisions
+        self.default_act_bits = default_act_bits
+        self.default_weight_bits = default_weight_bits
+        self.register_subpass("count_macs", CountMACsPass())
+
+    def weight_bits(self, m : nn.Module):
+        n_levels = getattr(m, 'n_levels', None)
+        return self.default_weight_bits if n_levels is None else _int_log2(n_levels)
+
+    def act_bits(self, gm : fx.GraphModule, node : fx.Node):
+        bits = [_node_bits(gm, inp, None)[0] for inp in node.all_input_nodes]
+        bits = [b for b in bits if b is not None]
+        return max(bits) if len(bits) else self.default_act_bits
+
+    def measured(self, node : fx.Node, m : nn.Module):
+        if self.bench_results is None:
+            return None
+        from quantlib.algorithms.bb.generate_bench_spec import ident_of_layer
+        try:
+            ident = ident_of_layer(node, m)
+        except AssertionError:
+            # layer can't be described by a LayerIdentifier
+            return None
+        lut = self.bench_results.get(ident, None) if ident is not None else None
+        if lut is None or self.bench_unit == 's':
+            return lut
+        return {k : self.target.to_time(v) for k, v in lut.items()}
+
+    def run_pass(self, gm : fx.GraphModule):
+        assert all('tensor_meta' in n.meta.keys() for n in gm.graph.nodes if n.op == 'call_module'), "LatencyModelPass: run ShapePropPass before estimating latencies!"
+        gm = self.count_macs.apply(gm)
+
+        breakdown = []
+        prec_nodes = []
+        for node in gm.graph.nodes:
+            if node.op != 'call_module':
+                continue
+            m = module_of_node(gm, node)
+            macs = node.meta.get('macs', 0)
+            weight_bits = self.weight_bits(m)
+            act_bits = self.act_bits(gm, node)
+            io_bytes = activation_bytes(gm, node) + sum(activation_bytes(gm, inp) for inp in node.all_input_nodes)
+
+            def estimate(a_bits, w_bits):
+                w_bytes = sum(p.numel() for p in m.parameters(recurse=False)) * w_bits / 8
+                return self.target.estimate(macs, io_bytes + w_bytes, a_bits, w_bits)
+
+            est = estimate(act_bits, weight_bits)
+            est['source'] = 'model'
+            lut = self.measured(node, m)
+            if lut is not None and (act_bits, weight_bits) in lut.keys():
+                est = {'compute' : None, 'memory' : None, 'total' : lut[(act_bits, weight_bits)], 'bound' : None, 'source' : 'lut'}
+            node.meta['latency_est'] = est
+
+            if macs > 0:
+                lat_dict = {(a, w) : estimate(a, w)['total'] for a, w in self.precisions}
+                if lut is not None:
+                    lat_dict.update(lut)
+                node.meta['latency'] = lat_dict
+                prec_nodes.append(node)
+
+            breakdown.append({'name' : node.target,
+                              'type' : type(m).__name__,
+                              'macs' : macs,
+                              'latency' : est['total'],
+                              'bound' : est['bound'],
+                              'source' : est['source']})
+
+        max_latency = max((max(n.meta['latency'].values()) for n in prec_nodes if len(n.meta['latency'])), default=0)
+        for n in prec_nodes:
+            n.meta['max_latency'] = max_latency
+
+        total = sum(b['latency'] for b in breakdown)
+        for b in breakdown:
+            b['share'] = b['latency'] / total if total > 0 else 0.
+        gm.latency_breakdown = sorted(breakdown, key=lambda b: -b['latency'])
+        gm.total_latency = total
+        return gm
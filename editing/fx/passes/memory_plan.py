@@ -0,0 +1,287 @@
+#
+# memory_plan.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import math
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+import torch
+from torch import fx
+
+from .pass_base import FxPass
+from ..util import module_of_node
+
+from quantlib.algorithms.pact.pact_ops import RequantShift
+
+__all__ = ['TensorAllocation',
+           'MemoryPlan',
+           'ActivationMemoryPlanPass',
+           'activation_bytes',
+           'memory_aware_schedule']
+
+_CONTAINER_BITS = [8, 16, 32, 64]
+
+def _n_levels_to_bits(n_levels):
+    if isinstance(n_levels, torch.Tensor):
+        n_levels = n_levels.max().item()
+    return max(int(math.ceil(math.log2(float(n_levels)))), 1)
+
+def _node_bits(gm : fx.GraphModule, node : fx.Node, default_bits : Optional[int]):
+    # returns (bits per element, signedness) of the node's output. The
+    # precision is taken from (in order of preference):
+    # - the configuration of RequantShift modules in integerized networks
+    # - the 'quant' annotation by AnnotateEpsPass
+    # - default_bits, if supplied
+    # - the element size of the tensor's dtype
+    if node.op == 'call_module':
+        m = module_of_node(gm, node)
+        if isinstance(m, RequantShift):
+            return _n_levels_to_bits(m.n_levels_out), bool(m.signed)
+    qi = node.meta.get('quant', None)
+    if qi is not None and qi.n_levels_out is not None:
+        return _n_levels_to_bits(qi.n_levels_out), None if qi.signed_out is None else bool(qi.signed_out)
+    if default_bits is not None:
+        return default_bits, None
+    return None, None
+
+def _tensor_metas(node : fx.Node):
+    # ShapeProp annotates multi-output nodes with (nested) tuples of
+    # TensorMetadata
+    def flatten(tm):
+        if hasattr(tm, 'shape'):
+            return [tm]
+        if isinstance(tm, (list, tuple)):
+            return [t for el in tm for t in flatten(el)]
+        if isinstance(tm, dict):
+            return [t for el in tm.values() for t in flatten(el)]
+        return []
+    return flatten(node.meta.get('tensor_meta', None))
+
+def activation_bytes(gm : fx.GraphModule, node : fx.Node, pack_bits : bool = False, default_bits : Optional[int] = None):
+    # number of bytes needed to store the output of `node`. If pack_bits is
+    # set, elements are assumed to be stored with exactly the number of bits
+    # they need; otherwise, every element takes up the smallest of 8, 16, 32
+    # or 64 bits which fits it.
+    if node.op in ['get_attr', 'output']:
+        # constants and parameters are not part of the activation memory
+        return 0
+    tms = _tensor_metas(node)
+    if len(tms) == 0:
+        return 0
+    bits, _ = _node_bits(gm, node, default_bits)
+    total = 0
+    for tm in tms:
+        numel = 1
+        for s in tm.shape:
+            numel *= s
+        if bits is None:
+            elem_bits = torch.empty((), dtype=tm.dtype).element_size() * 8
+        elif pack_bits:
+            elem_bits = bits
+        else:
+            elem_bits = next((c for c in _CONTAINER_BITS if c >= bits), bits)
+        total += int(math.ceil(numel * elem_bits / 8))
+    return total
+
+def _lifetimes(schedule : list, sizes : dict):
+    # the lifetime of a tensor spans from the step in which it is produced to
+    # the last step in which it is consumed (inclusive)
+    step = {n : i for i, n in enumerate(schedule)}
+    lifetimes = {}
+    for n in schedule:
+        if sizes.get(n, 0) == 0:
+            continue
+        end = max([step[u] for u in n.users if u in step.keys()], default=step[n])
+        lifetimes[n] = (step[n], end)
+    return lifetimes
+
+def _peak_live(n_steps : int, sizes : dict, lifetimes : dict):
+    # total size of the live tensors in each step and its maximum
+    delta = [0] * (n_steps + 1)
+    for n, (start, end) in lifetimes.items():
+        delta[start] += sizes[n]
+        delta[end+1] -= sizes[n]
+    live = []
+    cur = 0
+    for d in delta[:-1]:
+        cur += d
+        live.append(cur)
+    return max(live, default=0), live
+
+def memory_aware_schedule(gm : fx.GraphModule, sizes : dict):
+    # greedy topological ordering of the graph's nodes which tries to keep the
+    # working set small: among all nodes whose inputs have been computed,
+    # schedule the one which frees the most memory net of what it allocates.
+    # Ties are broken by the original graph order. Placeholders are kept at
+    # the start and the output node at the end.
+    nodes = list(gm.graph.nodes)
+    order = {n : i for i, n in enumerate(nodes)}
+    schedule = [n for n in nodes if n.op == 'placeholder']
+    done = set(schedule)
+    remaining_users = {n : len(n.users) for n in nodes}
+    n_missing = {n : len(set(n.all_input_nodes) - done) for n in nodes}
+    ready = {n for n in nodes if n not in done and n.op != 'output' and n_missing[n] == 0}
+    output_nodes = [n for n in nodes if n.op == 'output']
+
+    def gain(n):
+        # inputs of which n is the last unscheduled user die after n
+        freed = sum(sizes.get(inp, 0) for inp in n.all_input_nodes if remaining_users[inp] == 1)
+        return freed - sizes.get(n, 0)
+
+    while ready:
+        n = max(ready, key=lambda n: (gain(n), -order[n]))
+        ready.remove(n)
+        schedule.append(n)
+        done.add(n)
+        for inp in n.all_input_nodes:
+            remaining_users[inp] -= 1
+        for u in n.users:
+            n_missing[u] -= 1
+            if n_missing[u] == 0 and u.op != 'output' and u not in done:
+                ready.add(u)
+    return schedule + output_nodes
+
+def _plan_arena(allocations : list, alignment : int):
+    # greedy-by-size offset assignment: tensors are placed from largest to
+    # smallest at the lowest aligned offset which does not overlap with any
+    # already placed tensor whose lifetime overlaps.
+    placed = []
+    arena_size = 0
+    for a in sorted(allocations, key=lambda a: (-a.size, a.start)):
+        conflicts = sorted((p for p in placed if p.start <= a.end and a.start <= p.end), key=lambda p: p.offset)
+        offset = 0
+        for p in conflicts:
+            if offset + a.size <= p.offset:
+                break
+            offset = max(offset, int(math.ceil((p.offset + p.size) / alignment)) * alignment)
+        a.offset = offset
+        placed.append(a)
+        arena_size = max(arena_size, offset + a.size)
+    return arena_size
+
+@dataclass
+class TensorAllocation:
+    name : str
+    shape : list
+    bits : Optional[int]
+    signed : Optional[bool]
+    size : int
+    start : int
+    end : int
+    offset : int = -1
+
+@dataclass
+class MemoryPlan:
+    # schedule: node names in execution order
+    # peak_live: maximum total size of simultaneously live activations - a
+    #            lower bound for the arena size
+    # arena_size: size of the arena with the offsets in `allocations`
+    # alt_*: the same quantities for the memory-aware schedule (if computed)
+    schedule : list
+    allocations : list
+    peak_live : int
+    arena_size : int
+    alignment : int
+    alt_schedule : Optional[list] = None
+    alt_peak_live : Optional[int] = None
+    alt_arena_size : Optional[int] = None
+    live_bytes : list = field(default_factory=list)
+
+    @property
+    def schedule_savings(self):
+        # bytes of arena memory the memory-aware schedule would save
+        if self.alt_arena_size is None:
+            return 0
+        return self.arena_size - self.alt_arena_size
+
+    def to_dict(self):
+        d = asdict(self)
+        d['schedule_savings'] = self.schedule_savings
+        return d
+
+    def to_json(self, path : Optional[str] = None, **kwargs):
+        s = json.dumps(self.to_dict(), **kwargs)
+        if path is not None:
+            with open(path, 'w') as fh:
+                fh.write(s)
+        return s
+
+    def summary(self):
+        s = f"peak live activations: {self.peak_live} B, arena: {self.arena_size} B ({len(self.allocations)} tensors)"
+        if self.alt_arena_size is not None:
+            s += f"\nmemory-aware schedule: peak live {self.alt_peak_live} B, arena {self.alt_arena_size} B (saves {self.schedule_savings} B)"
+        return s
+
+class ActivationMemoryPlanPass(FxPass):
+    # static activation memory planning for a shape-annotated network (run
+    # ShapePropPass first; AnnotateEpsPass annotations are used to determine
+    # the precision of activations if present). For the graph's node order,
+    # this pass computes the byte size and lifetime of each activation, the
+    # peak working set and an offset-based arena allocation in which tensors
+    # with disjoint lifetimes share memory. The resulting MemoryPlan is
+    # stored in gm.memory_plan and nodes are annotated with 'act_bytes',
+    # 'lifetime' and 'arena_offset'.
+    # If alt_schedule is set, a memory-aware node order is planned as well
+    # so its savings can be reported - the graph itself is not reordered.
+    def __init__(self, alignment : int = 4, pack_bits : bool = False, default_bits : Optional[int] = None, alt_schedule : bool = True):
+        super(ActivationMemoryPlanPass, self).__init__()
+        assert alignment >= 1, f"ActivationMemoryPlanPass: alignment must be positive - got {alignment}"
+        self.alignment = alignment
+        self.pack_bits = pack_bits
+        self.default_bits = default_bits
+        self.alt_schedule = alt_schedule
+
+    def plan_schedule(self, gm : fx.GraphModule, schedule : list, sizes : dict):
+        lifetimes = _lifetimes(schedule, sizes)
+        allocations = {}
+        for n, (start, end) in lifetimes.items():
+            bits, signed = _node_bits(gm, n, self.default_bits)
+            shapes = [list(tm.shape) for tm in _tensor_metas(n)]
+            allocations[n] = TensorAllocation(name=n.name, shape=shapes[0] if len(shapes) == 1 else shapes, bits=bits, signed=signed, size=sizes[n], start=start, end=end)
+        peak, live = _peak_live(len(schedule), sizes, lifetimes)
+        arena_size = _plan_arena(list(allocations.values()), self.alignment)
+        return allocations, peak, arena_size, live
+
+    def run_pass(self, gm : fx.GraphModule):
+        sizes = {n : activation_bytes(gm, n, self.pack_bits, self.default_bits) for n in gm.graph.nodes}
+        schedule = list(gm.graph.nodes)
+        allocations, peak, arena_size, live = self.plan_schedule(gm, schedule, sizes)
+        plan = MemoryPlan(schedule=[n.name for n in schedule],
+                          allocations=list(allocations.values()),
+                          peak_live=peak,
+                          arena_size=arena_size,
+                          alignment=self.alignment,
+                          live_bytes=live)
+        if self.alt_schedule:
+            alt = memory_aware_schedule(gm, sizes)
+            _, alt_peak, alt_arena_size, _ = self.plan_schedule(gm, alt, sizes)
+            plan.alt_schedule = [n.name for n in alt]
+            plan.alt_peak_live = alt_peak
+            plan.alt_arena_size = alt_arena_size
+
+        for n in gm.graph.nodes:
+            n.meta['act_bytes'] = sizes[n]
+            if n in allocations.keys():
+                n.meta['lifetime'] = (allocations[n].start, allocations[n].end)
+                n.meta['arena_offset'] = allocations[n].offset
+        gm.memory_plan = plan
+        return gm
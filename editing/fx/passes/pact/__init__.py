@@ -2,3 +2,6 @@ from .integerize import *
 from .harmonize import *
 from .pact_util import *
 from .approximate import *
+from .cache import *
+from .integer_engine import *
+from .lut import *
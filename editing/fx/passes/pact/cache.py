@@ -0,0 +1,180 @@
+#
+# cache.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+import torch
+from torch import nn, fx
+
+from .pact_util import PACT_symbolic_trace
+from .integerize import IntegerizePACTNetPass
+
+__all__ = ['IntegerizationCache',
+           'integerization_key']
+
+# bump this whenever the integerization passes change in a way that affects
+# their output - this invalidates all existing cache entries.
+_CACHE_VERSION = 2
+
+# node annotations which are stored along with the GraphModule. GraphModules
+# are pickled as generated code, so all node.meta entries are lost otherwise.
+# Unpickling re-traces the code, which regenerates the node names - the
+# annotations are therefore stored by the nodes' positions in the graph.
+_CACHED_META = ['quant', 'tensor_meta', 'shape_in']
+
+def _hash_tensor(h, t : torch.Tensor):
+    t = t.detach().cpu().contiguous().reshape(-1)
+    h.update(f"{t.dtype}{tuple(t.shape)}".encode())
+    h.update(t.view(torch.uint8).numpy().tobytes())
+
+def _hash_value(h, v):
+    if isinstance(v, torch.Tensor):
+        _hash_tensor(h, v)
+    elif isinstance(v, dict):
+        for k in sorted(v.keys(), key=str):
+            h.update(str(k).encode())
+            _hash_value(h, v[k])
+    elif isinstance(v, (list, tuple)):
+        h.update(f"{type(v).__name__}{len(v)}".encode())
+        for el in v:
+            _hash_value(h, el)
+    else:
+        h.update(repr(v).encode())
+
+def _is_config_value(v):
+    if v is None or isinstance(v, (bool, int, float, str, torch.dtype)):
+        return True
+    if isinstance(v, (list, tuple)):
+        return all(_is_config_value(el) for el in v)
+    return False
+
+def integerization_key(net : nn.Module, **int_pass_kwargs):
+    # content hash of everything which determines the output of
+    # IntegerizePACTNetPass(**int_pass_kwargs)(PACT_symbolic_trace(net)):
+    # - the module hierarchy (types and configurations)
+    # - the state_dict
+    # - tensors and configuration values (bool/int/float/str, e.g., tqt,
+    #   rounding, cmsis_requant, export_node) which are stored as plain
+    #   attributes - many quantlib modules don't report them in extra_repr
+    # - the pass configuration, including shape_in and eps_in
+    h = hashlib.sha256()
+    h.update(f"v{_CACHE_VERSION} torch{torch.__version__}".encode())
+    for name, m in net.named_modules():
+        h.update(f"{name}:{type(m).__module__}.{type(m).__qualname__}({m.extra_repr()})".encode())
+        for k, v in sorted(vars(m).items()):
+            if k.startswith('_'):
+                continue
+            if isinstance(v, torch.Tensor):
+                h.update(f"{name}.{k}".encode())
+                _hash_tensor(h, v)
+            elif _is_config_value(v):
+                h.update(f"{name}.{k}".encode())
+                _hash_value(h, v)
+    for k, v in net.state_dict().items():
+        h.update(k.encode())
+        _hash_tensor(h, v)
+    _hash_value(h, int_pass_kwargs)
+    return h.hexdigest()
+
+def _target_repr(node : fx.Node):
+    # placeholder and output names are not stable across re-tracing
+    if node.op in ['placeholder', 'output']:
+        return None
+    return node.target if isinstance(node.target, str) else repr(node.target)
+
+def _torch_load(path):
+    # torch >= 2.6 defaults to weights_only loading, which can't restore
+    # GraphModules
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+class IntegerizationCache:
+    # on-disk cache of integerized networks. Entries are addressed by
+    # `integerization_key`, so a cached network is reused only if the
+    # original network, its parameters and the integerization settings are
+    # identical. Each entry stores the integerized GraphModule together with
+    # the node annotations listed in _CACHED_META.
+    def __init__(self, cache_dir : Union[str, Path], verbose : bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.verbose = verbose
+
+    def path(self, key : str):
+        return self.cache_dir.joinpath(f"{key}.pt")
+
+    def load(self, key : str):
+        p = self.path(key)
+        if not p.exists():
+            return None
+        try:
+            entry = _torch_load(str(p))
+        except Exception as e:
+            # corrupted or incompatible entry - treat it as a miss
+            if self.verbose:
+                print(f"IntegerizationCache: failed to load {p}: {e}")
+            return None
+        gm = entry['gm']
+        node_meta = entry['meta']
+        nodes = list(gm.graph.nodes)
+        if len(nodes) != len(node_meta) or any((n.op, _target_repr(n)) != ident for n, (ident, _) in zip(nodes, node_meta)):
+            # the re-traced graph does not match the stored one
+            if self.verbose:
+                print(f"IntegerizationCache: graph structure of {p} does not match its annotations")
+            return None
+        for node, (_, meta) in zip(nodes, node_meta):
+            node.meta.update(meta)
+        return gm
+
+    def store(self, key : str, gm : fx.GraphModule):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        node_meta = [((n.op, _target_repr(n)), {k : n.meta[k] for k in _CACHED_META if k in n.meta.keys()}) for n in gm.graph.nodes]
+        # write to a temporary file first so concurrent jobs never read a
+        # partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.cache_dir), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                torch.save({'gm' : gm, 'meta' : node_meta}, fh)
+            os.replace(tmp_path, str(self.path(key)))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def integerize(self, net : nn.Module, **int_pass_kwargs):
+        # drop-in replacement for
+        # IntegerizePACTNetPass(**int_pass_kwargs)(PACT_symbolic_trace(net))
+        key = integerization_key(net, **int_pass_kwargs)
+        gm = self.load(key)
+        if gm is not None:
+            if self.verbose:
+                print(f"IntegerizationCache: hit for key {key}")
+            return gm
+        if self.verbose:
+            print(f"IntegerizationCache: miss for key {key} - integerizing network")
+        int_pass = IntegerizePACTNetPass(**int_pass_kwargs)
+        gm = int_pass(PACT_symbolic_trace(net))
+        self.store(key, gm)
+        return gm
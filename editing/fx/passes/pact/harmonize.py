@@ -36,7 +36,7 @@ from quantlib.algorithms.generic.generic_ops import *
 
 from quantlib.algorithms.pact.pact_functions import AlmostSymmQuantFunc
 from .. import FxPass, SequentialPass, InsertModuleBetweenModulesPass, InsertModuleAfterNodePass,ReplaceSequentialPatternPass, AnnotateEpsPass
-from ...util import gm_modules, get_qualified_prefix, module_of_node
+from ...util import gm_modules, get_qualified_prefix, module_of_node, module_index, add_submodule
 from ...util.tracing import LeafTracer, custom_symbolic_trace
 
 
@@ -54,6 +54,8 @@ class OpTree:
     def __init__(self, end_node : fx.Node):
         self.end_node = end_node
         self.nodes = [end_node]
+        # for constant-time membership tests on large trees
+        self._node_set = {end_node}
         self.open_branches = len(end_node.all_input_nodes)
         assert self.open_branches > 0, "Tried to create OpTree with no branches - something is wrong!"
         # assume that order and assignment of args and kwargs does not matter
@@ -65,9 +67,10 @@ class OpTree:
         self.users = [u for u in end_node.users]
 
     def add_node(self, node : fx.Node):
-        assert node not in self.nodes, "OpTree.add_node(): something went wrong: you tried to add the same node to a tree twice..."
+        assert node not in self._node_set, "OpTree.add_node(): something went wrong: you tried to add the same node to a tree twice..."
         assert not self.is_terminated, "Tried to add a node to a terminated tree!"
         self.nodes.append(node)
+        self._node_set.add(node)
         # we assume that no node in our tree has more than 1 user
         self.open_branches += (len(node.all_input_nodes) - 1)
 
@@ -88,7 +91,7 @@ class OpTree:
         # tree, except those inputs which are tree nodes themselves.
 
         #SCHEREMO : This was some heavy monkey coding right here -- Why would you cast kwargs to their values? They could be reordered or whatever else!!!
-        all_args = [arg for node in self.nodes for arg in node._input_nodes.keys() if arg not in self.nodes] #+ [v for node in self.nodes for v in node.kwargs.values() if v not in self.nodes]
+        all_args = [arg for node in self.nodes for arg in node._input_nodes.keys() if arg not in self._node_set] #+ [v for node in self.nodes for v in node.kwargs.values() if v not in self.nodes]
         # in the case of concat nodes, the arguments are lists or tuples, so we
         # unpack them
         all_args_unpacked = []
@@ -115,38 +118,46 @@ class OpTreeReplacementPass(FxPass):
 
     @staticmethod
     def trace_op_trees(node : fx.Node, node_specs : list, cur_tree : Union[None, OpTree], op_trees : list, seen_nodes : set, always_terminate : bool = False):
-        if node in seen_nodes:
-            # if we have already seen this node, it is either already part of a
-            # tree or it will never be, so if we exited a tree, terminate the
-            # branch and return
-            if cur_tree is not None:
-                cur_tree.terminate_branch()
-                if cur_tree.is_terminated:
-                    op_trees.append(cur_tree)
-            return
-        seen_nodes.add(node)
-        if any(OpTreeReplacementPass.node_matches_spec(node, spec) for spec in node_specs):
-            # the current node belongs to a tree
-            if cur_tree is not None and (len(node.users) > 1 or always_terminate):
-                # there is a branch, so we need to cut the tree and start a new one
+        # depth-first walk upstream from `node`. This used to be implemented
+        # recursively, which overflows the stack on deep graphs; the explicit
+        # stack visits the nodes in exactly the same order, so the same trees
+        # are found. Each stack entry holds a node and the tree its user
+        # belongs to (or None).
+        stack = [(node, cur_tree)]
+        while stack:
+            node, cur_tree = stack.pop()
+            if node in seen_nodes:
+                # if we have already seen this node, it is either already part of a
+                # tree or it will never be, so if we exited a tree, terminate the
+                # branch
+                if cur_tree is not None:
+                    cur_tree.terminate_branch()
+                    if cur_tree.is_terminated:
+                        op_trees.append(cur_tree)
+                continue
+            seen_nodes.add(node)
+            if any(OpTreeReplacementPass.node_matches_spec(node, spec) for spec in node_specs):
+                # the current node belongs to a tree
+                if cur_tree is not None and (len(node.users) > 1 or always_terminate):
+                    # there is a branch, so we need to cut the tree and start a new one
+                    cur_tree.terminate_branch()
+                    if cur_tree.is_terminated:
+                        op_trees.append(cur_tree)
+                    cur_tree = OpTree(end_node=node)
+                elif cur_tree is None:
+                    cur_tree = OpTree(end_node=node)
+                else:
+                    cur_tree.add_node(node)
+            elif cur_tree is not None:
+                # we exited a tree => terminate this branch
                 cur_tree.terminate_branch()
                 if cur_tree.is_terminated:
                     op_trees.append(cur_tree)
-                cur_tree = OpTree(end_node=node)
-            elif cur_tree is None:
-                cur_tree = OpTree(end_node=node)
-            else:
-                cur_tree.add_node(node)
-        elif cur_tree is not None:
-            # we exited a tree => terminate this branch
-            cur_tree.terminate_branch()
-            if cur_tree.is_terminated:
-                op_trees.append(cur_tree)
-            cur_tree = None
+                cur_tree = None
 
-        # follow the graph upstream
-        for inp in node.all_input_nodes:
-            OpTreeReplacementPass.trace_op_trees(inp, node_specs, cur_tree, op_trees, seen_nodes, always_terminate)
+            # follow the graph upstream - push the inputs in reverse so they
+            # are popped in argument order
+            stack.extend((inp, cur_tree) for inp in reversed(node.all_input_nodes))
 
 
     def run_pass(self, gm : fx.GraphModule):
@@ -160,7 +171,7 @@ class OpTreeReplacementPass(FxPass):
             module = self.replacement_fn(gm, tree)
             if module is not None:
                 new_target = f"_QL_OP_TREE_REPLACE_{self.name.upper()}{'_' if self.name != '' else ''}{i}"
-                gm.add_submodule(new_target, module)
+                add_submodule(gm, new_target, module)
                 # add a node for the submodule call
                 with gm.graph.inserting_before(tree.end_node):
                     new_node = gm.graph.call_module(new_target, args=tree.args)
@@ -371,7 +382,7 @@ class InsertActivationsAfterLinearsPass(SequentialPass):
 
         passes = []
 
-        modules = dict(gm.named_modules())
+        modules = gm_modules(gm)
         output_node = list(gm.graph.nodes.__reversed__())[0]
         node_list = self.find_unactivated_linops(output_node, modules, self.before_modules , self.activation_nodes, outputQuant=True)
 
@@ -556,7 +567,7 @@ class RQSMergePass(SequentialPass):
 
 def apply_wrap_module_fun(node, _pass, _tracer):
 
-    module = dict(node.graph._owning_module.named_modules())[node.target]
+    module = module_index(node.graph._owning_module)[node.target]
 
     cloneModule = copy.deepcopy(module.module)
     fx_graph = _tracer.trace(cloneModule)
@@ -580,7 +591,7 @@ def integerize_wrap_module_fun(node, _pass, _tracer, _shape_fun: lambda node: no
     shape_in = node.meta['shape_in']
     eps_in = node.meta['quant'].eps_in[0]
     runnablePass = _pass(shape_in, eps_in)
-    module = dict(node.graph._owning_module.named_modules())[node.target]
+    module = module_index(node.graph._owning_module)[node.target]
 
     cloneModule = copy.deepcopy(module.module)
     fx_graph = _tracer.trace(cloneModule)
@@ -597,7 +608,7 @@ class IntegerizeWrapModule(ModularizePass):
         super().__init__(op='call_module', target=tuple(pattern), replacement_fn = partial(integerize_wrap_module_fun, _pass=_pass, _tracer=tracer, _shape_fun=shape_fun), name=f"APPLY_TO_WRAP_PASS_{name}")
 
 def wrap_module_fun(node, n_levels, quantize, **actArgs):
-    module = dict(node.graph._owning_module.named_modules())[node.target]
+    module = module_index(node.graph._owning_module)[node.target]
     returnNode = PACTWrapModule(module, n_levels, module.__dict__, quantize = quantize, **actArgs)
     return returnNode, node.args, node.kwargs
 
@@ -0,0 +1,133 @@
+#
+# harmonize_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import operator
+import sys
+import unittest
+from unittest import TestCase
+
+import torch
+from torch import nn, fx
+
+from quantlib.editing.fx.passes.pact.harmonize import OpTree, OpTreeReplacementPass, AddTreeReplacementPass, MulReplacementPass
+
+
+def _trace_op_trees_recursive(node, node_specs, cur_tree, op_trees, seen_nodes, always_terminate=False):
+    # reference: OpTreeReplacementPass.trace_op_trees before the recursion was
+    # replaced by an explicit stack
+    if node in seen_nodes:
+        if cur_tree is not None:
+            cur_tree.terminate_branch()
+            if cur_tree.is_terminated:
+                op_trees.append(cur_tree)
+        return
+    seen_nodes.add(node)
+    if any(OpTreeReplacementPass.node_matches_spec(node, spec) for spec in node_specs):
+        if cur_tree is not None and (len(node.users) > 1 or always_terminate):
+            cur_tree.terminate_branch()
+            if cur_tree.is_terminated:
+                op_trees.append(cur_tree)
+            cur_tree = OpTree(end_node=node)
+        elif cur_tree is None:
+            cur_tree = OpTree(end_node=node)
+        else:
+            cur_tree.add_node(node)
+    elif cur_tree is not None:
+        cur_tree.terminate_branch()
+        if cur_tree.is_terminated:
+            op_trees.append(cur_tree)
+        cur_tree = None
+
+    for inp in node.all_input_nodes:
+        _trace_op_trees_recursive(inp, node_specs, cur_tree, op_trees, seen_nodes, always_terminate)
+
+def _trees(trace_fn, gm : fx.GraphModule, node_specs : list, always_terminate : bool = False):
+    op_trees = []
+    trace_fn(list(gm.graph.nodes)[-1], node_specs, None, op_trees, set(), always_terminate)
+    return [([n.name for n in t.nodes], [a.name if isinstance(a, fx.Node) else a for a in t.args]) for t in op_trees]
+
+
+class SharedAdder(nn.Module):
+    # add trees with shared intermediate results, constants and muls
+    def __init__(self):
+        super(SharedAdder, self).__init__()
+        self.conv1 = nn.Conv1d(1, 1, 4)
+        self.conv2 = nn.Conv1d(1, 1, 4)
+        self.conv3 = nn.Conv1d(1, 1, 4)
+        self.conv4 = nn.Conv1d(1, 1, 4)
+
+    def forward(self, x):
+        x1 = self.conv1(x)
+        x2 = self.conv2(x)
+        x3 = self.conv3(x)
+        x4 = self.conv4(x)
+        y1 = x1 + x2
+        y2 = y1 + x3
+        y3 = (y1 + x4) * x1
+        y3 = y3 + 1.3
+        y4 = torch.add(y1, y2 * y3)
+        return y4.add(y3 * x2) * y2
+
+def _deep_graph(depth : int, relu_every : int = 0):
+    # a chain of `depth` adds, each of which adds the input to the running
+    # sum, optionally cut into trees by ReLUs
+    g = fx.Graph()
+    x = g.placeholder('x')
+    y = x
+    for i in range(depth):
+        y = g.call_function(operator.add, (y, x))
+        if relu_every and (i+1) % relu_every == 0:
+            y = g.call_function(torch.relu, (y,))
+    g.output(y)
+    return fx.GraphModule(nn.Module(), g)
+
+
+class TestTraceOpTrees(TestCase):
+
+    def test_matches_recursive(self):
+        gm = fx.symbolic_trace(SharedAdder())
+        for specs in [AddTreeReplacementPass.add_node_specs, MulReplacementPass.mul_node_specs, AddTreeReplacementPass.add_node_specs + MulReplacementPass.mul_node_specs]:
+            for always_terminate in [False, True]:
+                ref = _trees(_trace_op_trees_recursive, gm, specs, always_terminate)
+                self.assertEqual(_trees(OpTreeReplacementPass.trace_op_trees, gm, specs, always_terminate), ref)
+
+    def test_matches_recursive_chain(self):
+        # shallow enough for the recursive version
+        for relu_every in [0, 1, 7]:
+            gm = _deep_graph(200, relu_every)
+            specs = AddTreeReplacementPass.add_node_specs
+            self.assertEqual(_trees(OpTreeReplacementPass.trace_op_trees, gm, specs), _trees(_trace_op_trees_recursive, gm, specs))
+
+    def test_deep(self):
+        depth = 3 * sys.getrecursionlimit()
+        gm = _deep_graph(depth)
+        trees = _trees(OpTreeReplacementPass.trace_op_trees, gm, AddTreeReplacementPass.add_node_specs)
+        # a single tree containing all the adds
+        self.assertEqual(len(trees), 1)
+        self.assertEqual(len(trees[0][0]), depth)
+        gm = _deep_graph(depth, relu_every=3)
+        trees = _trees(OpTreeReplacementPass.trace_op_trees, gm, AddTreeReplacementPass.add_node_specs)
+        # the innermost trees are terminated first
+        self.assertEqual([len(t[0]) for t in trees], [3] * (depth//3))
+
+
+if __name__ == '__main__':
+    unittest.main()
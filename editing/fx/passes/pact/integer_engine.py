@@ -0,0 +1,434 @@
+#
+# integer_engine.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import operator
+
+import torch
+from torch import nn, fx
+from torch.nn import functional as F
+
+from quantlib.algorithms.pact.pact_ops import RequantShift, PACTIntegerSoftmax, PACTIntegerGELU, PACTIntegerLayerNorm, PACTIntegerITAMax
+
+__all__ = ['IntegerInterpreter',
+           'register_integer_kernel']
+
+# Execution engine for integerized networks. The float64 reference (i.e.,
+# running the integerized GraphModule on float64 tensors) is the ground
+# truth: every kernel in this file either provably computes the same result
+# with integer arithmetic or returns None, in which case the node is
+# executed with the float64 reference implementation.
+#
+# Activations are kept in the smallest integer dtype which fits their range
+# (int8/uint8/int16/int32/int64) while they are integer-valued. Values which
+# are not (e.g., the output of an average pooling layer) are kept in
+# float64.
+
+# {module type : kernel(engine, module, *args, **kwargs) -> result or None}
+_INTEGER_KERNELS = {}
+
+def register_integer_kernel(module_type : type, kernel : callable):
+    # lookup is by exact type - subclasses usually have different forward
+    # semantics
+    _INTEGER_KERNELS[module_type] = kernel
+
+# largest magnitude up to which float32/float64 represent all integers
+# exactly
+_FP32_EXACT = 2**24
+_FP64_EXACT = 2**53
+
+_INT_DTYPES = [torch.int8, torch.uint8, torch.int16, torch.int32, torch.int64]
+
+def _is_int(x):
+    return isinstance(x, torch.Tensor) and not x.is_floating_point() and not x.is_complex() and x.dtype != torch.bool
+
+def _compact(t : torch.Tensor):
+    # store an integer tensor in the smallest dtype which fits it
+    if t.numel() == 0:
+        return t
+    lo, hi = t.aminmax()
+    lo, hi = lo.item(), hi.item()
+    for dt in _INT_DTYPES:
+        info = torch.iinfo(dt)
+        if info.min <= lo and hi <= info.max:
+            return t.to(dt)
+    return t
+
+def _to_float(x):
+    if _is_int(x):
+        return x.to(torch.float64)
+    if type(x) in (list, tuple):
+        return type(x)(_to_float(el) for el in x)
+    if isinstance(x, dict):
+        return {k : _to_float(v) for k, v in x.items()}
+    return x
+
+def _from_float(x):
+    # convert integer-valued float tensors to integer tensors
+    if isinstance(x, torch.Tensor) and x.is_floating_point() and x.numel() > 0:
+        if x.dtype != torch.float64:
+            return x
+        if not (torch.isfinite(x).all() and torch.equal(x, torch.floor(x))):
+            return x
+        if x.abs().max().item() > _FP64_EXACT:
+            return x
+        return _compact(x.to(torch.int64))
+    if type(x) in (list, tuple):
+        return type(x)(_from_float(el) for el in x)
+    if isinstance(x, dict):
+        return {k : _from_float(v) for k, v in x.items()}
+    return x
+
+def _int_valued(t : torch.Tensor):
+    return bool(torch.isfinite(t).all() and torch.equal(t, torch.floor(t)))
+
+def _abs_max(t : torch.Tensor):
+    # abs() of the minimum of a signed dtype overflows - go through aminmax
+    lo, hi = t.aminmax()
+    return max(abs(lo.item()), abs(hi.item()))
+
+def _log2_int(v):
+    # exact log2 of positive powers of 2, None otherwise
+    v = int(v)
+    return v.bit_length() - 1 if v > 0 and v & (v - 1) == 0 else None
+
+# functions and methods which only move data around and therefore work on
+# integer tensors as they are
+_DATA_MOVEMENT_FUNCTIONS = {operator.getitem, torch.flatten, torch.reshape, torch.cat, torch.stack,
+                            torch.transpose, torch.permute, torch.squeeze, torch.unsqueeze,
+                            torch.split, torch.chunk, getattr}
+_DATA_MOVEMENT_METHODS = {'view', 'reshape', 'flatten', 'permute', 'transpose', 'contiguous', 'squeeze',
+                          'unsqueeze', 'size', 'dim', 'chunk', 'split', 'expand', 'repeat', 'clone'}
+# integer-closed arithmetic - executed in int64
+_INT_ARITH_FUNCTIONS = {operator.add, operator.sub, operator.mul, operator.neg, torch.add, torch.sub, torch.mul}
+_INT_ARITH_METHODS = {'add', 'sub', 'mul', 'neg'}
+
+def _all_int_args(args, kwargs):
+    vals = list(args) + list(kwargs.values())
+    return all(_is_int(a) or isinstance(a, int) for a in vals) and any(_is_int(a) for a in vals)
+
+def _long(x):
+    return x.to(torch.int64) if _is_int(x) else x
+
+
+class IntegerInterpreter(fx.Interpreter):
+    # Runs an integerized GraphModule with integer kernels. The outputs are
+    # bit-identical to running the GraphModule on float64 inputs and are
+    # returned as float64 tensors. Like the float64 reference, the
+    # GraphModule is converted to float64 in place - the non-integer parts of
+    # the network are executed with it.
+    # Forward hooks and pre-hooks registered on modules are called with
+    # float64 tensors, so activation dumping hooks work as with the
+    # reference.
+    def __init__(self, gm : fx.GraphModule):
+        gm.to(dtype=torch.float64)
+        super(IntegerInterpreter, self).__init__(gm)
+        self._params = {}
+
+    def reset_cache(self):
+        # call this if the parameters of the GraphModule are modified
+        self._params = {}
+
+    def params(self, m : nn.Module, fn : callable):
+        # integer parameters of a module, derived by `fn` once
+        key = id(m)
+        if key not in self._params.keys():
+            self._params[key] = (m, fn(m))
+        return self._params[key][1]
+
+    def run(self, *args, **kwargs):
+        args = [_from_float(a.to(torch.float64)) if isinstance(a, torch.Tensor) else a for a in args]
+        with torch.no_grad():
+            out = super(IntegerInterpreter, self).run(*args, **kwargs)
+        return _to_float(out)
+
+    def call_module(self, target, args, kwargs):
+        return self.call_kernel(self.fetch_attr(target), args, kwargs)
+
+    def call_kernel(self, m : nn.Module, args, kwargs=None):
+        # execute a module with its integer kernel, if there is one - kernels
+        # can use this to call submodules
+        kwargs = {} if kwargs is None else kwargs
+        kernel = _INTEGER_KERNELS.get(type(m), None)
+        if kernel is None:
+            # hooks are called by nn.Module.__call__
+            return _from_float(m(*_to_float(args), **_to_float(kwargs)))
+
+        if len(m._forward_pre_hooks):
+            fargs = _to_float(tuple(args))
+            for hook in m._forward_pre_hooks.values():
+                res = hook(m, fargs)
+                if res is not None:
+                    fargs = res if isinstance(res, tuple) else (res,)
+            args = _from_float(fargs)
+
+        out = kernel(self, m, *args, **kwargs)
+        if out is None:
+            out = _from_float(m.forward(*_to_float(args), **_to_float(kwargs)))
+
+        if len(m._forward_hooks):
+            fargs = _to_float(tuple(args))
+            fout = _to_float(out)
+            for hook in m._forward_hooks.values():
+                res = hook(m, fargs, fout)
+                if res is not None:
+                    fout = res
+                    out = _from_float(res)
+        return out
+
+    def call_function(self, target, args, kwargs):
+        if target in _DATA_MOVEMENT_FUNCTIONS:
+            return target(*args, **kwargs)
+        if target in _INT_ARITH_FUNCTIONS and _all_int_args(args, kwargs):
+            return _compact(target(*[_long(a) for a in args], **{k : _long(v) for k, v in kwargs.items()}))
+        return _from_float(target(*_to_float(args), **_to_float(kwargs)))
+
+    def call_method(self, target, args, kwargs):
+        if target in _DATA_MOVEMENT_METHODS:
+            return super(IntegerInterpreter, self).call_method(target, args, kwargs)
+        if target in _INT_ARITH_METHODS and _all_int_args(args, kwargs):
+            return _compact(super(IntegerInterpreter, self).call_method(target, [_long(a) for a in args], {k : _long(v) for k, v in kwargs.items()}))
+        return _from_float(super(IntegerInterpreter, self).call_method(target, _to_float(args), _to_float(kwargs)))
+
+
+# conv/linear: PyTorch has no integer convolution kernels, but floating
+# point convolutions are exact as long as all partial sums are integers
+# which the format represents exactly. float32 is used whenever
+# max|x| * max_c(sum|w_c|) + max|b| < 2**24 (on CPU - GPU convolutions may
+# use TF32 or transform-based algorithms), float64 otherwise.
+def _linop_params(m : nn.Module):
+    w = m.weight.detach().to(torch.float64)
+    b = None if m.bias is None else m.bias.detach().to(torch.float64)
+    if not _int_valued(w) or (b is not None and not _int_valued(b)):
+        return None
+    w_sum = w.abs().reshape(w.shape[0], -1).sum(dim=1).max().item()
+    b_max = 0 if b is None else b.abs().max().item()
+    return {'w64' : w, 'b64' : b, 'w32' : w.float(), 'b32' : None if b is None else b.float(), 'w_sum' : w_sum, 'b_max' : b_max}
+
+def _linop_kernel(engine : IntegerInterpreter, m : nn.Module, x):
+    if not _is_int(x) or getattr(m, 'padding_mode', 'zeros') != 'zeros':
+        return None
+    p = engine.params(m, _linop_params)
+    if p is None:
+        return None
+    bound = _abs_max(x) * p['w_sum'] + p['b_max']
+    if bound >= _FP64_EXACT:
+        return None
+    if bound < _FP32_EXACT and x.device.type == 'cpu':
+        xf, w, b = x.to(torch.float32), p['w32'], p['b32']
+    else:
+        xf, w, b = x.to(torch.float64), p['w64'], p['b64']
+    if isinstance(m, nn.Linear):
+        y = F.linear(xf, w, b)
+    else:
+        conv = F.conv1d if isinstance(m, nn.Conv1d) else F.conv2d
+        y = conv(xf, w, b, m.stride, m.padding, m.dilation, m.groups)
+    return y.to(torch.int32 if bound < 2**31 else torch.int64)
+
+for _t in [nn.Conv1d, nn.Conv2d, nn.Linear]:
+    register_integer_kernel(_t, _linop_kernel)
+
+
+# RequantShift: y = clip(floor((x * mul + add) / div + 0.5)). With integer
+# mul/add and a power-of-2 div, this is (x * mul + add + div/2) >> log2(div).
+def _requant_is_identity(mul, add, div, x_dim):
+    if mul.dim() == 1:
+        mul = mul.reshape([-1]+[1]*(x_dim-2))
+    if add.dim() == 1:
+        add = add.reshape([-1]+[1]*(x_dim-2))
+    return torch.equal(mul, div) and torch.equal(add, torch.zeros((1,), dtype=add.dtype))
+
+def _requant_params(m : RequantShift):
+    mul = m.mul.detach().to(torch.float64)
+    add = m.add.detach().to(torch.float64)
+    div = m.div.detach().to(torch.float64)
+    if div.numel() != 1 or not _int_valued(div) or _log2_int(div.item()) is None:
+        return None
+    # the reference returns its input unchanged if mul == div and add == 0,
+    # which depends on the shapes of the (reshaped) parameters
+    identity = lambda x_dim, mul=mul, add=add, div=div: _requant_is_identity(mul, add, div, x_dim)
+    if m.cmsis_requant:
+        # the reference rounds add/mul in floating point
+        add = torch.floor(add / mul + 0.5)
+    if not _int_valued(mul) or not _int_valued(add):
+        return None
+    n_levels = m.n_levels_out.item()
+    if m.signed:
+        c = round(n_levels / 2. + 0.001)
+        lo, hi = -c, c - 1
+    else:
+        lo, hi = 0, int(n_levels) - 1
+    return {'mul' : mul.long(), 'add' : add.long(), 'shift' : _log2_int(div.item()), 'lo' : lo, 'hi' : hi, 'identity' : identity}
+
+def _requant_kernel(engine : IntegerInterpreter, m : RequantShift, x):
+    if not _is_int(x):
+        return None
+    p = engine.params(m, _requant_params)
+    if p is None:
+        return None
+    if p['identity'](x.dim()):
+        return x
+    mul, add = p['mul'], p['add']
+    if mul.dim() == 1:
+        mul = mul.reshape([-1]+[1]*(x.dim()-2))
+    if add.dim() == 1:
+        add = add.reshape([-1]+[1]*(x.dim()-2))
+    x = x.to(torch.int64)
+    y = (x + add) * mul if m.cmsis_requant else x * mul + add
+    if p['shift'] > 0:
+        y = (y + 2**(p['shift']-1)) >> p['shift']
+    return _compact(torch.clamp(y, p['lo'], p['hi']))
+
+register_integer_kernel(RequantShift, _requant_kernel)
+
+
+# I-BERT softmax: all floating point divisions in the reference are exact
+# floor divisions of integers (or divisions by powers of 2)
+def _softmax_params(m : PACTIntegerSoftmax):
+    vals = [m.log2, m.coeffA, m.coeffB, m.coeffC, m.n_levels, m.zero]
+    if not all(_int_valued(v.to(torch.float64)) for v in vals):
+        return None
+    return [int(v.item()) for v in vals]
+
+def _softmax_kernel(engine : IntegerInterpreter, m : PACTIntegerSoftmax, x):
+    if not _is_int(x):
+        return None
+    p = engine.params(m, _softmax_params)
+    if p is None:
+        return None
+    log2, A, B, C, n_levels, zero = p
+    x = x.to(torch.int64)
+    x_tilde = x - torch.max(x, dim=-1, keepdim=True)[0]
+    z = torch.div(-x_tilde, log2, rounding_mode='floor')
+    q = x_tilde + z * log2
+    num = A * (q + B)**2 + C
+    if _abs_max(num) >= _FP64_EXACT:
+        return None
+    # floor division by 2**z; for z >= 63 this is 0 or -1, just like the
+    # arithmetic shift
+    y = num >> torch.clamp(z, max=63)
+    y_sum = torch.sum(y, -1, keepdim=True)
+    if not bool((y_sum > 0).all()) or _abs_max(y) * (n_levels - 1) >= _FP64_EXACT // 2 or _abs_max(y_sum) >= _FP64_EXACT:
+        # the reference's division would not be exact
+        return None
+    norm = torch.div(y * (n_levels - 1), y_sum, rounding_mode='floor')
+    return _compact(torch.clamp(norm, zero, n_levels - 1))
+
+register_integer_kernel(PACTIntegerSoftmax, _softmax_kernel)
+
+
+def _gelu_params(m : PACTIntegerGELU):
+    if not (_int_valued(m.b.to(torch.float64)) and _int_valued(m.one.to(torch.float64))):
+        return None
+    return int(m.b.item()), int(m.one.item())
+
+def _gelu_kernel(engine : IntegerInterpreter, m : PACTIntegerGELU, x):
+    if not _is_int(x):
+        return None
+    p = engine.params(m, _gelu_params)
+    if p is None:
+        return None
+    b, one = p
+    x = x.to(torch.int64)
+    L = torch.sign(x) * (-(torch.clamp(torch.abs(x), max=-b) + b)**2 + one)
+    h = torch.div(one + L, 2, rounding_mode='floor')
+    if _abs_max(x) * _abs_max(h) >= _FP64_EXACT:
+        # the reference's product would not be exact
+        return None
+    return _compact(x * h)
+
+register_integer_kernel(PACTIntegerGELU, _gelu_kernel)
+
+
+def _layernorm_params(m : PACTIntegerLayerNorm):
+    w = m.weight.detach().to(torch.float64)
+    b = m.bias.detach().to(torch.float64)
+    D = m.D.to(torch.float64)
+    if not (_int_valued(w) and _int_valued(b) and _int_valued(D)):
+        return None
+    n_levels = int(m.n_levels.item())
+    return {'w' : w.long(), 'b' : b.long(), 'D' : int(D.item()), 'lo' : -n_levels//2, 'hi' : n_levels//2-1}
+
+def _layernorm_kernel(engine : IntegerInterpreter, m : PACTIntegerLayerNorm, x):
+    if not _is_int(x):
+        return None
+    p = engine.params(m, _layernorm_params)
+    if p is None:
+        return None
+    if _abs_max(x) >= _FP32_EXACT:
+        # the reference rounds the mean to float32
+        return None
+    x = x.to(torch.int64)
+    N = x.shape[-1]
+    # the reference truncates the mean with .int()
+    nom = x - torch.div(torch.sum(x, -1, keepdim=True), N, rounding_mode='trunc')
+    sq_sum = torch.sum(nom**2, -1, keepdim=True)
+    if _abs_max(sq_sum) >= _FP64_EXACT:
+        # the reference's sum of squares would not be exact
+        return None
+    msq = torch.div(sq_sum, N, rounding_mode='floor')
+    # square root exactly as in the reference
+    denom = torch.floor(torch.sqrt((msq + 1).to(torch.float64))).to(torch.int64)
+    nom = nom * p['w']
+    if _abs_max(nom) >= _FP64_EXACT:
+        return None
+    y = torch.div(nom, denom, rounding_mode='trunc')
+    # the reference casts to int32 and then rounds to float32 with
+    # .int().float()
+    if _abs_max(y) > 2**31 - 1:
+        return None
+    y = y.to(torch.float32).to(torch.int64)
+    y = torch.div(y + p['b'], p['D'], rounding_mode='floor')
+    return _compact(torch.clamp(y, p['lo'], p['hi']))
+
+register_integer_kernel(PACTIntegerLayerNorm, _layernorm_kernel)
+
+
+# ITAMax: with n_levels = 2**B and B a power of 2, eps_max = B/2**B is a
+# power of 2, so shift = floor(diff * eps_max + 0.5) is an integer rounding
+# shift and all other operations are integer floor divisions.
+def _itamax_params(m : PACTIntegerITAMax):
+    n_levels = m.n_levels.item()
+    B = _log2_int(n_levels)
+    if B is None or _log2_int(B) is None or B - _log2_int(B) < 1:
+        return None
+    return {'n_levels' : int(n_levels), 'B' : B, 's' : B - _log2_int(B)}
+
+def _itamax_kernel(engine : IntegerInterpreter, m : PACTIntegerITAMax, x):
+    x = engine.call_kernel(m.rq, (x,))
+    p = engine.params(m, _itamax_params)
+    if not _is_int(x) or p is None or x.dim() != 4 or x.shape[-1] != x.shape[-2]:
+        return _from_float(m.MySoftmax.forward(None, _to_float(x), m.n_levels.to(torch.float64)))
+    lo, hi = x.aminmax()
+    if lo.item() < -128 or hi.item() > 127:
+        # the reference casts the row maxima to int8
+        return _from_float(m.MySoftmax.forward(None, _to_float(x), m.n_levels.to(torch.float64)))
+    n, s = p['n_levels'], p['s']
+    x = x.to(torch.int64)
+    diff = torch.max(x, dim=-1, keepdim=True)[0] - x
+    shift = (diff + 2**(s-1)) >> s
+    if shift.max().item() > p['B']:
+        # n_levels / 2**shift would not be an integer
+        return _from_float(m.MySoftmax.forward(None, _to_float(x), m.n_levels.to(torch.float64)))
+    exp_sum = torch.sum(torch.full_like(shift, n) >> shift, dim=-1, keepdim=True)
+    exp_sum_inverse = torch.div(n * (n-1), exp_sum, rounding_mode='floor')
+    return _compact(exp_sum_inverse >> shift)
+
+register_integer_kernel(PACTIntegerITAMax, _itamax_kernel)
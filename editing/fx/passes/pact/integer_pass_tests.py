@@ -0,0 +1,357 @@
+#
+# integer_pass_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Bit-exactness tests for the integer kernels and passes operating on
+# integerized networks. The float64 reference (gm.double()) is the ground
+# truth the exporters write as golden model.
+
+import copy
+import tempfile
+import unittest
+from unittest import TestCase
+
+import torch
+from torch import nn, fx
+
+from quantlib.algorithms.pact.pact_ops import *
+from quantlib.algorithms.pact.pact_controllers import PACTActController, PACTLinearController
+from quantlib.editing.fx.passes.pact.pact_util import PACT_symbolic_trace
+from quantlib.editing.fx.passes.pact import integer_engine
+from quantlib.editing.fx.passes.pact.integer_engine import IntegerInterpreter
+from quantlib.editing.fx.passes.pact.cache import IntegerizationCache, integerization_key
+from quantlib.editing.fx.passes.pact.lut import CompileLUTPass
+from quantlib.editing.fx.passes.pact.integerize import IntegerizePACTNetPass
+from quantlib.editing.fx.passes.eps import QuantInfo
+from quantlib.editing.fx.passes.general import ShapePropPass
+
+
+class IntegerBlock(nn.Module):
+    # LayerNorm -> GELU -> RequantShift -> Softmax, as produced by
+    # IntegerizePACTNetPass for a transformer block
+    def __init__(self, C : int = 16, D_ln : int = 2**24):
+        super(IntegerBlock, self).__init__()
+        self.ln = PACTIntegerLayerNorm(n_levels=256, eps_in=1./32, maxval=4., weight=torch.rand(C)+0.5, bias=torch.randn(C)*0.5, D=D_ln)
+        self.gelu = PACTIntegerGELU(eps_in=torch.Tensor((1./32,)), D=2**14)
+        self.rq = RequantShift(mul=torch.Tensor((37.,)), add=torch.Tensor((2.**9,)), n_levels=256, signed=True, D=torch.Tensor((2.**10,)))
+        self.softmax = PACTIntegerSoftmax(n_levels=256, eps_in=torch.Tensor((1./16,)))
+
+    def forward(self, x):
+        x = self.ln(x)
+        x = self.gelu(x)
+        x = self.rq(x)
+        return self.softmax(x)
+
+
+def _int_input(*shape, lo=-128, hi=128):
+    return torch.randint(lo, hi, shape).to(torch.float64)
+
+
+class TestIntegerInterpreter(TestCase):
+
+    def test_bit_exact(self):
+        torch.manual_seed(0)
+        for D_ln in [2**12, 2**24]:
+            gm = PACT_symbolic_trace(IntegerBlock(D_ln=D_ln))
+            ref = copy.deepcopy(gm).double()
+            engine = IntegerInterpreter(copy.deepcopy(gm))
+            for _ in range(8):
+                x = _int_input(4, 8, 16)
+                self.assertTrue(torch.equal(engine.run(x), ref(x)))
+
+    def test_layernorm_rounding(self):
+        # large D makes |y| exceed 2**24 before the reference rounds it to
+        # float32
+        torch.manual_seed(1)
+        ln = PACTIntegerLayerNorm(n_levels=256, eps_in=1./32, maxval=1., weight=torch.rand(64)+0.5, bias=torch.randn(64), D=2**24)
+        gm = PACT_symbolic_trace(nn.Sequential(ln))
+        ref = copy.deepcopy(gm).double()
+        engine = IntegerInterpreter(copy.deepcopy(gm))
+        x = _int_input(32, 64)
+        self.assertTrue(torch.equal(engine.run(x), ref(x)))
+
+    def _check_fallback(self, m : nn.Module, x : torch.Tensor):
+        # the integer kernel must refuse x and the interpreter fall back to
+        # the reference
+        gm = PACT_symbolic_trace(nn.Sequential(m))
+        ref = copy.deepcopy(gm).double()
+        engine = IntegerInterpreter(copy.deepcopy(gm))
+        m = engine.fetch_attr('0')
+        self.assertIsNone(integer_engine._INTEGER_KERNELS[type(m)](engine, m, x.to(torch.int64)))
+        self.assertTrue(torch.equal(engine.run(x), ref(x)))
+
+    def test_layernorm_inexact_sum(self):
+        # |x| < 2**24, but the sum of squares exceeds 2**53
+        ln = PACTIntegerLayerNorm(n_levels=256, eps_in=1./32, maxval=1., weight=torch.ones(64), bias=torch.zeros(64), D=2**12)
+        x = torch.Tensor([2**24 - 1, -(2**24 - 1)]).repeat(4, 32).to(torch.float64)
+        self._check_fallback(ln, x)
+
+    def test_gelu_inexact_product(self):
+        gelu = PACTIntegerGELU(eps_in=torch.Tensor((1./32,)), D=2**14)
+        x = _int_input(4, 16, lo=-2**45, hi=2**45)
+        self._check_fallback(gelu, x)
+
+
+class TestRequantShift(TestCase):
+
+    @staticmethod
+    def requant(**kwargs):
+        return RequantShift(mul=torch.Tensor((37.,)), add=torch.Tensor((2.**9,)), n_levels=256, signed=True, D=torch.Tensor((2.**10,)), shift_path=True, **kwargs)
+
+    def test_non_integer_input(self):
+        # the shift path must not truncate fractional inputs
+        torch.manual_seed(3)
+        rq = self.requant()
+        x = torch.randn(16, 32).double() * 100
+        ref = RequantShift.MyRequantShift.forward(None, x, rq.mul.double(), rq.add.double(), rq.div.double(), rq.signed, rq.n_levels_out.double(), rq.cmsis_requant)
+        self.assertTrue(torch.equal(rq(x), ref))
+
+    def test_config_changes(self):
+        # the cached clipping range must follow n_levels_out and signed
+        torch.manual_seed(4)
+        rq = self.requant()
+        x = _int_input(16, 32, lo=-2**12, hi=2**12)
+        rq(x)
+        for n_levels, signed in [(16, True), (16, False), (256, False)]:
+            rq.n_levels_out = torch.Tensor((n_levels,))
+            rq.signed = signed
+            ref = RequantShift.MyRequantShift.forward(None, x, rq.mul.double(), rq.add.double(), rq.div.double(), signed, rq.n_levels_out.double(), rq.cmsis_requant)
+            self.assertTrue(torch.equal(rq(x), ref))
+
+
+class TestSoftmaxKernel(TestCase):
+
+    @staticmethod
+    def reference(sm : PACTIntegerSoftmax, x : torch.Tensor):
+        return PACTIntegerSoftmax.MySoftmax.forward(None, x, sm.log2.type_as(x), sm.coeffA.type_as(x), sm.coeffB.type_as(x), sm.coeffC.type_as(x), sm.n_levels.type_as(x), sm.zero.type_as(x))
+
+    def test_bit_exact(self):
+        torch.manual_seed(5)
+        for dtype in [torch.float32, torch.float64]:
+            for eps_in in [1./4, 1./16, 1./64, 1./255]:
+                sm = PACTIntegerSoftmax(n_levels=256, eps_in=torch.Tensor((eps_in,)), int_kernel=True)
+                for _ in range(4):
+                    x = _int_input(8, 4, 64, lo=-128, hi=128).to(dtype)
+                    self.assertIsNotNone(sm.int_forward(x))
+                    self.assertTrue(torch.equal(sm(x), self.reference(sm, x)), f"mismatch for eps_in {eps_in}, {dtype}")
+
+    def test_non_integer_input(self):
+        torch.manual_seed(6)
+        sm = PACTIntegerSoftmax(n_levels=256, eps_in=torch.Tensor((1./16,)), int_kernel=True)
+        x = torch.randn(8, 64).double() * 50
+        self.assertIsNone(sm.int_forward(x))
+        self.assertTrue(torch.equal(sm(x), self.reference(sm, x)))
+
+
+def _partial_max_loop(x : torch.Tensor, n_levels : torch.Tensor, groups : int, group_width : int):
+    # reference: the per-group loop PACTIntegerITAPartialMax.MySoftmax used
+    # before it was vectorized
+    B = torch.log2(n_levels).type_as(x)
+    eps_max = B / (2**B)
+    _, H, S, _ = x.size()
+    exp_partial_sum = torch.zeros_like(x)[...,0].type(torch.int32)
+    global_max = torch.full_like(x, -127)[...,0].type(torch.int8)
+    for i in range(groups):
+        current_max = torch.max(x[...,0 + i * group_width:group_width + i * group_width].type(torch.int32), dim = -1)[0]
+        shift_sum = torch.zeros_like(x)[...,0].type(torch.int32)
+        max_shift = torch.floor((current_max - global_max) * eps_max + 0.5 + torch.finfo(x.dtype).eps)
+        shift_sum = torch.where(current_max > global_max, max_shift, shift_sum)
+        global_max = torch.where(current_max > global_max, current_max, global_max)
+        diff = torch.repeat_interleave(global_max, group_width).reshape(-1, H, S, group_width) - x[...,0 + i * group_width:group_width + i * group_width].type(torch.int32)
+        shift = torch.floor(diff * eps_max + 0.5 + torch.finfo(x.dtype).eps).type(torch.int32)
+        exp_sum = torch.floor(torch.sum(n_levels / 2**shift, dim = -1))
+        exp_partial_sum = torch.floor(exp_partial_sum / 2**shift_sum) + exp_sum
+    exp_partial_sum_inverse = torch.floor(n_levels * (n_levels-1) / exp_partial_sum).type(torch.int32)
+    diff = torch.repeat_interleave(global_max, S).reshape(-1, H, S, S) - x.type(torch.int32)
+    shift = torch.floor(diff * eps_max + 0.5 + torch.finfo(x.dtype).eps).type(torch.int32)
+    return torch.floor(torch.repeat_interleave(exp_partial_sum_inverse, S).reshape(-1, H, S, S) / 2**shift).type_as(x)
+
+
+class TestITAPartialMax(TestCase):
+
+    def test_vectorized(self):
+        torch.manual_seed(7)
+        n_levels = torch.Tensor((256.,))
+        for dtype in [torch.float32, torch.float64]:
+            for S, group_width in [(64, 16), (32, 8), (16, 16)]:
+                x = _int_input(2, 3, S, S).to(dtype)
+                out = PACTIntegerITAPartialMax.MySoftmax.forward(None, x, n_levels.type_as(x), S // group_width, group_width)
+                ref = _partial_max_loop(x, n_levels.type_as(x), S // group_width, group_width)
+                self.assertTrue(torch.equal(out, ref), f"mismatch for S={S}, group_width={group_width}, {dtype}")
+
+    @staticmethod
+    def accumulate_loop(exp_sum : torch.Tensor, shift_sum : torch.Tensor):
+        acc = [0] * exp_sum.shape[0]
+        for r in range(exp_sum.shape[0]):
+            for e, s in zip(exp_sum[r].tolist(), shift_sum[r].tolist()):
+                acc[r] = acc[r] // 2**int(s) + int(e)
+        return torch.tensor(acc, dtype=torch.int64)
+
+    def test_accumulate(self):
+        # small shift sums take the closed form, large ones overflow int64 and
+        # take the fallback
+        torch.manual_seed(8)
+        for max_shift in [4, 40]:
+            exp_sum = torch.randint(0, 2**20, (64, 8)).double()
+            shift_sum = torch.randint(0, max_shift, (64, 8)).double()
+            acc = PACTIntegerITAPartialMax._accumulate(exp_sum, shift_sum)
+            self.assertTrue(torch.equal(acc, self.accumulate_loop(exp_sum, shift_sum)), f"mismatch for max_shift {max_shift}")
+
+
+def _conv_net(n_levels_in : int = 16):
+    # started PACT network: input activation -> PACTConv2d -> BN -> activation
+    net = nn.Sequential(PACTAsymmetricAct(n_levels=n_levels_in, init_clip='const', learn_clip=False, act_kind='identity'),
+                        PACTConv2d(3, 8, 3, n_levels=16, init_clip='max', bias=False),
+                        nn.BatchNorm2d(8),
+                        PACTUnsignedAct(n_levels=256, init_clip='const', learn_clip=False, act_kind='relu'))
+    PACTActController([net[0], net[3]], {0 : 'start'}, init_clip_lo=-1., init_clip_hi=1.).step_pre_training_epoch(0)
+    PACTLinearController([net[1]], {0 : 'start'}).step_pre_training_epoch(0)
+    return net.eval()
+
+
+class TestFixChannelNumbers(TestCase):
+
+    def test_integerize_padded(self):
+        # 4-bit inputs require an even number of input channels; the weights
+        # cached during shape propagation must not survive the padding
+        torch.manual_seed(9)
+        gm = PACT_symbolic_trace(_conv_net())
+        int_gm = IntegerizePACTNetPass(shape_in=(1, 3, 8, 8), eps_in=1./8, fix_channel_numbers=True)(gm)
+        convs = [m for m in int_gm.modules() if isinstance(m, nn.Conv2d)]
+        self.assertEqual(len(convs), 1)
+        self.assertEqual(convs[0].in_channels, 4)
+        self.assertEqual(convs[0].weight.shape[1], 4)
+        x = torch.randint(-8, 8, (2, 4, 8, 8)).float()
+        x[:, 3] = 0
+        self.assertEqual(int_gm(x).shape[1], 8)
+
+
+class AddChain(nn.Module):
+    def forward(self, x):
+        a = x + 1
+        b = a + 1
+        c = b + 1
+        return c + 1
+
+
+class TestIntegerizationCache(TestCase):
+
+    def test_meta_round_trip(self):
+        gm = fx.symbolic_trace(AddChain())
+        # drop `add_1` so the surviving nodes get renamed when the cached
+        # GraphModule is re-traced
+        nodes = {n.name : n for n in gm.graph.nodes}
+        nodes['add_1'].replace_all_uses_with(nodes['add'])
+        gm.graph.erase_node(nodes['add_1'])
+        gm.recompile()
+        gm = ShapePropPass(torch.Size([2, 3]))(gm)
+        for i, n in enumerate(gm.graph.nodes):
+            n.meta['quant'] = QuantInfo(eps_in=[2.**-i], eps_out=2.**-i, n_levels_in=[2**i], n_levels_out=2**i, signed_in=[True], signed_out=bool(i % 2))
+            n.meta['shape_in'] = [i]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = IntegerizationCache(cache_dir)
+            cache.store('key', gm)
+            loaded = cache.load('key')
+        self.assertIsNotNone(loaded)
+        orig_nodes, loaded_nodes = list(gm.graph.nodes), list(loaded.graph.nodes)
+        self.assertEqual(len(orig_nodes), len(loaded_nodes))
+        for n, l in zip(orig_nodes, loaded_nodes):
+            for k in ['quant', 'tensor_meta', 'shape_in']:
+                self.assertEqual(k in n.meta.keys(), k in l.meta.keys())
+                if k in n.meta.keys():
+                    self.assertEqual(n.meta[k], l.meta[k])
+
+    def test_key_config_attributes(self):
+        def net(**kwargs):
+            return nn.Sequential(RequantShift(mul=torch.Tensor((3.,)), add=torch.Tensor((1.,)), n_levels=256, signed=True, **kwargs))
+        self.assertEqual(integerization_key(net()), integerization_key(net()))
+        self.assertNotEqual(integerization_key(net(requant_node=True)), integerization_key(net(requant_node=False)))
+        self.assertNotEqual(integerization_key(net(shift_path=True)), integerization_key(net(shift_path=False)))
+
+
+class LUTChain(nn.Module):
+    # channelwise RequantShift (clipping, but not elementwise) followed by an
+    # elementwise chain whose final multiply-add exceeds 2**24
+    def __init__(self, C : int = 8):
+        super(LUTChain, self).__init__()
+        self.rq_in = RequantShift(mul=torch.randint(1, 8, (C,)).float(), add=torch.zeros(C), n_levels=256, signed=True, D=torch.Tensor((4.,)))
+        self.gelu = PACTIntegerGELU(eps_in=torch.Tensor((1./16,)), D=2**14)
+        self.rq_out = RequantShift(mul=torch.Tensor((2.**20+3,)), add=torch.Tensor((2.**19,)), n_levels=256, signed=True, D=torch.Tensor((2.**24,)))
+
+    def forward(self, x):
+        return self.rq_out(self.gelu(self.rq_in(x)))
+
+
+class ConvLUTChain(nn.Module):
+    # integerized conv followed by a scalar RequantShift, GELU and another
+    # RequantShift - the first RequantShift's input domain is unknown
+    def __init__(self):
+        super(ConvLUTChain, self).__init__()
+        self.conv = nn.Conv2d(4, 8, 3, bias=False)
+        self.conv.weight.data.copy_(torch.randint(-8, 8, self.conv.weight.shape))
+        self.rq_in = RequantShift(mul=torch.Tensor((5.,)), add=torch.Tensor((2.**6,)), n_levels=256, signed=True, D=torch.Tensor((2.**7,)))
+        self.gelu = PACTIntegerGELU(eps_in=torch.Tensor((1./16,)), D=2**14)
+        self.rq_out = RequantShift(mul=torch.Tensor((2.**20+3,)), add=torch.Tensor((2.**19,)), n_levels=256, signed=True, D=torch.Tensor((2.**24,)))
+
+    def forward(self, x):
+        return self.rq_out(self.gelu(self.rq_in(self.conv(x))))
+
+
+class TestCompileLUT(TestCase):
+
+    @staticmethod
+    def n_luts(gm : fx.GraphModule):
+        return sum(isinstance(m, PACTIntegerLUT) for m in gm.modules())
+
+    def test_bit_exact(self):
+        torch.manual_seed(2)
+        gm = PACT_symbolic_trace(LUTChain())
+        ref = copy.deepcopy(gm).double()
+        compiled = CompileLUTPass()(copy.deepcopy(gm)).double()
+        self.assertEqual(self.n_luts(compiled), 1)
+        x = _int_input(64, 8, lo=-2**10, hi=2**10)
+        self.assertTrue(torch.equal(compiled(x), ref(x)))
+
+    def test_after_conv(self):
+        torch.manual_seed(10)
+        gm = PACT_symbolic_trace(ConvLUTChain())
+        ref = copy.deepcopy(gm).double()
+        compiled = CompileLUTPass()(copy.deepcopy(gm)).double()
+        self.assertEqual(self.n_luts(compiled), 1)
+        # the leading RequantShift provides the LUT's domain and is kept
+        self.assertEqual(sum(isinstance(m, RequantShift) for m in compiled.modules()), 1)
+        x = _int_input(2, 4, 8, 8, lo=-16, hi=16)
+        self.assertTrue(torch.equal(compiled(x), ref(x)))
+
+    def test_unknown_domain(self):
+        # without use_annotations, only chains fed by a clipping module are
+        # compiled
+        gm = PACT_symbolic_trace(nn.Sequential(PACTIntegerGELU(eps_in=torch.Tensor((1./16,)), D=2**14)))
+        self.assertEqual(self.n_luts(CompileLUTPass()(gm)), 0)
+
+    def test_clamp(self):
+        lut = PACTIntegerLUT(torch.arange(10.)*3, offset=-5)
+        x = torch.Tensor((-100., -6., -5., 0., 4., 5., 100.))
+        self.assertTrue(torch.equal(lut(x), torch.Tensor((0., 0., 0., 15., 27., 27., 27.))))
+
+
+if __name__ == '__main__':
+    unittest.main()
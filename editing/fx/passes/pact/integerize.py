@@ -33,11 +33,11 @@ from torch.fx.subgraph_rewriter import Match
 
 from quantlib.algorithms.pact.pact_ops import *
 
-from .. import FxPass, ReplaceSequentialPatternPass, ModifySequentialPatternPass, SequentialPass, ShapePropPass, ModularizePass
+from .. import FxPass, ReplaceSequentialPatternPass, ReplaceSequentialPatternsPass, ModifySequentialPatternPass, SequentialPass, ShapePropPass, ModularizePass
 from .. import AnnotateEpsPass, extract_eps
 from .. import MergeConvBNPass, RetracePass
 from .harmonize import LayerNormDisassemblePass, ApplyPassToWrapModule, InsertBNBetweenBiasedConvAndActsPass, RQSMergePass
-from ...util import gm_modules, module_of_node, get_ordered_active_nodes
+from ...util import gm_modules, module_of_node, module_index, get_ordered_active_nodes
 from ...util.tracing import LeafTracer, custom_symbolic_trace
 
 from quantlib.algorithms.pact.pact_ops import RequantShift, HardActRequantShift, ChannelwiseThreshold
@@ -57,7 +57,7 @@ __all__ = ['IntegerizePACTConvPass',
            'PACTTracer',
            'PACT_symbolic_trace',]
 
-def integerize_softmax_fun(gm : fx.GraphModule, match : Match, mode: Literal["I-BERT", "ITA", 'ITA-Partial'] = "I-BERT", D=2**12, export_node=False):
+def integerize_softmax_fun(gm : fx.GraphModule, match : Match, mode: Literal["I-BERT", "ITA", 'ITA-Partial'] = "I-BERT", D=2**12, export_node=False, int_kernel=False):
     modules = gm_modules(gm)
     matched_nodes = [m for k, m in match.nodes_map.items() if k.op == 'call_module']
     lin_node = matched_nodes[0]
@@ -67,7 +67,7 @@ def integerize_softmax_fun(gm : fx.GraphModule, match : Match, mode: Literal["I-
     # assert isinstance(module, PACTSoftmax), f"integerize_softmax_fun got bad match - expected PACTSoftmax, got {type(module)}"
 
     if mode=='I-BERT':
-        new_softmax = PACTIntegerSoftmax(n_levels=module.n_levels, eps_in=eps_in, export_node=export_node)
+        new_softmax = PACTIntegerSoftmax(n_levels=module.n_levels, eps_in=eps_in, export_node=export_node, int_kernel=int_kernel)
     elif mode=='ITA':
         new_softmax = PACTIntegerITAMax(max_value = module.act.max, n_levels=module.n_levels, eps_in=eps_in, D=D, export_node=export_node)
     elif mode=='ITA-Partial':
@@ -93,7 +93,7 @@ def integerize_gelu_fun(gm : fx.GraphModule, match : Match, D=2**14, export_node
 class IntegerizeConstWrapPass(ModularizePass):
     @staticmethod
     def constwrap_replacement_fn(node):
-        module = dict(node.graph._owning_module.named_modules())[node.target]
+        module = module_index(node.graph._owning_module)[node.target]
         return (PACTIntegerConstWrap(), node.args, node.kwargs)
 
     def __init__(self, **kwargs):
@@ -114,7 +114,7 @@ class IntegerizeMeanPass(ModularizePass):
 class IntegerizeTrueDivPass(ModularizePass):
     @staticmethod
     def truediv_replacement_fn(node, integer_node=False):
-        module = dict(node.graph._owning_module.named_modules())[node.target]
+        module = module_index(node.graph._owning_module)[node.target]
         if module.stable:
             return (PACTIntegerDiv(module.Delta, eps=module.get_eps_div(), eta=module.eta, integer_node=integer_node), node.args, node.kwargs)
         else:
@@ -154,11 +154,11 @@ class IntegerizeLayerNormPass(SequentialPass):
         super().__init__(*passes, name_prefix='_INTEGER_LAYERNORM_PASS')
 
 class IntegerizeSoftmaxPass(SequentialPass):
-    def __init__(self, D=2**12, export_softmax_node = False , **kwargs):
+    def __init__(self, D=2**12, export_softmax_node = False, softmax_int_kernel = False, **kwargs):
         passes = []
 
         pattern = nn.Sequential(PACTSoftmax())
-        passes.append(ReplaceSequentialPatternPass(pattern, PACT_symbolic_trace, partial(integerize_softmax_fun, mode='I-BERT', export_node=export_softmax_node), f'_INTEGER_SOFTMAX_PASS'))
+        passes.append(ReplaceSequentialPatternPass(pattern, PACT_symbolic_trace, partial(integerize_softmax_fun, mode='I-BERT', export_node=export_softmax_node, int_kernel=softmax_int_kernel), f'_INTEGER_SOFTMAX_PASS'))
 
         pattern = nn.Sequential(PACTITAMax())
         passes.append(ReplaceSequentialPatternPass(pattern, PACT_symbolic_trace, partial(integerize_softmax_fun, mode='ITA', D=D, export_node=export_softmax_node), f'_INTEGER_SOFTMAX_PASS'))
@@ -326,7 +326,7 @@ class ReplacePACTCausalConv1DPass(ReplaceSequentialPatternPass):
 
 
 def bn_act_to_requant_fun(gm : fx.GraphModule, match : Match, D=2**24, cmsis_requant=False, requant_node=False):
-    modules = dict(gm.named_modules())
+    modules = gm_modules(gm)
     if not isinstance(D, torch.Tensor):
         D = torch.tensor(D)
     matched_nodes = [n for n in match.nodes_map.values()][-2:0:-1]
@@ -392,23 +392,24 @@ def bn_act_to_requant_fun(gm : fx.GraphModule, match : Match, D=2**24, cmsis_req
     requant = RequantShift(gamma_h, beta_h, act.n_levels, signed_act, D, cmsis_requant=cmsis_requant, requant_node=requant_node)
     return requant
 
-class IntegerizeBNActPass(SequentialPass):
+class IntegerizeBNActPass(ReplaceSequentialPatternsPass):
     def __init__(self, D : float = 2**24, cmsis_requant=False, requant_node=False):
-        passes = []
-        # replace all combinations of BN + PACT activation with RequantShift layers
+        patterns = []
+        # replace all combinations of BN + PACT activation with RequantShift
+        # layers - all patterns are matched in a single traversal of the graph
         for act_name, act_type in [("UNSIGNED_ACT", PACTUnsignedAct), ("SIGNED_ACT", PACTAsymmetricAct)]:
             for bn_name, bn_type in [("BN1D", nn.BatchNorm1d), ("BN2D", nn.BatchNorm2d), ("BN3D", nn.BatchNorm3d)]:
                 pattern = nn.Sequential(bn_type(1), act_type(n_levels=256, init_clip='max', learn_clip=False, act_kind='identity'))
-                passes.append(ReplaceSequentialPatternPass(pattern, PACT_symbolic_trace, bn_act_to_requant_fun, f"_INTEGERIZE_{bn_name}_{act_name}_PASS", D=D, cmsis_requant=cmsis_requant, requant_node=requant_node))
+                patterns.append((pattern, f"_INTEGERIZE_{bn_name}_{act_name}_PASS"))
 
             #also replace "freestanding" activations AFTER replacing the BN+Act stacks
             pattern = nn.Sequential(act_type(n_levels=256, init_clip='max', learn_clip=False, act_kind='identity'))
-            passes.append(ReplaceSequentialPatternPass(pattern, PACT_symbolic_trace, bn_act_to_requant_fun, f"_INTEGERIZE_{act_name}_PASS", D=D, cmsis_requant=cmsis_requant, requant_node=requant_node))
+            patterns.append((pattern, f"_INTEGERIZE_{act_name}_PASS"))
 
-        super(IntegerizeBNActPass, self).__init__(*passes, name_prefix="_INTEGERIZE_BN_ACT_PASS")
+        super(IntegerizeBNActPass, self).__init__(patterns, PACT_symbolic_trace, bn_act_to_requant_fun, "_INTEGERIZE_BN_ACT_PASS", D=D, cmsis_requant=cmsis_requant, requant_node=requant_node)
 
 def conv_bn_act_to_conv_threshold_fun(gm : fx.GraphModule, match : Match, cutie_style_threshs=False):
-    modules = dict(gm.named_modules())
+    modules = gm_modules(gm)
     matched_nodes = [n for n in match.nodes_map.values()][-2:0:-1]
     matched_modules = [modules[m.target] for k, m in match.nodes_map.items() if k.op == 'call_module'][::-1]
     assert len(matched_nodes) == len(matched_modules), "conv_bn_act_to_conv_threshold_fun got unexpected non-'call_module' nodes!"
@@ -582,6 +583,9 @@ class FixChannelNumbersPass(FxPass):
                     new_bias = torch.zeros([new_out_ch]).type_as(module.bias.data)
                     new_bias[:out_ch] = module.bias.data
                     module.bias.data = new_bias
+                # the quantized weights cached by the ShapePropPass' forward
+                # pass don't reflect the new weights
+                module.invalidate_weight_q_cache()
 
                 print(f"Adjusting Conv {node.target}'s channels: {module.in_channels}/{module.out_channels} ==> {new_in_ch}/{new_out_ch}")
                 module.in_channels = new_in_ch
@@ -778,7 +782,8 @@ class IntegerizePACTNetPass(SequentialPass):
                  convert_input_to_unsigned : bool = False, D1 : float = 2**18, D2 : float = 2**12,
                  ternarize : bool = False, word_align_channels : bool = False,
                  export_layernorm_node = False, export_softmax_node = False,
-                 export_gelu_node = False, export_div_node = False, verbose=False):
+                 export_gelu_node = False, export_div_node = False, verbose=False,
+                 meta_shape_prop : bool = False, softmax_int_kernel : bool = False):
 
         passes = []
         # start by retracing the network to dissolve any integer ops
@@ -795,7 +800,9 @@ class IntegerizePACTNetPass(SequentialPass):
         # know what shape a node's output has
         # IMPORTANT: run model.eval() BEFORE running this pass - otherwise the
         # ShapePropPass will contaminate the batchnorm parameters!
-        passes.append(ShapePropPass(shape_in))
+        # with meta_shape_prop, shapes are propagated on the meta device
+        # without executing the network.
+        passes.append(ShapePropPass(shape_in, meta=meta_shape_prop))
         # biases of convolutional layers which are not followed by a BN must be
         # folded into a new batchNorm layer and their biases discarded/turned off
         passes.append(InsertBNBetweenBiasedConvAndActsPass())
@@ -819,7 +826,7 @@ class IntegerizePACTNetPass(SequentialPass):
             passes.append(IntegerizePACTConvPass())
         passes.append(IntegerizePACTLinearPass())
         passes.append(IntegerizeBNPACTHardActsPass(D1=D1, D2=D2))
-        passes.append(IntegerizeSoftmaxPass(D=D, export_softmax_node=export_softmax_node))
+        passes.append(IntegerizeSoftmaxPass(D=D, export_softmax_node=export_softmax_node, softmax_int_kernel=softmax_int_kernel))
         passes.append(IntegerizeLayerNormPass(D=D, export_layernorm_node=export_layernorm_node))
         passes.append(IntegerizeGELUPass(D=D, export_gelu_node=export_gelu_node))
         passes.append(IntegerizeBNActPass(D, enable_add_first, requant_node=requant_node))
@@ -0,0 +1,205 @@
+#
+# lut.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import torch
+from torch import fx, nn
+
+from quantlib.algorithms.pact.pact_ops import RequantShift, HardActRequantShift, PACTIntegerGELU, PACTIntegerHardswish, PACTIntegerHardsigmoid, PACTIntegerLUT
+
+from .. import FxPass
+from ...util import module_of_node, get_qualified_prefix, add_submodule, delete_submodule
+
+__all__ = ['CompileLUTPass',
+           'lut_domain']
+
+# integer modules which operate elementwise on their input as long as all
+# their parameters are scalars. PACTIntegerExp is not included as it
+# subtracts the maximum of each row.
+_LUT_ELEMENTWISE_MODULES = (RequantShift,
+                            HardActRequantShift,
+                            PACTIntegerGELU,
+                            PACTIntegerHardswish,
+                            PACTIntegerHardsigmoid,
+                            PACTIntegerLUT)
+
+def _lut_compatible(m : nn.Module):
+    if not isinstance(m, _LUT_ELEMENTWISE_MODULES):
+        return False
+    # channelwise parameters would make the result depend on the position of
+    # an element
+    tensors = list(m.buffers()) + list(m.parameters()) + [v for v in vars(m).values() if isinstance(v, torch.Tensor)]
+    if isinstance(m, PACTIntegerLUT):
+        tensors = [t for t in tensors if t is not m.lut]
+    return all(t.numel() <= 1 for t in tensors)
+
+def _clips_output(m : nn.Module):
+    # whether the outputs of `m` are clipped to a known integer range
+    return isinstance(m, (RequantShift, HardActRequantShift)) or (isinstance(m, PACTIntegerLUT) and m.clips_output)
+
+def _module_device(m : nn.Module):
+    return next(m.buffers(), torch.empty(0)).device
+
+def _levels_to_range(n_levels, signed : bool):
+    if isinstance(n_levels, torch.Tensor):
+        n_levels = n_levels.item()
+    if signed:
+        c = round(n_levels/2. + 0.001)
+        return -c, c-1
+    return 0, int(n_levels)-1
+
+def lut_domain(gm : fx.GraphModule, node : fx.Node, use_annotations : bool = False):
+    # range (lo, hi) of the integer values produced by `node`, or None if it
+    # is not known. Clipping modules determine the range exactly. With
+    # use_annotations, the (approximate) n_levels annotations of
+    # AnnotateEpsPass are used for all other nodes.
+    if node.op == 'call_module':
+        m = module_of_node(gm, node)
+        if isinstance(m, RequantShift):
+            return _levels_to_range(m.n_levels_out, m.signed)
+        if isinstance(m, HardActRequantShift):
+            return int(m.c_lo.item()), int(m.c_hi.item())
+        if isinstance(m, PACTIntegerLUT) and m.clips_output:
+            return _levels_to_range(m.n_levels_out, m.signed_out)
+    if not use_annotations:
+        return None
+    qi = node.meta.get('quant', None)
+    if qi is None or qi.n_levels_out is None or qi.signed_out is None:
+        return None
+    return _levels_to_range(qi.n_levels_out, qi.signed_out)
+
+class CompileLUTPass(FxPass):
+    # replaces chains of elementwise integer modules (RequantShift,
+    # HardActRequantShift, PACTIntegerGELU, PACTIntegerHardswish,
+    # PACTIntegerHardsigmoid) whose input takes at most `max_entries` distinct
+    # values with a single PACTIntegerLUT, so each element costs one gather.
+    # The input domain of a chain is the clipping range of the module
+    # producing its input. If it is unknown, the leading modules up to and
+    # including the chain's first clipping module are kept and the rest of
+    # the chain is compiled. The table is computed by running the chain on
+    # every value of the domain in `dtype`, so the LUT reproduces the chain's
+    # outputs exactly when the network is run in the same dtype - the
+    # exporters' golden models use float64.
+    # PACTIntegerLUT clamps inputs to the domain. If use_annotations is set,
+    # chains whose input is not produced by a clipping module are compiled
+    # too, with the domain taken from the AnnotateEpsPass annotations (run
+    # AnnotateEpsPass on the integerized network first). These annotations
+    # are approximate, so inputs outside of them are clamped instead of
+    # being processed by the chain.
+    # Only chains with at least `min_chain_length` modules are replaced; set
+    # it to 2 to keep isolated RequantShifts for backends which map them to
+    # dedicated hardware.
+    def __init__(self, max_entries : int = 2**16, min_chain_length : int = 1, dtype : torch.dtype = torch.float64, use_annotations : bool = False, export_node : bool = False, verbose : bool = False):
+        super(CompileLUTPass, self).__init__()
+        self.max_entries = max_entries
+        self.min_chain_length = min_chain_length
+        self.dtype = dtype
+        self.use_annotations = use_annotations
+        self.export_node = export_node
+        self.verbose = verbose
+
+    def _is_lut_node(self, gm : fx.GraphModule, node : fx.Node):
+        return node.op == 'call_module' and len(node.args) == 1 and isinstance(node.args[0], fx.Node) and len(node.kwargs) == 0 and _lut_compatible(module_of_node(gm, node))
+
+    def find_chains(self, gm : fx.GraphModule):
+        chains = []
+        visited = set()
+        for node in gm.graph.nodes:
+            if node in visited or not self._is_lut_node(gm, node):
+                continue
+            chain = [node]
+            visited.add(node)
+            # intermediate results must not be used anywhere else
+            while len(chain[-1].users) == 1:
+                u = next(iter(chain[-1].users))
+                if not self._is_lut_node(gm, u):
+                    break
+                chain.append(u)
+                visited.add(u)
+            chains.append(chain)
+        return chains
+
+    def compile_chain(self, gm : fx.GraphModule, chain : list, domain : tuple):
+        lo, hi = domain
+        x = torch.arange(lo, hi+1, dtype=self.dtype).reshape(1, -1)
+        with torch.no_grad():
+            for n in chain:
+                m = module_of_node(gm, n)
+                x = m(x.to(_module_device(m)))
+        x = x.reshape(-1).cpu()
+        qi = chain[-1].meta.get('quant', None)
+        eps_out, n_levels_out, signed_out = (None, None, None) if qi is None else (qi.eps_out, qi.n_levels_out, qi.signed_out)
+        last = module_of_node(gm, chain[-1])
+        clips_output = False
+        if isinstance(last, RequantShift):
+            # AnnotateEpsPass does not propagate the output range of
+            # RequantShifts
+            n_levels_out, signed_out = int(last.n_levels_out.item()), bool(last.signed)
+            clips_output = True
+        elif isinstance(last, PACTIntegerLUT):
+            clips_output = last.clips_output
+        return PACTIntegerLUT(x, lo, eps_out=eps_out, n_levels_out=n_levels_out, signed_out=signed_out, clips_output=clips_output, export_node=self.export_node)
+
+    def run_pass(self, gm : fx.GraphModule):
+        module_names = set(dict(gm.named_modules()).keys())
+        lut_idx = 0
+        for chain in self.find_chains(gm):
+            in_node = chain[0].args[0]
+            domain = lut_domain(gm, in_node, self.use_annotations)
+            # chains usually start with the RequantShift after a conv/linear/
+            # add, whose input domain is unknown. In that case, the chain is
+            # compiled from the first clipping module on
+            while domain is None or domain[1] - domain[0] + 1 > self.max_entries:
+                clip_idx = next((i for i, n in enumerate(chain[:-1]) if _clips_output(module_of_node(gm, n))), None)
+                if clip_idx is None:
+                    break
+                in_node = chain[clip_idx]
+                chain = chain[clip_idx+1:]
+                domain = lut_domain(gm, in_node, self.use_annotations)
+            if len(chain) < self.min_chain_length:
+                continue
+            if len(chain) == 1 and isinstance(module_of_node(gm, chain[0]), PACTIntegerLUT):
+                # already compiled
+                continue
+            if domain is None or domain[1] - domain[0] + 1 > self.max_entries:
+                if self.verbose:
+                    print(f"[CompileLUTPass] Not compiling chain {[n.name for n in chain]} - input domain {domain} unknown or too large")
+                continue
+            lut = self.compile_chain(gm, chain, domain)
+            prefix = get_qualified_prefix(chain[0].target)
+            while True:
+                target = f"_QL_LUT_{lut_idx}" if not len(prefix) else f"{prefix}._QL_LUT_{lut_idx}"
+                lut_idx += 1
+                if target not in module_names:
+                    break
+            module_names.add(target)
+            add_submodule(gm, target, lut.to(_module_device(module_of_node(gm, chain[0]))))
+            with gm.graph.inserting_after(chain[-1]):
+                new_node = gm.graph.call_module(target, args=(in_node,))
+            new_node.meta.update(chain[-1].meta)
+            chain[-1].replace_all_uses_with(new_node)
+            for n in reversed(chain):
+                gm.graph.erase_node(n)
+                # modules may be called from more than one node
+                if not any(u.op == 'call_module' and u.target == n.target for u in gm.graph.nodes):
+                    delete_submodule(gm, n.target)
+            if self.verbose:
+                print(f"[CompileLUTPass] Replaced {[n.name for n in chain]} with a {lut.lut.numel()}-entry LUT")
+        return gm
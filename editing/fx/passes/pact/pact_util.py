@@ -52,6 +52,7 @@ PACT_OPS = set([_PACTActivation,
                 PACTIntegerHardsigmoid,
                 PACTIntegerHardswish,
                 RequantShift,
+                PACTIntegerLUT,
                 PACTDiv,
                 PACTMean,
                 PACTIntegerMean,
@@ -21,14 +21,23 @@
 #
 
 
+from contextlib import contextmanager
 from typing import Optional, Union
+import time
+import weakref
 
 from torch import fx, nn
 from torch.fx.subgraph_rewriter import Match
 
-from ..util import get_ordered_active_nodes, get_qualified_prefix, module_of_node, SequentialMatcher#, NonUniqueGeneralMatcher
+from .profiling import active_profiler
+from ..util import get_ordered_active_nodes, get_qualified_prefix, module_of_node, module_index, invalidate_module_index, add_submodule, delete_submodule, SequentialMatcher, MultiSequentialMatcher#, NonUniqueGeneralMatcher
 
 __all__ = ['FxPass',
+           'set_recompile_mode',
+           'recompile_mode',
+           'flush_recompile',
+           'recompiles_avoided',
+           'reset_recompiles_avoided',
            'SequentialPass',
            'ModifyMatchedModulesPass',
            'ModifyMatchesPass',
@@ -36,13 +45,77 @@ __all__ = ['FxPass',
            'FindSequentialPatternsPass',
            'ReplaceMatchWithModulePass',
            'ReplaceSequentialPatternPass',
+           'ReplaceSequentialPatternsPass',
            'ReplaceSingleInputPatternPass',
            'ModularizeNodePass',
            'ModularizePass',
            'ConstShapePass']
 
+# recompiling and linting a GraphModule regenerates its Python code, which is
+# expensive for large graphs. The pass pipeline supports 3 modes:
+# - 'eager':    recompile and lint after every (sub)pass (default)
+# - 'deferred': recompile and lint only when the outermost pass applied to
+#               a GraphModule is finished
+# - 'manual':   never recompile automatically; call `flush_recompile(gm)`
+_RECOMPILE_MODES = ['eager', 'deferred', 'manual']
+_recompile_state = {'mode' : 'eager', 'avoided' : 0}
+# GraphModules whose code is out of date with their graph
+_stale_gms = weakref.WeakSet()
+# number of active `apply` calls on each GraphModule. This is tracked per
+# GraphModule because passes may create and transform other GraphModules
+# (e.g., the ones wrapped in PACTWrapModules) while they are running.
+_apply_depth = weakref.WeakKeyDictionary()
+# passes like RetracePass return a new GraphModule which replaces their
+# input. The depth of the enclosing passes is carried over to the new
+# GraphModule; this maps the replaced GraphModules to their replacements so
+# the enclosing passes can find it when they finish.
+_replaced_by = weakref.WeakKeyDictionary()
+
+def _depth(gm : fx.GraphModule):
+    return _apply_depth.get(gm, 0)
+
+def _depth_holder(gm : fx.GraphModule):
+    # the GraphModule which currently carries the depth recorded for gm
+    while gm in _replaced_by:
+        gm = _replaced_by[gm]
+    return gm
+
+def set_recompile_mode(mode : str):
+    assert mode in _RECOMPILE_MODES, f"set_recompile_mode: Invalid mode {mode}, expected one of {_RECOMPILE_MODES}"
+    _recompile_state['mode'] = mode
+
+@contextmanager
+def recompile_mode(mode : str):
+    old_mode = _recompile_state['mode']
+    set_recompile_mode(mode)
+    try:
+        yield
+    finally:
+        _recompile_state['mode'] = old_mode
+
+def _recompile(gm : fx.GraphModule):
+    gm.recompile()
+    gm.graph.lint()
+    _stale_gms.discard(gm)
+
+def flush_recompile(gm : fx.GraphModule):
+    # recompile and lint gm if any pass skipped doing so
+    if gm in _stale_gms:
+        _recompile(gm)
+    return gm
+
+def recompiles_avoided():
+    return _recompile_state['avoided']
+
+def reset_recompiles_avoided():
+    _recompile_state['avoided'] = 0
+
 #TODO implement logging!
 class FxPass:
+    # set this to True in passes which execute or re-trace the GraphModule's
+    # code (rather than only working on its graph) - pending recompilations
+    # are then performed before the pass is run.
+    requires_recompiled_gm = False
 
     def __init__(self):
         self.parent = None
@@ -91,10 +164,49 @@ class FxPass:
     # DO NOT OVERWRITE this function in custom pass subclasses unless you have
     # a very good reason!
     def apply(self, gm : fx.GraphModule):
-        self.retarget(gm)
-        gm = self.run_pass(gm)
-        gm.recompile()
-        gm.graph.lint()
+        if self.requires_recompiled_gm:
+            flush_recompile(gm)
+        if _depth(gm) == 0:
+            # the module hierarchy may have been modified outside of a pass
+            invalidate_module_index(gm)
+        profiler = active_profiler()
+        if profiler is not None:
+            profiler.enter(self, gm)
+        gm_in = gm
+        _apply_depth[gm_in] = _depth(gm_in) + 1
+        try:
+            self.retarget(gm)
+            gm = self.run_pass(gm)
+        except BaseException:
+            if profiler is not None:
+                profiler.abort()
+            raise
+        finally:
+            holder = _depth_holder(gm_in)
+            _apply_depth[holder] -= 1
+            if _apply_depth[holder] == 0:
+                del _apply_depth[holder]
+                # the outermost pass is finished - forget the replacements
+                replaced = gm_in
+                while replaced in _replaced_by:
+                    replaced = _replaced_by.pop(replaced)
+        if gm is not holder and _depth(holder) > 0:
+            # gm replaces holder in the enclosing passes
+            _apply_depth[gm] = _depth(gm) + _apply_depth.pop(holder)
+            _replaced_by[holder] = gm
+        mode = _recompile_state['mode']
+        recompile_time = 0.
+        # the returned GraphModule may be a different one than gm_in - it
+        # must be recompiled if no enclosing pass is working on it
+        if mode == 'eager' or (mode == 'deferred' and _depth(gm) == 0):
+            t_start = time.perf_counter()
+            _recompile(gm)
+            recompile_time = time.perf_counter() - t_start
+        else:
+            _stale_gms.add(gm)
+            _recompile_state['avoided'] += 1
+        if profiler is not None:
+            profiler.exit(self, gm, recompile_time)
         return gm
 
     def __call__(self, gm : fx.GraphModule):
@@ -114,7 +226,10 @@ class SequentialPass(FxPass):
         self.setup_passes(passes)
 
     def run_pass(self, gm : fx.GraphModule):
-        for p in self.named_subpasses().values():
+        profiler = active_profiler()
+        for name, p in self.named_subpasses().items():
+            if profiler is not None:
+                profiler.next_name = name
             gm = p.apply(gm)
         return gm
 
@@ -223,7 +338,7 @@ class FindSequentialPatternsPass(ModifySequentialPatternPass):
 #             target_list.append(f"_QL_REPLACED_{self.name.upper()}")
 #             target = '.'.join(target_list)
 #             #add the submodule
-#             gm.add_submodule(target, self.module)
+#             add_submodule(gm, target, self.module)
 #             try:
 #                 with gm.graph.inserting_after(first_matched_node.all_input_nodes[0]):
 #                     # TODO: The bug's here
@@ -244,7 +359,7 @@ class FindSequentialPatternsPass(ModifySequentialPatternPass):
 #         for n in reversed(matched_nodes):
 #             gm.graph.erase_node(n)
 #             if n.op == 'call_module':
-#                 gm.delete_submodule(n.target)
+#                 delete_submodule(gm, n.target)
 
 #         return gm
 
@@ -280,7 +395,7 @@ class ReplaceMatchWithModulePass(FxPass):
             target_list.append(f"_QL_REPLACED_{self.name.upper()}")
             target = '.'.join(target_list)
             #add the submodule
-            gm.add_submodule(target, self.module)
+            add_submodule(gm, target, self.module)
             try:
                 with gm.graph.inserting_after(first_matched_node.all_input_nodes[0]):
                     # TODO: The bug's here
@@ -302,7 +417,7 @@ class ReplaceMatchWithModulePass(FxPass):
         for n in reversed(matched_nodes):
             gm.graph.erase_node(n)
             if n.op == 'call_module':
-                gm.delete_submodule(n.target)
+                delete_submodule(gm, n.target)
 
         return gm
 
@@ -338,7 +453,7 @@ class ReplacePartialSingleInputMatchWithModulePass(FxPass):
             target_list.append(f"_QL_REPLACED_{self.name.upper()}")
             target = '.'.join(target_list)
             #add the submodule
-            gm.add_submodule(target, self.module)
+            add_submodule(gm, target, self.module)
             try:
                 with gm.graph.inserting_after(first_matched_node):
                     new_node = gm.graph.call_module(target, args=(first_matched_node,))
@@ -360,7 +475,7 @@ class ReplacePartialSingleInputMatchWithModulePass(FxPass):
             if n != first_matched_node:
                 gm.graph.erase_node(n)
                 if n.op == 'call_module':
-                    gm.delete_submodule(n.target)
+                    delete_submodule(gm, n.target)
 
         return gm
 
@@ -389,6 +504,32 @@ class ReplaceSequentialPatternPass(SequentialPass):
 
         self.setup_passes(passes)
 
+class ReplaceSequentialPatternsPass(SequentialPass):
+    # like ReplaceSequentialPatternPass, but matches multiple patterns with a
+    # single MultiSequentialMatcher. patterns is a list of (pattern, name)
+    # tuples in order of decreasing priority; the replacements are performed
+    # (and named) as if one ReplaceSequentialPatternPass per pattern were run
+    # in sequence.
+    def __init__(self, patterns : list, trace : callable, replacement_fn : callable, name : str, **kwargs):
+        super(ReplaceSequentialPatternsPass, self).__init__(name_prefix=name)
+        self.pattern_names = [pn for _, pn in patterns]
+        self.matcher = MultiSequentialMatcher([p for p, _ in patterns], trace)
+        self.replacement_fn = replacement_fn
+        self.name = name
+        self.kwargs = kwargs
+
+    def retarget(self, gm : fx.GraphModule):
+        for k in self.named_subpasses().keys():
+            self.remove_subpass(k)
+        self.matches = self.matcher.match_graph(gm)
+        passes = []
+        for pattern_name, matches in zip(self.pattern_names, self.matches):
+            for i, m in enumerate(matches):
+                replacement_module = self.replacement_fn(gm, m, **self.kwargs)
+                passes.append(ReplaceMatchWithModulePass(m, replacement_module, f"{pattern_name}_{i}"))
+
+        self.setup_passes(passes)
+
 #TODO: Non-Sequential Pass
 class ReplaceSingleInputPatternPass(SequentialPass):
     # finds all instances of pattern in the graph, calls the replacement_fn on
@@ -427,19 +568,18 @@ class ModularizeNodePass(FxPass):
         self.module, self.node_args, self.node_kwargs = replacement_fn(node)
 
     def run_pass(self, gm : fx.GraphModule):
-        submodule_names = [m[0] for m in gm.named_modules()]
-        if self.node not in gm.graph.nodes or self.new_target in submodule_names:
+        if self.node not in gm.graph.nodes or self.new_target in module_index(gm).keys():
             # either the pass has already been run or we were passed the wrong
             # graphmodule. in either case, quit.
             #import IPython; IPython.embed()
             return gm
 
-        gm.add_submodule(self.new_target, self.module)
+        add_submodule(gm, self.new_target, self.module)
         with gm.graph.inserting_before(self.node):
             new_node = gm.graph.call_module(self.new_target, args=self.node.args, kwargs=self.node_kwargs)
 
         if self.node.op == 'call_module':
-            gm.delete_submodule(self.node.target)
+            delete_submodule(gm, self.node.target)
 
         self.node.replace_all_uses_with(new_node)
         gm.graph.erase_node(self.node)
@@ -469,11 +609,12 @@ class ModularizePass(SequentialPass):
             self.remove_subpass(k)
         i = 0
         passes = []
+        modules = module_index(gm)
         for node in gm.graph.nodes:
 
             if self.op == 'call_module' and node.op == self.op:
                 # Match on the class of the target
-                targetClass = type(dict(gm.named_modules())[node.target])
+                targetClass = type(modules[node.target])
                 for _target in self.target:
                     ownClass = type(_target)
                     if targetClass == ownClass:
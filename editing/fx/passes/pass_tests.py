@@ -0,0 +1,263 @@
+#
+# pass_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import copy
+import operator
+import unittest
+from unittest import TestCase, mock
+
+import torch
+from torch import nn, fx
+
+from quantlib.algorithms.pact.pact_ops import PACTWrapModule, PACTUnsignedAct, PACTAsymmetricAct, PACTConv2d, PACTLinear, RequantShift
+from quantlib.editing.fx.passes.eps import AnnotateEpsPass
+from quantlib.editing.fx.passes import pass_base
+from quantlib.editing.fx.passes.pass_base import FxPass, SequentialPass, recompile_mode
+from quantlib.editing.fx.passes.general import RetracePass, ShapePropPass
+from quantlib.editing.fx.passes.memory_plan import ActivationMemoryPlanPass, activation_bytes
+from quantlib.editing.fx.passes.pact.harmonize import ApplyPassToWrapModule
+from quantlib.editing.fx.passes.pact.pact_util import PACT_symbolic_trace
+
+
+class DoubleOutputPass(FxPass):
+    # modifies the graph without recompiling it - that's left to FxPass.apply
+    def run_pass(self, gm : fx.GraphModule):
+        out = next(n for n in gm.graph.nodes if n.op == 'output')
+        with gm.graph.inserting_before(out):
+            doubled = gm.graph.call_function(operator.mul, (out.args[0], 2.))
+        out.args = (doubled,)
+        return gm
+
+
+class WrappedLinear(nn.Module):
+    def __init__(self):
+        super(WrappedLinear, self).__init__()
+        self.wrap = PACTWrapModule(nn.Linear(4, 4), n_levels=256)
+
+    def forward(self, x):
+        return self.wrap(x)
+
+
+class TestRecompileModes(TestCase):
+
+    def test_wrap_module_deferred(self):
+        # the GraphModule inside the PACTWrapModule is transformed by a pass
+        # which runs while the outer pass is still active - it must be
+        # recompiled nonetheless
+        torch.manual_seed(0)
+        net = WrappedLinear()
+        x = torch.randn(2, 4)
+        ref = 2 * net(x)
+        for mode in ['eager', 'deferred']:
+            with recompile_mode(mode):
+                gm = ApplyPassToWrapModule(DoubleOutputPass())(PACT_symbolic_trace(net))
+            self.assertTrue(torch.allclose(gm(x), ref), f"mismatch in recompile mode {mode}")
+
+    def test_retrace_deferred(self):
+        # the GraphModule returned by RetracePass replaces its input in the
+        # enclosing SequentialPass - later subpasses must still be deferred
+        net = nn.Sequential(nn.Linear(4, 4))
+        x = torch.randn(2, 4)
+        ref = 8 * net(x)
+        pipeline = SequentialPass(DoubleOutputPass(), RetracePass(fx.symbolic_trace), DoubleOutputPass(), DoubleOutputPass())
+        with recompile_mode('deferred'), mock.patch.object(pass_base, '_recompile', wraps=pass_base._recompile) as recompile:
+            gm = pipeline(fx.symbolic_trace(net))
+        # once before retracing and once at the end of the pipeline
+        self.assertEqual(recompile.call_count, 2)
+        self.assertTrue(torch.allclose(gm(x), ref))
+
+
+class TestIncrementalEps(TestCase):
+
+    @staticmethod
+    def eps_outs(gm : fx.GraphModule):
+        return [n.meta['quant'].eps_out for n in gm.graph.nodes if n.op != 'output']
+
+    def test_data_copy(self):
+        # controllers update clipping bounds in place via `.data.copy_()`;
+        # incremental annotation must pick this up
+        net = nn.Sequential(PACTUnsignedAct(n_levels=256, init_clip='max', learn_clip=True, act_kind='relu'),
+                            nn.Dropout(),
+                            PACTAsymmetricAct(n_levels=256, init_clip='max', learn_clip=True, act_kind='identity'))
+        gm = PACT_symbolic_trace(net)
+        annotate = AnnotateEpsPass(eps_in=1./255, incremental=True)
+        annotate(gm)
+        for clip_hi in [3., 6., 0.5]:
+            net_0 = gm.get_submodule('0')
+            net_0.clip_hi.data.copy_(torch.Tensor((clip_hi,)))
+            annotate(gm)
+            full = AnnotateEpsPass(eps_in=1./255)(copy.deepcopy(gm))
+            for e_inc, e_full in zip(self.eps_outs(gm), self.eps_outs(full)):
+                self.assertTrue(torch.equal(torch.as_tensor(e_inc), torch.as_tensor(e_full)))
+
+
+class TestEpsPlan(TestCase):
+
+    def test_matches_annotation(self):
+        # the precompiled eps plan computes the same epsilons as the full
+        # annotation, also after the clipping bounds changed
+        net = nn.Sequential(PACTUnsignedAct(n_levels=256, init_clip='max', learn_clip=True, act_kind='relu'),
+                            nn.Dropout(),
+                            PACTAsymmetricAct(n_levels=16, init_clip='max', learn_clip=True, act_kind='identity'))
+        gm = PACT_symbolic_trace(net)
+        annotate = AnnotateEpsPass(eps_in=1./255)
+        plan = annotate.eps_plan(gm, list(gm.graph.nodes))
+        for clip_hi in [1., 3., 0.5]:
+            gm.get_submodule('0').clip_hi.data.copy_(torch.Tensor((clip_hi,)))
+            eps = annotate.run_eps_plan(plan)
+            annotate(gm)
+            for n in gm.graph.nodes:
+                if n.op != 'output':
+                    self.assertTrue(torch.equal(torch.as_tensor(eps[n]), torch.as_tensor(n.meta['quant'].eps_out)))
+
+
+class ShapeNet(nn.Module):
+    # standard modules, quantlib modules which need meta shape rules,
+    # functions and methods
+    def __init__(self):
+        super(ShapeNet, self).__init__()
+        self.conv = nn.Conv2d(3, 8, 3, stride=2, padding=1)
+        self.bn = nn.BatchNorm2d(8)
+        self.act = PACTUnsignedAct(n_levels=256, init_clip='max', learn_clip=False, act_kind='relu')
+        self.pconv = PACTConv2d(8, 8, 3, n_levels=256, quantize='per_channel', padding=1, groups=2)
+        self.rqs = RequantShift(torch.ones(8), torch.zeros(8), 256)
+        self.pool = nn.AdaptiveAvgPool2d((2, 2))
+        self.lin = PACTLinear(32, 10, n_levels=256)
+
+    def forward(self, x):
+        y = self.act(self.bn(self.conv(x)))
+        y = self.rqs(self.pconv(y)) + y
+        y = torch.flatten(self.pool(y), 1)
+        return self.lin(y).view(-1, 5, 2)
+
+
+class TestMetaShapeProp(TestCase):
+
+    @staticmethod
+    def shapes(gm : fx.GraphModule):
+        return {n.name : (n.meta['tensor_meta'].shape, n.meta['tensor_meta'].dtype, n.meta['shape_in']) for n in gm.graph.nodes if 'tensor_meta' in n.meta.keys()}
+
+    def test_matches_real(self):
+        # shapes propagated on the meta device must be identical to those from
+        # executing the network
+        net = ShapeNet().eval()
+        for shape in [(1, 3, 16, 16), (4, 3, 15, 17)]:
+            ref = ShapePropPass(shape)(fx.symbolic_trace(net))
+            gm = ShapePropPass(shape, meta=True)(fx.symbolic_trace(net))
+            self.assertEqual(self.shapes(gm), self.shapes(ref))
+            self.assertEqual(len(self.shapes(gm)), len([n for n in gm.graph.nodes if n.op != 'output']))
+
+    def test_no_materialization(self):
+        # the network's parameters stay where they are
+        net = ShapeNet().eval()
+        gm = ShapePropPass((1, 3, 16, 16), meta=True)(fx.symbolic_trace(net))
+        for t in list(gm.parameters()) + list(gm.buffers()):
+            self.assertFalse(t.is_meta)
+
+
+class ResidualMLP(nn.Module):
+    def __init__(self):
+        super(ResidualMLP, self).__init__()
+        self.l1 = nn.Linear(16, 32)
+        self.relu = nn.ReLU()
+        self.l2 = nn.Linear(32, 16)
+
+    def forward(self, x):
+        return self.l2(self.relu(self.l1(x))) + x
+
+
+class TwoBranches(nn.Module):
+    # both large activations are computed before either is reduced, so the
+    # graph order keeps them alive at the same time
+    def __init__(self):
+        super(TwoBranches, self).__init__()
+        self.big1 = nn.Linear(16, 256)
+        self.big2 = nn.Linear(16, 256)
+
+    def forward(self, x):
+        p = self.big1(x)
+        r = self.big2(x)
+        return p.sum(-1, keepdim=True) + r.sum(-1, keepdim=True)
+
+
+def _plan(net : nn.Module, **kwargs):
+    gm = ShapePropPass((1, 16))(fx.symbolic_trace(net))
+    return ActivationMemoryPlanPass(**kwargs)(gm)
+
+
+class TestActivationMemoryPlan(TestCase):
+
+    def assertValidArena(self, plan):
+        # tensors with overlapping lifetimes must not overlap in the arena
+        allocs = plan.allocations
+        for i, a in enumerate(allocs):
+            self.assertEqual(a.offset % plan.alignment, 0)
+            self.assertLessEqual(a.offset + a.size, plan.arena_size)
+            for b in allocs[i+1:]:
+                if a.start <= b.end and b.start <= a.end:
+                    self.assertTrue(a.offset + a.size <= b.offset or b.offset + b.size <= a.offset, f"{a.name} and {b.name} overlap")
+        self.assertGreaterEqual(plan.arena_size, plan.peak_live)
+
+    def test_residual(self):
+        # float32 activations: x: 64 B, l1/relu: 128 B, l2/add: 64 B. x is
+        # live until the residual add.
+        gm = _plan(ResidualMLP(), alt_schedule=False)
+        plan = gm.memory_plan
+        self.assertEqual({a.name : (a.size, a.start, a.end) for a in plan.allocations},
+                         {'x' : (64, 0, 4), 'l1' : (128, 1, 2), 'relu' : (128, 2, 3), 'l2' : (64, 3, 4), 'add' : (64, 4, 5)})
+        self.assertEqual(plan.live_bytes, [64, 192, 320, 256, 192, 64])
+        self.assertEqual(plan.peak_live, 320)
+        self.assertEqual(plan.arena_size, 320)
+        self.assertEqual({a.name : a.offset for a in plan.allocations}, {'x' : 256, 'l1' : 0, 'relu' : 128, 'l2' : 0, 'add' : 64})
+        self.assertValidArena(plan)
+        for n in gm.graph.nodes:
+            if n.op != 'output':
+                self.assertEqual(n.meta['arena_offset'], next(a.offset for a in plan.allocations if a.name == n.name))
+
+    def test_alignment(self):
+        plan = _plan(ResidualMLP(), alignment=48, alt_schedule=False).memory_plan
+        self.assertEqual(plan.arena_size, 352)
+        self.assertValidArena(plan)
+
+    def test_bits(self):
+        gm = ShapePropPass((1, 16))(fx.symbolic_trace(ResidualMLP()))
+        x = next(iter(gm.graph.nodes))
+        self.assertEqual(activation_bytes(gm, x), 64)
+        self.assertEqual(activation_bytes(gm, x, default_bits=4), 16)
+        self.assertEqual(activation_bytes(gm, x, pack_bits=True, default_bits=4), 8)
+        self.assertEqual(activation_bytes(gm, x, pack_bits=True, default_bits=12), 24)
+        self.assertEqual(activation_bytes(gm, x, default_bits=12), 32)
+
+    def test_memory_aware_schedule(self):
+        # reducing each large activation right after it was computed halves
+        # the working set
+        plan = _plan(TwoBranches()).memory_plan
+        self.assertEqual(plan.peak_live, 2112)
+        self.assertEqual(plan.arena_size, 2112)
+        self.assertEqual(plan.alt_schedule, ['x', 'big1', 'sum_1', 'big2', 'sum_2', 'add', 'output'])
+        self.assertEqual(plan.alt_peak_live, 1092)
+        self.assertEqual(plan.alt_arena_size, 1092)
+        self.assertEqual(plan.schedule_savings, 1020)
+        self.assertValidArena(plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+#
+# profiling.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import time
+import tracemalloc
+from typing import Optional
+
+import torch
+from torch import fx
+
+__all__ = ['PassProfiler',
+           'active_profiler']
+
+_profiler_state = {'profiler' : None}
+
+def active_profiler():
+    return _profiler_state['profiler']
+
+def _n_nodes(gm : fx.GraphModule):
+    # constant time - the graph keeps track of its length
+    return len(gm.graph.nodes)
+
+def _n_matches(fx_pass):
+    matches = getattr(fx_pass, 'matches', None)
+    if not isinstance(matches, (list, tuple)):
+        return None
+    # multi-pattern passes store one list of matches per pattern
+    return sum(len(m) if isinstance(m, (list, tuple)) else 1 for m in matches)
+
+class PassProfiler:
+    # Opt-in instrumentation of FxPass pipelines. While a PassProfiler is
+    # active (use it as a context manager), every applied pass records:
+    # - 'name':           the name under which it is registered in its parent
+    #                     SequentialPass (the class name for top-level passes)
+    # - 'type':           the class name of the pass
+    # - 'time':           wall time in seconds (including all subpasses)
+    # - 'recompile_time': time spent recompiling and linting the GraphModule
+    # - 'matches':        number of pattern matches (if applicable)
+    # - 'nodes_added'/'nodes_removed': the net change of the number of nodes
+    #                     in the graph
+    # - 'peak_memory':    peak host memory allocated by Python (in bytes,
+    #                     relative to the start of the pass) if track_memory
+    #                     is set, and 'peak_cuda_memory' if CUDA is available
+    # - 'children':       the records of the subpasses
+    # Memory tracking uses tracemalloc, which slows down the pipeline
+    # noticeably and distorts the timings - it is disabled by default.
+    def __init__(self, track_memory : bool = False):
+        self.track_memory = track_memory
+        self.records = []
+        self._stack = []
+        self.next_name = None
+        self._started_tracemalloc = False
+        self._track_cuda = track_memory and torch.cuda.is_available()
+
+    def __enter__(self):
+        assert active_profiler() is None, "PassProfiler: Another profiler is already active!"
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        _profiler_state['profiler'] = self
+        return self
+
+    def __exit__(self, *args):
+        _profiler_state['profiler'] = None
+        self._stack = []
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _peak(self):
+        # absolute peaks since the last reset
+        host = tracemalloc.get_traced_memory()[1] if self.track_memory else 0
+        cuda = torch.cuda.max_memory_allocated() if self._track_cuda else 0
+        return host, cuda
+
+    def _reset_peak(self):
+        # tracemalloc.reset_peak is only available from Python 3.9 on
+        if self.track_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        if self._track_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def enter(self, fx_pass, gm : fx.GraphModule):
+        name = self.next_name if self.next_name is not None else type(fx_pass).__name__
+        self.next_name = None
+        record = {'name' : name,
+                  'type' : type(fx_pass).__name__,
+                  'time' : 0.,
+                  'recompile_time' : 0.,
+                  'matches' : None,
+                  'nodes_added' : 0,
+                  'nodes_removed' : 0,
+                  'children' : []}
+        frame = {'record' : record, 'nodes' : _n_nodes(gm), 'peak' : (0, 0), 'start_mem' : (0, 0)}
+        if self.track_memory:
+            if self._stack:
+                # save the parent's peak so far before resetting
+                parent = self._stack[-1]
+                parent['peak'] = tuple(max(a, b) for a, b in zip(parent['peak'], self._peak()))
+            self._reset_peak()
+            host = tracemalloc.get_traced_memory()[0]
+            cuda = torch.cuda.memory_allocated() if self._track_cuda else 0
+            frame['start_mem'] = (host, cuda)
+            frame['peak'] = (host, cuda)
+        (self._stack[-1]['record']['children'] if self._stack else self.records).append(record)
+        self._stack.append(frame)
+        frame['t_start'] = time.perf_counter()
+
+    def exit(self, fx_pass, gm : fx.GraphModule, recompile_time : float):
+        frame = self._stack.pop()
+        record = frame['record']
+        record['time'] = time.perf_counter() - frame['t_start']
+        record['recompile_time'] = recompile_time
+        record['matches'] = _n_matches(fx_pass)
+        diff = _n_nodes(gm) - frame['nodes']
+        record['nodes_added'] = max(diff, 0)
+        record['nodes_removed'] = max(-diff, 0)
+        if self.track_memory:
+            peak = tuple(max(a, b) for a, b in zip(frame['peak'], self._peak()))
+            record['peak_memory'] = peak[0] - frame['start_mem'][0]
+            if self._track_cuda:
+                record['peak_cuda_memory'] = peak[1] - frame['start_mem'][1]
+            if self._stack:
+                parent = self._stack[-1]
+                parent['peak'] = tuple(max(a, b) for a, b in zip(parent['peak'], peak))
+
+    def abort(self):
+        # a pass raised an exception - drop its frame
+        if self._stack:
+            frame = self._stack.pop()
+            frame['record']['time'] = time.perf_counter() - frame['t_start']
+            frame['record']['error'] = True
+
+    def report(self):
+        return self.records
+
+    def to_json(self, path : Optional[str] = None, **kwargs):
+        s = json.dumps(self.records, **kwargs)
+        if path is not None:
+            with open(path, 'w') as fh:
+                fh.write(s)
+        return s
+
+    def format_tree(self, min_time : float = 0.):
+        # printable tree of all records; passes which took less than
+        # min_time seconds are omitted
+        lines = []
+        def fmt(record, depth):
+            if record['time'] < min_time:
+                return
+            s = f"{'  '*depth}{record['name']} ({record['type']}): {record['time']*1000:.1f} ms"
+            details = []
+            if record['recompile_time'] > 0:
+                details.append(f"recompile {record['recompile_time']*1000:.1f} ms")
+            if record['matches'] is not None:
+                details.append(f"{record['matches']} matches")
+            if record['nodes_added'] or record['nodes_removed']:
+                details.append(f"+{record['nodes_added']}/-{record['nodes_removed']} nodes")
+            if 'peak_memory' in record.keys():
+                details.append(f"peak {record['peak_memory']/2**20:.1f} MiB")
+            if 'peak_cuda_memory' in record.keys():
+                details.append(f"peak CUDA {record['peak_cuda_memory']/2**20:.1f} MiB")
+            if len(details):
+                s += " [" + ", ".join(details) + "]"
+            lines.append(s)
+            for c in record['children']:
+                fmt(c, depth+1)
+        for r in self.records:
+            fmt(r, 0)
+        return "\n".join(lines)
@@ -20,18 +20,82 @@
 #
 
 import copy
+from functools import partial
 
-from torch import fx
+from torch import fx, nn
 from torch.fx.subgraph_rewriter import Match
 
-__all__ = ['SequentialMatcher', 'get_ordered_active_nodes']
+from .util import module_index
+
+from .tracing import LeafTracer
+
+__all__ = ['NodeIndex', 'SequentialMatcher', 'MultiSequentialMatcher', 'get_ordered_active_nodes', 'trace_pattern', 'clear_pattern_cache']
+
+# patterns are usually constructed and traced whenever a pass is constructed,
+# so traced patterns are cached for the whole process. The keys describe the
+# pattern's structure and the tracer rather than the object identities.
+_traced_patterns = {}
+
+def _tracer_key(t):
+    if isinstance(t, partial):
+        return (t.func, tuple(_tracer_key(a) for a in t.args), tuple(sorted((k, _tracer_key(v)) for k, v in t.keywords.items())))
+    if isinstance(t, LeafTracer):
+        return (type(t), frozenset(t.leaf_types))
+    return t
+
+def _pattern_key(pattern):
+    if isinstance(pattern, nn.Module):
+        return tuple((name, type(m), m.extra_repr()) for name, m in pattern.named_modules())
+    return pattern
+
+def trace_pattern(pattern : callable, trace : callable = fx.symbolic_trace):
+    # traced patterns are shared between matchers and must not be modified!
+    try:
+        key = (_pattern_key(pattern), _tracer_key(trace))
+        p = _traced_patterns.get(key)
+    except TypeError:
+        # unhashable pattern or tracer - don't cache
+        return trace(pattern)
+    if p is None:
+        p = trace(pattern)
+        _traced_patterns[key] = p
+    return p
+
+def clear_pattern_cache():
+    _traced_patterns.clear()
+
+class NodeIndex:
+    # index of the nodes of a GraphModule by op and target - or, for
+    # call_module nodes, by the type of the called module. It is built in a
+    # single traversal of the graph and can be shared by multiple matchers as
+    # long as the graph is not modified.
+    def __init__(self, gm : fx.GraphModule):
+        self.gm = gm
+        self.modules = module_index(gm)
+        self.nodes = {}
+        self.position = {}
+        for i, n in enumerate(gm.graph.nodes):
+            self.position[n] = i
+            self.nodes.setdefault(self.key(n), []).append(n)
+
+    def key(self, n : fx.Node):
+        if n.op == 'call_module':
+            return (n.op, type(self.modules[n.target]))
+        return (n.op, n.target)
+
+    def nodes_like(self, pn : fx.Node, pattern_modules : dict):
+        # all nodes which can be matched by the (non-wildcard) pattern node pn
+        if pn.op != 'call_module':
+            return self.nodes.get((pn.op, pn.target), [])
+        pattern_type = type(pattern_modules[pn.target])
+        return [n for (op, t), nodes in self.nodes.items() if op == 'call_module' and issubclass(t, pattern_type) for n in nodes]
 
 class SequentialMatcher:
     # simplified matcher which matches call_module ops more reasonably
     def __init__(self, pattern : callable, trace : callable = fx.symbolic_trace):
         # Trace a GraphModule from pattern
         self.trace = trace
-        p = self.trace(pattern)
+        p = trace_pattern(pattern, self.trace)
         # as this is a sequential matcher, ensure every node only has max. 1
         # input and output
         for n in p.graph.nodes:
@@ -47,12 +111,12 @@ class SequentialMatcher:
     @property
     def searched_modules(self):
         # a dictionary of the modules contained in the searched GraphModule
-        return dict(self.searched_gm.named_modules())
+        return module_index(self.searched_gm)
 
     @property
     def pattern_modules(self):
         # a dictionary of the modules contained in the pattern
-        return dict(self.p.named_modules())
+        return module_index(self.p)
 
     def matches_subgraph_from_anchor(self, anchor : fx.Node):
         # similar to the fx method, except the nodes_map is not a member of the
@@ -88,8 +152,10 @@ class SequentialMatcher:
                 # for call_module op, we check that the called module's exact
                 # type is the same - checking for the same target would require
                 # their names to be the same which really makes no sense.
-                return pn.op == gn.op and isinstance(self.searched_modules[gn.target], type(self.pattern_modules[pn.target]))
+                return pn.op == gn.op and isinstance(searched_modules[gn.target], type(pattern_modules[pn.target]))
 
+        searched_modules = self.searched_modules
+        pattern_modules = self.pattern_modules
         # from here on, proceed as in the original implementation.
         if not attributes_are_equal(pn, gn):
             return None
@@ -122,18 +188,34 @@ class SequentialMatcher:
         # pattern and graph. We know that gn has only 1 input!
         return self._match_nodes(pn.all_input_nodes[0], gn.all_input_nodes[0], False, nodes_map)
 
-    def match_graph(self, gm : fx.GraphModule):
+    def anchor_candidates(self, node_index : NodeIndex):
+        # the pattern's output node is a wildcard, so only the users of nodes
+        # matching the last active pattern node can anchor a match.
+        pn = self.pattern_anchor.all_input_nodes[0]
+        if pn.op == "placeholder":
+            return list(node_index.gm.graph.nodes)
+        anchors = set()
+        for n in node_index.nodes_like(pn, self.pattern_modules):
+            anchors.update(n.users.keys())
+        # visit the anchors in graph order to keep the greedy matching order
+        return sorted(anchors, key=node_index.position.__getitem__)
+
+    def match_graph(self, gm : fx.GraphModule, node_index : NodeIndex = None, matched_nodes : set = None):
         # this function returns a list of non-overlapping matches of self.p
         # in gm, which is first traced with self.trace. Any matches which
-        # overlap previous matches are discarded.
+        # overlap previous matches are discarded. To match multiple patterns
+        # with priorities, pass the same node_index and matched_nodes set to
+        # the matchers in order of decreasing priority.
 
         self.searched_gm = gm
+        if node_index is None:
+            node_index = NodeIndex(gm)
         all_matches = []
-        matched_nodes = set()
+        matched_nodes = set() if matched_nodes is None else matched_nodes
         def match_overlaps_with_previous(match):
             return any(n in matched_nodes and n.op not in ("placeholder", "output") and k.op not in ("placeholder", "output") for k, n in match.nodes_map.items())
 
-        for node in self.searched_gm.graph.nodes:
+        for node in self.anchor_candidates(node_index):
             matches = self.matches_subgraph_from_anchor(node)
             for m in matches:
                 if not match_overlaps_with_previous(m):
@@ -143,5 +225,20 @@ class SequentialMatcher:
                             matched_nodes.add(n)
         return all_matches
 
+class MultiSequentialMatcher:
+    # matches a list of sequential patterns in order of decreasing priority:
+    # the graph is indexed once and no node is matched by more than one
+    # pattern. This is equivalent to running a SequentialMatcher for each
+    # pattern and replacing the matches in between, as long as no pattern can
+    # match the replacement of a previous pattern.
+    def __init__(self, patterns : list, trace : callable = fx.symbolic_trace):
+        self.matchers = [SequentialMatcher(p, trace) for p in patterns]
+
+    def match_graph(self, gm : fx.GraphModule):
+        # returns a list of match lists, one for each pattern
+        node_index = NodeIndex(gm)
+        matched_nodes = set()
+        return [m.match_graph(gm, node_index, matched_nodes) for m in self.matchers]
+
 def get_ordered_active_nodes(m : Match):
     return [v for v in m.nodes_map.values()][-2:0:-1]
@@ -19,20 +19,72 @@
 # limitations under the License.
 # 
 
-from torch import fx
+import weakref
+
+from torch import fx, nn
 
 __all__ = ['gm_modules',
+           'module_index',
+           'invalidate_module_index',
+           'add_submodule',
+           'delete_submodule',
            'module_of_node',
            'named_module_nodes',
            'get_qualified_prefix']
 
+# building a {name : module} dictionary walks the whole module hierarchy, so
+# it is done once per GraphModule and the result is kept up to date by
+# `add_submodule`/`delete_submodule`. Code which modifies the module hierarchy
+# by other means must call `invalidate_module_index`.
+_module_indices = weakref.WeakKeyDictionary()
+
+def module_index(gm : nn.Module):
+    # the returned dictionary is shared - do not modify it!
+    index = _module_indices.get(gm)
+    if index is None:
+        index = dict(gm.named_modules())
+        _module_indices[gm] = index
+    return index
+
+def invalidate_module_index(gm : nn.Module):
+    _module_indices.pop(gm, None)
+
+def _drop_from_index(index : dict, target : str):
+    module = index.get(target)
+    if module is not None:
+        for name, _ in module.named_modules(prefix=target):
+            index.pop(name, None)
+
+def add_submodule(gm : fx.GraphModule, target : str, module : nn.Module):
+    added = gm.add_submodule(target, module)
+    index = _module_indices.get(gm)
+    if added and index is not None:
+        _drop_from_index(index, target)
+        # add_submodule creates missing intermediate modules
+        atoms = target.split('.')
+        for i in range(1, len(atoms)):
+            prefix = '.'.join(atoms[:i])
+            if prefix not in index.keys():
+                index[prefix] = gm.get_submodule(prefix)
+        for name, m in module.named_modules(prefix=target):
+            index[name] = m
+    return added
+
+def delete_submodule(gm : fx.GraphModule, target : str):
+    index = _module_indices.get(gm)
+    if index is not None:
+        _drop_from_index(index, target)
+    return gm.delete_submodule(target)
+
 def gm_modules(gm : fx.GraphModule):
-    return dict(gm.named_modules())
+    return module_index(gm)
 
 def module_of_node(gm : fx.GraphModule, node : fx.Node):
     assert node.op == "call_module", "module_of_node can only be called on 'call_module' nodes!"
-
-    return gm.get_submodule(node.target)
+    module = module_index(gm).get(node.target)
+    if module is None:
+        module = gm.get_submodule(node.target)
+    return module
 
 # convenience iterator to get all named modules and associated nodes
 # yields (name, node, module) tuples
@@ -0,0 +1,226 @@
+#
+# util_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+from unittest import TestCase
+from functools import partial
+
+import torch
+from torch import nn, fx
+
+from quantlib.editing.fx.passes.pass_base import FxPass, SequentialPass, ReplaceSequentialPatternPass, ReplaceSequentialPatternsPass
+from quantlib.editing.fx.util import module_index, add_submodule, delete_submodule, SequentialMatcher, MultiSequentialMatcher, get_ordered_active_nodes, trace_pattern, clear_pattern_cache
+from quantlib.editing.fx.util.tracing import LeafTracer, custom_symbolic_trace
+
+
+class Block(nn.Module):
+    def __init__(self):
+        super(Block, self).__init__()
+        self.conv = nn.Conv2d(4, 4, 3, padding=1)
+        self.bn = nn.BatchNorm2d(4)
+        self.act = nn.ReLU()
+
+    def forward(self, x):
+        return self.act(self.bn(self.conv(x)))
+
+
+class IndexSnapshotPass(FxPass):
+    # records the module index a pass sees
+    def run_pass(self, gm : fx.GraphModule):
+        self.index = dict(module_index(gm))
+        return gm
+
+
+class TestModuleIndex(TestCase):
+
+    def assertIndexValid(self, gm : fx.GraphModule):
+        index = module_index(gm)
+        ref = dict(gm.named_modules())
+        self.assertEqual(set(index.keys()), set(ref.keys()))
+        for k, m in ref.items():
+            self.assertIs(index[k], m)
+
+    def test_add_delete(self):
+        gm = fx.symbolic_trace(nn.Sequential(Block(), Block()))
+        module_index(gm)
+        # new intermediate modules are created
+        add_submodule(gm, 'extra.block', Block())
+        self.assertIndexValid(gm)
+        # an existing subtree is replaced
+        add_submodule(gm, '0', nn.Sequential(nn.Identity()))
+        self.assertNotIn('0.conv', module_index(gm).keys())
+        self.assertIndexValid(gm)
+        delete_submodule(gm, 'extra.block')
+        self.assertNotIn('extra.block.conv', module_index(gm).keys())
+        self.assertIndexValid(gm)
+
+    def test_outside_modification(self):
+        # changes to the module hierarchy between passes must not leave a
+        # stale index behind
+        gm = fx.symbolic_trace(nn.Sequential(Block()))
+        module_index(gm)
+        gm.add_module('extra', nn.ReLU())
+        del gm._modules['0']
+        snapshot = IndexSnapshotPass()
+        snapshot(gm)
+        self.assertIn('extra', snapshot.index.keys())
+        self.assertNotIn('0', snapshot.index.keys())
+        self.assertIndexValid(gm)
+
+
+class ReLUSub(nn.ReLU):
+    pass
+
+class LinearNet(nn.Module):
+    # sequential chains with branches: Linear -> ReLU pairs, lone Linears and
+    # ReLUs and a ReLU subclass
+    def __init__(self):
+        super(LinearNet, self).__init__()
+        self.l0 = nn.Linear(8, 8)
+        self.r0 = nn.ReLU()
+        self.l1 = nn.Linear(8, 8)
+        self.l2 = nn.Linear(8, 8)
+        self.r2 = ReLUSub()
+        self.r3 = nn.ReLU()
+        self.l4 = nn.Linear(8, 8)
+        self.r4 = nn.ReLU()
+
+    def forward(self, x):
+        y = self.r0(self.l0(x))
+        z = self.l2(self.l1(y))
+        # z has two users, so l2 can't be matched as a pattern's inner node
+        a = self.r3(self.r2(z))
+        b = self.r4(self.l4(z))
+        return a + b
+
+def _matched_nodes(matches):
+    return [[n.name for n in get_ordered_active_nodes(m)] for m in matches]
+
+def _match_all_anchors(matcher : SequentialMatcher, gm : fx.GraphModule):
+    # reference: SequentialMatcher.match_graph before anchors were taken from
+    # the node index - every node of the graph is tried as an anchor
+    matcher.searched_gm = gm
+    all_matches = []
+    matched_nodes = set()
+    for node in gm.graph.nodes:
+        for m in matcher.matches_subgraph_from_anchor(node):
+            if not any(n in matched_nodes and n.op not in ("placeholder", "output") and k.op not in ("placeholder", "output") for k, n in m.nodes_map.items()):
+                all_matches.append(m)
+                for k, n in m.nodes_map.items():
+                    if k.op not in ("placeholder", "output"):
+                        matched_nodes.add(n)
+    return all_matches
+
+_PATTERNS = [(nn.Sequential(nn.Linear(1, 1), nn.ReLU()), "_LIN_RELU"),
+             (nn.Sequential(nn.ReLU()), "_RELU"),
+             (nn.Sequential(nn.Linear(1, 1)), "_LIN")]
+
+class Marker(nn.Module):
+    # replacement module which records the size of the replaced match
+    def __init__(self, n : int):
+        super(Marker, self).__init__()
+        self.n = n
+
+    def forward(self, x):
+        return x
+
+def _replace_with_marker(gm : fx.GraphModule, match):
+    return Marker(len(get_ordered_active_nodes(match)))
+
+
+class TestSequentialMatcher(TestCase):
+
+    def test_anchors(self):
+        # anchoring only at users of candidate nodes must find the same
+        # matches in the same order as trying every node
+        gm = fx.symbolic_trace(LinearNet())
+        for pattern, _ in _PATTERNS + [(nn.Sequential(nn.ReLU(), nn.ReLU()), '')]:
+            matcher = SequentialMatcher(pattern)
+            ref = _matched_nodes(_match_all_anchors(SequentialMatcher(pattern), gm))
+            self.assertEqual(_matched_nodes(matcher.match_graph(gm)), ref)
+
+    def test_multi_matcher(self):
+        # matching the patterns by priority with a single matcher is
+        # equivalent to running one replacement pass per pattern
+        net = LinearNet()
+        ref = SequentialPass(*[ReplaceSequentialPatternPass(p, fx.symbolic_trace, _replace_with_marker, name) for p, name in _PATTERNS])(fx.symbolic_trace(net))
+        gm = ReplaceSequentialPatternsPass(_PATTERNS, fx.symbolic_trace, _replace_with_marker, "_MULTI")(fx.symbolic_trace(net))
+        self.assertEqual([(n.op, n.target) for n in gm.graph.nodes], [(n.op, n.target) for n in ref.graph.nodes])
+        for n in gm.graph.nodes:
+            if n.op == 'call_module':
+                m, m_ref = gm.get_submodule(n.target), ref.get_submodule(n.target)
+                self.assertIs(type(m), type(m_ref))
+                if isinstance(m, Marker):
+                    self.assertEqual(m.n, m_ref.n)
+        x = torch.randn(4, 8)
+        self.assertTrue(torch.equal(gm(x), ref(x)))
+
+    def test_multi_matcher_claims(self):
+        # no node is matched by more than one pattern
+        gm = fx.symbolic_trace(LinearNet())
+        matches = MultiSequentialMatcher([p for p, _ in _PATTERNS]).match_graph(gm)
+        names = [n for ms in matches for nodes in _matched_nodes(ms) for n in nodes]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(_matched_nodes(matches[0]), [['l0', 'r0'], ['l4', 'r4']])
+
+
+class ReLUFirst(nn.Sequential):
+    # same submodules as an nn.Sequential, but a different structure
+    def forward(self, x):
+        return self[0](x) + self[1](x)
+
+
+class TestTracePattern(TestCase):
+
+    def setUp(self):
+        clear_pattern_cache()
+
+    def test_structural_key(self):
+        p = trace_pattern(nn.Sequential(nn.Linear(4, 4), nn.ReLU()))
+        self.assertIs(trace_pattern(nn.Sequential(nn.Linear(4, 4), nn.ReLU())), p)
+        # different module configurations, types or forward functions
+        self.assertIsNot(trace_pattern(nn.Sequential(nn.Linear(4, 8), nn.ReLU())), p)
+        self.assertIsNot(trace_pattern(nn.Sequential(nn.Linear(4, 4), nn.ReLU6())), p)
+        self.assertIsNot(trace_pattern(ReLUFirst(nn.Linear(4, 4), nn.ReLU())), p)
+
+    def test_tracer_key(self):
+        pattern = nn.Sequential(nn.Linear(4, 4), nn.ReLU())
+        leaf_trace = lambda leaf_types: partial(custom_symbolic_trace, tracer=LeafTracer(leaf_types))
+        p = trace_pattern(pattern, leaf_trace([nn.ReLU]))
+        # tracer instances with the same leaf types share the cache entry
+        self.assertIs(trace_pattern(pattern, leaf_trace([nn.ReLU])), p)
+        self.assertIsNot(trace_pattern(pattern, leaf_trace([nn.ReLU, nn.Linear])), p)
+        self.assertIsNot(trace_pattern(pattern), p)
+
+    def test_unhashable(self):
+        # partials with unhashable arguments are traced every time
+        pattern = nn.Sequential(nn.ReLU())
+        trace = partial(custom_symbolic_trace, concrete_args={})
+        self.assertIsNot(trace_pattern(pattern, trace), trace_pattern(pattern, trace))
+
+    def test_clear(self):
+        p = trace_pattern(nn.Sequential(nn.ReLU()))
+        clear_pattern_cache()
+        self.assertIsNot(trace_pattern(nn.Sequential(nn.ReLU())), p)
+
+
+if __name__ == '__main__':
+    unittest.main()
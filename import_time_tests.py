@@ -0,0 +1,82 @@
+#
+# import_time_tests.py
+#
+# Author(s):
+# Georg Rutishauser <georgr@iis.ee.ethz.ch>
+#
+# Copyright (c) 2020-2021 ETH Zurich.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Import-time benchmark: every import is timed in a fresh interpreter, so
+# results are not affected by modules cached in this process. Run with
+#   python -m unittest quantlib.import_time_tests
+# or directly with
+#   python -m quantlib.import_time_tests
+# to print the timings.
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+from unittest import TestCase
+
+# modules which must not be loaded by importing a training-only part of
+# quantlib
+_HEAVY_MODULES = ['onnx', 'onnxruntime', 'torchvision', 'scipy', 'pandas', 'matplotlib']
+
+_PROBE = """
+import sys, time, json
+import torch
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(json.dumps({{'time' : t, 'modules' : sorted(m for m in {heavy} if m in sys.modules)}}))
+"""
+
+def time_import(module : str):
+    # returns (import time in seconds, heavy modules loaded by the import).
+    # torch is imported before the timer starts - it is needed in any case.
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    out = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, heavy=_HEAVY_MODULES)],
+                         env=env, check=True, capture_output=True, text=True).stdout
+    res = json.loads(out.strip().splitlines()[-1])
+    return res['time'], res['modules']
+
+
+class TestLazyImports(TestCase):
+
+    def test_toplevel(self):
+        _, loaded = time_import('quantlib')
+        self.assertEqual(loaded, [])
+
+    def test_pact(self):
+        _, loaded = time_import('quantlib.algorithms.pact')
+        self.assertEqual(loaded, [])
+
+    def test_fx_passes(self):
+        _, loaded = time_import('quantlib.editing.fx.passes')
+        self.assertEqual(loaded, [])
+
+
+if __name__ == '__main__':
+    for m in ['quantlib', 'quantlib.algorithms.pact', 'quantlib.editing.fx.passes', 'quantlib.backends.dory', 'quantlib.backends.deeploy']:
+        try:
+            t, loaded = time_import(m)
+            print(f"{m}: {t*1000:.0f} ms (heavy modules: {', '.join(loaded) if loaded else 'none'})")
+        except subprocess.CalledProcessError:
+            print(f"{m}: import failed")
+    unittest.main()